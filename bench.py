@@ -0,0 +1,283 @@
+#!/bin/env python
+"""
+Benchmarks the client against the stand-in server from tests.py, which runs
+in a child process so that it does not share the client's memory or GIL.
+
+Each benchmark runs at every concurrency given, and reports operations per
+second, MB/s for transfers, request latency percentiles and the client's
+peak memory as JSON. Every run is in a process of its own, so that its
+peak memory is not that of an earlier run. Given a previous run with
+--compare, exits with status 1 if anything got slower by more than
+--tolerance.
+
+    python bench.py --output bench.json
+    python bench.py --latency 0.02 --compare bench.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+import platform
+import multiprocessing
+
+from optparse import OptionParser
+
+import smartfile
+from smartfile import AsyncBasicClient
+from smartfile.metrics import MetricsCollector
+from smartfile.pipeline import ProcessPipeline
+from smartfile.tasks import TaskWaiter
+
+from tests import API_KEY
+from tests import API_PASSWORD
+from tests import StandInServer
+
+MB = 1048576.0
+BENCHMARKS = ('info', 'upload', 'download', 'ranged', 'tasks', 'pipeline')
+
+
+def serve(queue, options, sizes):
+    files = dict((path, os.urandom(size)) for path, size in sizes.items())
+    server = StandInServer(files=files, record=False, **options)
+    queue.put(server.server_port)
+    server.join()
+
+
+class Bench(object):
+    def __init__(self, url, options, tmp):
+        self.url = url
+        self.options = options
+        self.tmp = tmp
+
+    def client(self, concurrency):
+        return AsyncBasicClient(key=API_KEY, password=API_PASSWORD,
+                                url=self.url, workers=concurrency,
+                                pool_size=concurrency)
+
+    def count(self, errors):
+        "Counts the operations that succeeded, and those that failed."
+        done = 0
+        for error in errors:
+            if error is None:
+                done += 1
+            else:
+                self.failures += 1
+        return done
+
+    def bench_info(self, client, concurrency):
+        futures = [client.get('/path/info', '/bench/small.bin')
+                   for i in range(self.options.requests)]
+        return self.count(f.exception() for f in futures), 0
+
+    def bench_upload(self, client, concurrency):
+        pairs = [(self.options.local, '/bench/up%s/' % i)
+                 for i in range(concurrency * 2)]
+        done = self.count(r.error for r in client.upload_many(
+                          pairs, workers=concurrency))
+        return done, done * self.options.file_size
+
+    def bench_download(self, client, concurrency):
+        pairs = [('/bench/file.bin', os.path.join(self.tmp, 'down%s' % i))
+                 for i in range(concurrency * 2)]
+        done = self.count(r.error for r in client.download_many(
+                          pairs, workers=concurrency))
+        return done, done * self.options.file_size
+
+    def bench_ranged(self, client, concurrency):
+        local = os.path.join(self.tmp, 'ranged')
+        try:
+            client.download_to('/bench/large.bin', local, workers=concurrency,
+                               part_size=self.options.part_size)
+        except Exception:
+            self.failures += 1
+            return 0, 0
+        return 1, self.options.large_size
+
+    def bench_tasks(self, client, concurrency):
+        client.task_waiter = TaskWaiter(client, pollers=concurrency,
+                                        initial=0.01, max_delay=0.01)
+        tasks = [{'uuid': '%s-%s' % (concurrency, i)}
+                 for i in range(self.options.requests // 4)]
+        return self.count(f.exception()
+                          for f in client.wait_for_tasks(tasks)), 0
+
+    def bench_pipeline(self, client, concurrency):
+        pairs = [(self.options.local, '/bench/pipe%s/' % i)
+                 for i in range(concurrency * 2)]
+        with ProcessPipeline(client, processes=concurrency,
+                             threads=concurrency, compress=True,
+                             part_size=self.options.part_size) as pipeline:
+            done = self.count(r.error for r in pipeline.upload_many(pairs))
+        return done, done * self.options.file_size
+
+    def run(self, name, concurrency):
+        self.failures = 0
+        metrics = MetricsCollector()
+        with metrics.install(self.client(concurrency)) as client:
+            rss = peak_rss()
+            start = time.time()
+            operations, size = getattr(self, 'bench_' + name)(client,
+                                                              concurrency)
+            seconds = time.time() - start
+        totals = metrics.totals()
+        result = {
+            'name': name,
+            'concurrency': concurrency,
+            'operations': operations,
+            'failures': self.failures,
+            'requests': totals['requests'],
+            'errors': totals['errors'],
+            'retries': totals['retries'],
+            'seconds': seconds,
+            'ops_per_sec': operations / seconds,
+            'latency': totals['latency'],
+            'peak_rss_kb': peak_rss(),
+            'rss_growth_kb': peak_rss() - rss,
+        }
+        if size:
+            result['mb_per_sec'] = size / MB / seconds
+        return result
+
+
+def run_one(queue, bench, name, concurrency):
+    "Runs one benchmark in a child process, puts its result on queue."
+    try:
+        queue.put(bench.run(name, concurrency))
+    except Exception, e:
+        queue.put(e)
+        raise
+
+
+def run_isolated(bench, name, concurrency):
+    """Runs one benchmark in a fresh process. The peak memory the kernel
+    reports is the peak over a process's lifetime, so runs in one process
+    would all report the largest peak so far."""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=run_one,
+                                      args=(queue, bench, name, concurrency))
+    process.start()
+    try:
+        result = queue.get()
+    finally:
+        process.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def peak_rss():
+    "The peak resident memory of this process, in KB."
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+
+def compare(results, baseline, tolerance):
+    "Returns a message for each result slower than in baseline."
+    before = dict(((r['name'], r['concurrency']), r)
+                  for r in baseline['results'])
+    regressions = []
+    for result in results:
+        old = before.get((result['name'], result['concurrency']))
+        if old is None:
+            continue
+        for key in ('ops_per_sec', 'mb_per_sec'):
+            if key in old and result[key] < old[key] * (1 - tolerance):
+                regressions.append('%s x%s: %s %.2f -> %.2f' % (
+                    result['name'], result['concurrency'], key, old[key],
+                    result[key]))
+    return regressions
+
+
+def main():
+    parser = OptionParser(usage='%prog [options] [benchmark ...]',
+                          description='Benchmarks: ' + ', '.join(BENCHMARKS))
+    parser.add_option('-c', '--concurrency', default='1,4,16',
+                      help='comma separated concurrency levels [%default]')
+    parser.add_option('-n', '--requests', type='int', default=500,
+                      help='requests per info benchmark [%default]')
+    parser.add_option('--file-size', type='int', default=1048576,
+                      help='bytes per uploaded/downloaded file [%default]')
+    parser.add_option('--large-size', type='int', default=33554432,
+                      help='bytes of the ranged download [%default]')
+    parser.add_option('--part-size', type='int', default=4194304,
+                      help='part size of the ranged download [%default]')
+    parser.add_option('--latency', type='float', default=0,
+                      help='server latency per request, in seconds')
+    parser.add_option('--bandwidth', type='int', default=None,
+                      help='server bandwidth per request, in bytes/sec')
+    parser.add_option('--throttle-every', type='int', default=None,
+                      help='throttle one request in this many')
+    parser.add_option('-o', '--output', help='write JSON results here')
+    parser.add_option('--compare', metavar='FILE',
+                      help='report regressions against earlier results')
+    parser.add_option('--tolerance', type='float', default=0.2,
+                      help='slowdown allowed by --compare [%default]')
+    options, names = parser.parse_args()
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error('Unknown benchmark: %s' % name)
+    concurrency = [int(c) for c in options.concurrency.split(',')]
+
+    server_options = {'latency': options.latency,
+                      'bandwidth': options.bandwidth,
+                      'throttle_every': options.throttle_every}
+    sizes = {'/bench/small.bin': 1024,
+             '/bench/file.bin': options.file_size,
+             '/bench/large.bin': options.large_size}
+    queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve,
+                                     args=(queue, server_options, sizes))
+    server.daemon = True
+    server.start()
+    url = 'http://127.0.0.1:%s/' % queue.get(timeout=10)
+
+    tmp = tempfile.mkdtemp()
+    try:
+        options.local = os.path.join(tmp, 'file.bin')
+        with open(options.local, 'wb') as f:
+            f.write(os.urandom(options.file_size))
+        bench = Bench(url, options, tmp)
+        results = []
+        for name in names or BENCHMARKS:
+            for c in concurrency:
+                result = run_isolated(bench, name, c)
+                sys.stderr.write('%-10s x%-3s %9.1f ops/s %s\n' % (
+                    name, c, result['ops_per_sec'],
+                    'mb_per_sec' in result and
+                    '%8.1f MB/s' % result['mb_per_sec'] or ''))
+                results.append(result)
+    finally:
+        shutil.rmtree(tmp)
+        server.terminate()
+
+    report = {
+        'version': smartfile.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'server': server_options,
+        'results': results,
+    }
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    if options.compare:
+        with open(options.compare) as f:
+            regressions = compare(results, json.load(f), options.tolerance)
+        for regression in regressions:
+            sys.stderr.write('REGRESSION: %s\n' % regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
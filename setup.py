@@ -47,6 +47,7 @@ setup(
     url='http://github.com/smartfile/client-python/',
     license='MIT',
     packages=['smartfile'],
+    scripts=['bin/smartfile'],
     package_data={'': ['README.rst']},
     classifiers=(
         'Development Status :: 4 - Beta',
@@ -1,18 +1,32 @@
 import re
 import os
 import time
-import string
+import zlib
+import sys
 import urllib
 import urlparse
 import requests
+import threading
 
-from netrc import netrc
-
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
+from requests.models import RequestEncodingMixin
 
+from smartfile.auth import clean_tokens
+from smartfile.auth import oauth1
+from smartfile.auth import BasicAuthProvider
+from smartfile.auth import OAuthProvider
 from smartfile.errors import APIError
 from smartfile.errors import RequestError
 from smartfile.errors import ResponseError
+from smartfile.endpoint import Endpoint
+from smartfile.flight import request_key
+from smartfile.multipart import MultipartStream
+from smartfile.pool import Future
+from smartfile.pool import WorkerPool
+from smartfile.retry import body_mark
+from smartfile.retry import rewind_body
+from smartfile.retry import RetryPolicy
 
 
 __version__ = '2.1'
@@ -23,96 +37,461 @@ THROTTLE_PATTERN = re.compile('^.*; next=([\d\.]+) sec$')
 HTTP_USER_AGENT = 'SmartFile Python API client v{0}'.format(__version__)
 
 
-def clean_tokens(*args):
-    args = map(string.strip, args)
-    for i, arg in enumerate(args):
-        if len(arg) < 30:
-            raise ValueError("Too short")
-        if not isinstance(arg, unicode):
-            arg = unicode(arg)
-        args[i] = arg
-    return args
+def _filenames(kwargs):
+    "Returns the names of the files a prepared request uploads."
+    return getattr(kwargs.get('data'), 'filenames', ())
 
 
 class Client(object):
-    """Base API client, handles communication, retry, versioning etc."""
-    def __init__(self, url=None, version=__version__, throttle_wait=True):
+    """Base API client, handles communication, retry, versioning etc.
+
+    Requests are made through a pooled ``requests.Session``, so connections
+    to the API are kept alive and reused between calls. ``pool_size`` is the
+    maximum number of connections kept per host, ``pool_block`` makes callers
+    wait for a free connection rather than opening an extra one, and pooled
+    connections left unused for ``idle_timeout`` seconds are discarded. Call
+    ``close()`` (or use the client as a context manager) to release them.
+
+    Uploads are streamed from the file, upload_chunk_size bytes at a time.
+
+    A throttle.RateLimiter, which may be shared between clients, can be
+    given as rate_limiter to pace requests before the API throttles them.
+
+    If a cache.ResponseCache is given as cache, GET responses are cached
+    and revalidated with conditional requests.
+
+    Requests are signed by auth, an auth.AuthProvider, if one is given.
+
+    Failed requests are retried as retry, a retry.RetryPolicy, decides. By
+    default, throttled requests, and idempotent ones that failed in passing,
+    are tried up to retrys times, with backoff. Upload bodies are rewound
+    for each try.
+
+    Each try times out as timeout, a number of seconds or a (connect, read)
+    tuple, says; the read timeout applies to each read of the response, so
+    it also bounds a stalled download. hedge, a hedge.Hedge, sends a second
+    copy of GET requests that are slower than usual and uses whichever
+    answers first. breaker, a breaker.CircuitBreaker, fails requests to an
+    endpoint that keeps failing at once, until it recovers.
+
+    If a flight.SingleFlight is given as single_flight, identical GET
+    requests made at the same time, by any thread, share one request and
+    its decoded result, or its error.
+
+    With records, /path/info entries in JSON responses, including streamed
+    listing items, are decoded into compact records.PathInfo objects, which
+    can still be read like dicts.
+
+    With compress (the default), gzip and deflate responses are accepted and
+    decoded, including file downloads read from the returned stream; turn it
+    off for data that is already compressed. With compress_requests, form
+    bodies of compress_min_size bytes or more are sent gzipped at
+    compress_level, until the server refuses one with a 415 response. The
+    bytes compression saved are counted in bytes_saved, for requests sent
+    and buffered responses received."""
+    retrys = 3
+    # The number of Endpoint handles kept by endpoint().
+    max_endpoints = 256
+    # The size of the reads used to decode streamed JSON items.
+    stream_chunk_size = 65536
+    # Smaller request bodies are not worth compressing.
+    compress_min_size = 1024
+
+    def __init__(self, url=None, version=__version__, throttle_wait=True,
+                 pool_size=10, pool_block=False, keep_alive=True,
+                 idle_timeout=60, upload_chunk_size=65536,
+                 rate_limiter=None, cache=None, auth=None, compress=True,
+                 compress_requests=False, compress_level=6, retry=None,
+                 timeout=(10, 60), hedge=None, breaker=None,
+                 single_flight=None, records=False):
         self.url = url or os.environ.get('SMARTFILE_API_URL') or API_URL
         self.version = version
         self.throttle_wait = throttle_wait
+        self.pool_size = pool_size
+        self.pool_block = pool_block
+        self.keep_alive = keep_alive
+        self.idle_timeout = idle_timeout
+        self.upload_chunk_size = upload_chunk_size
+        self.rate_limiter = rate_limiter
+        self.cache = cache
+        self.auth = auth
+        self.retry = retry or RetryPolicy(tries=self.retrys)
+        self.timeout = timeout
+        self.hedge = hedge
+        self.breaker = breaker
+        self.single_flight = single_flight
+        self.records = records
+        self.compress = compress
+        self.compress_requests = compress_requests
+        self.compress_level = compress_level
+        self.bytes_saved = {'sent': 0, 'received': 0}
+        self._stats_lock = threading.Lock()
+        self._session = None
+        self._session_used = 0
+        self._session_lock = threading.Lock()
+        self._task_waiter = None
+        self._endpoints = {}
+        self._hooks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _create_session(self):
+        "Creates a session whose adapters pool connections to the API."
+        session = requests.Session()
+        for prefix in ('http://', 'https://'):
+            session.mount(prefix, HTTPAdapter(pool_connections=1,
+                                              pool_maxsize=self.pool_size,
+                                              pool_block=self.pool_block))
+        session.headers['User-Agent'] = HTTP_USER_AGENT
+        session.headers['Accept-Encoding'] = self.compress and \
+            'gzip, deflate' or 'identity'
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    @property
+    def session(self):
+        "The pooled session, created on first use and after close()."
+        with self._session_lock:
+            now = time.time()
+            if self._session is None:
+                self._session = self._create_session()
+            elif self.idle_timeout and \
+                    now - self._session_used > self.idle_timeout:
+                # Drop connections that have sat idle, the server has most
+                # likely closed them already.
+                for adapter in self._session.adapters.values():
+                    adapter.close()
+            self._session_used = now
+            return self._session
+
+    def close(self):
+        "Closes all pooled connections."
+        with self._session_lock:
+            session, self._session = self._session, None
+            waiter, self._task_waiter = self._task_waiter, None
+        if session is not None:
+            session.close()
+        if waiter is not None:
+            waiter.close()
+
+    def _get_task_waiter(self):
+        with self._session_lock:
+            if self._task_waiter is None:
+                from smartfile.tasks import TaskWaiter
+                self._task_waiter = TaskWaiter(self)
+            return self._task_waiter
+
+    def _set_task_waiter(self, waiter):
+        self._task_waiter = waiter
+
+    task_waiter = property(_get_task_waiter, _set_task_waiter, doc="""
+        The TaskWaiter used by wait_for_task(), created on first use. Assign
+        a TaskWaiter to change the polling intervals or number of pollers.""")
+
+    def on(self, event, fn):
+        """Registers fn to be called with a dict describing each event of the
+        given type. Events are:
+
+        request: a request is about to be sent (method, url).
+        response: a response was received (method, url, response, elapsed,
+            the seconds until its headers were received).
+        error: a request failed (method, url, error, elapsed).
+        throttle: the API throttled a request (url, delay, the seconds it
+            asked us to wait).
+        retry: a request is being retried (url, attempt, delay).
+        hedge: a second copy of a slow GET is being sent (url, delay).
+
+        Every event also includes the client and the event name. Hooks are
+        called by the thread making the request, and should be quick. A
+        client without hooks skips all of this."""
+        self._hooks.setdefault(event, []).append(fn)
+
+    def _fire(self, event, **info):
+        info['event'] = event
+        info['client'] = self
+        for fn in self._hooks.get(event, ()):
+            fn(info)
+
+    def _count_saved(self, direction, size):
+        with self._stats_lock:
+            self.bytes_saved[direction] += size
+
+    def _compress_body(self, kwargs):
+        """Returns a copy of kwargs with the form body gzipped, and the bytes
+        saved, or None if the body is too small to bother. The body is
+        encoded as requests would send it uncompressed."""
+        body = RequestEncodingMixin._encode_params(kwargs['data'])
+        if len(body) < self.compress_min_size:
+            return None
+        gz = zlib.compressobj(self.compress_level, zlib.DEFLATED,
+                              16 + zlib.MAX_WBITS)
+        compressed = dict(kwargs, data=gz.compress(body) + gz.flush())
+        compressed['headers'] = dict(kwargs.get('headers') or {}, **{
+            'Content-Type': 'application/x-www-form-urlencoded',
+            'Content-Encoding': 'gzip'})
+        return compressed, len(body) - len(compressed['data'])
 
     def _do_request(self, request, url, **kwargs):
         "Actually makes the HTTP request."
+        if self.auth is not None:
+            kwargs['auth'] = self.auth.signer
+        kwargs.setdefault('timeout', self.timeout)
+        breaker = self.breaker
+        if breaker is not None:
+            key = breaker.before(self, url)
         try:
-            response = request(url, stream=True, **kwargs)
-        except RequestException, e:
-            raise RequestError(e)
-        else:
-            if response.status_code >= 400:
-                raise ResponseError(response)
-        # Try to return the response in the most useful fashion given it's type.
+            compressed = None
+            if self.compress_requests and isinstance(kwargs.get('data'), dict):
+                compressed = self._compress_body(kwargs)
+            hooks = self._hooks
+            if hooks:
+                method = request.__name__.upper()
+                self._fire('request', method=method, url=url)
+                start = time.time()
+            try:
+                response = request(url, stream=True,
+                                   **(compressed and compressed[0] or kwargs))
+            except RequestException, e:
+                if breaker is not None:
+                    breaker.failure(key)
+                if hooks:
+                    self._fire('error', method=method, url=url, error=e,
+                               elapsed=time.time() - start)
+                raise RequestError(e)
+            else:
+                if breaker is not None:
+                    if response.status_code >= 500 and \
+                            'x-throttle' not in response.headers:
+                        breaker.failure(key)
+                    else:
+                        breaker.success(key)
+                if compressed is not None:
+                    if response.status_code == 415:
+                        # The server does not take compressed bodies, so
+                        # stop sending them.
+                        response.close()
+                        self.compress_requests = False
+                        return self._do_request(request, url, **kwargs)
+                    self._count_saved('sent', compressed[1])
+                if hooks:
+                    self._fire('response', method=method, url=url,
+                               response=response, elapsed=time.time() - start)
+                if response.status_code >= 400:
+                    e = ResponseError(response)
+                    if hooks:
+                        self._fire('error', method=method, url=url, error=e,
+                                   elapsed=time.time() - start)
+                    raise e
+            return response
+        finally:
+            if breaker is not None:
+                # Frees a half-open trial that failed before it was sent.
+                breaker.release(key)
+
+    def _read_body(self, response):
+        """Reads the body of a JSON response, so that one cut short fails
+        the try that sent it, and can be retried like it. Files are left to
+        be streamed."""
         if response.headers.get('content-type') == 'application/json':
+            try:
+                response.content
+            except RequestException, e:
+                raise RequestError(e)
+
+    def _decode_response(self, response):
+        "Returns the response in the most useful fashion given it's type."
+        if response.headers.get('content-type') == 'application/json':
+            length = response.headers.get('content-length')
+            if length and response.headers.get('content-encoding'):
+                self._count_saved('received',
+                                  len(response.content) - int(length))
             try:
                 # Try to decode as JSON
+                if self.records:
+                    from smartfile.records import object_hook
+                    return response.json(object_hook=object_hook)
                 return response.json()
             except ValueError:
                 # If that fails, return the text.
                 return response.text
         else:
-            # This might be a file, so return it.
+            # This might be a file, so return it, decompressed as it is read.
+            response.raw.decode_content = True
             return response.raw
 
-    def _request(self, method, endpoint, id=None, **kwargs):
-        "Handles retrying failed requests and error handling."
-        request = getattr(requests, method, None)
+    def _prepare_request(self, method, endpoint, id=None, **kwargs):
+        """Builds the request callable, URL and kwargs for requests from an
+        API call."""
+        request = getattr(self.session, method, None)
         if not callable(request):
             raise RequestError('Invalid method %s' % method)
-        # Find files, separate them out to correct kwarg for requests.
+        # Find files, if there are any the body is streamed as multipart.
         data = kwargs.get('data')
         if data:
             files = {}
             for name, value in data.items():
-                # Value might be a file-like object (with a read method), or it
-                # might be a (filename, file-like) tuple.
-                if hasattr(value, 'read') or isinstance(value, tuple):
+                # Value might be a file-like object (with a read method), an
+                # iterator of strings, or a (filename, file-like) tuple.
+                if hasattr(value, 'read') or hasattr(value, 'next') or \
+                        isinstance(value, tuple):
                     files[name] = data.pop(name)
             if files:
-                kwargs.setdefault('files', {}).update(files)
-        path = ['api', self.version, endpoint]
-        # If we received an ID, append it to the path.
-        if id:
-            path.append(str(id))
-        # Join fragments into a URL
-        path = '/'.join(path)
-        if not path.endswith('/'):
-            path += '/'
-        while '//' in path:
-            path = path.replace('//', '/')
-        url = self.url + path
-        # Add our user agent.
-        kwargs.setdefault('headers', {}).setdefault('User-Agent', HTTP_USER_AGENT)
-        # Now try the request, if we get throttled, sleep and try again.
-        trys, retrys = 0, 3
+                body = MultipartStream(data, files, self.upload_chunk_size)
+                kwargs['data'] = body
+                kwargs.setdefault('headers', {})['Content-Type'] = body.content_type
+        url = self.endpoint(endpoint).url_for(id)
+        return request, url, kwargs
+
+    def endpoint(self, endpoint):
+        """Returns a reusable Endpoint handle, whose get/put/post/delete
+        methods call the given endpoint with its URL already built."""
+        handle = self._endpoints.get(endpoint)
+        if handle is None:
+            if len(self._endpoints) >= self.max_endpoints:
+                self._endpoints.clear()
+            handle = self._endpoints[endpoint] = Endpoint(self, endpoint)
+        return handle
+
+    def _throttle_delay(self, e):
+        """Returns the number of seconds to wait before retrying a throttled
+        request, or None if the failure was not due to throttling."""
+        if e.status_code != 503:
+            return
+        m = THROTTLE_PATTERN.match(e.response.headers.get('x-throttle', ''))
+        if not m:
+            return
+        delay = float(m.group(1))
+        if self._hooks:
+            self._fire('throttle', url=e.response.url, delay=delay)
+        if self.rate_limiter is not None:
+            # The limiter holds back every request, including our retry.
+            self.rate_limiter.throttled(delay)
+            delay = 0
+        return delay
+
+    def _retry_delay(self, request, url, kwargs, attempt, e, started, mark):
+        """Returns the seconds to wait before retrying a request that failed
+        with e, or None to give up. Raises RequestError if throttling has
+        outlasted the retries."""
+        throttle = None
+        if isinstance(e, ResponseError):
+            throttle = self._throttle_delay(e)
+            if throttle is not None and not self.throttle_wait:
+                return None
+        delay = self.retry.delay(request.__name__.upper(), attempt, e,
+                                 time.time() - started, throttle)
+        if delay is None:
+            if throttle is not None and attempt >= self.retry.tries:
+                raise RequestError('Could not complete request after %s '
+                                   'trys.' % attempt)
+            return None
+        if not rewind_body(kwargs.get('data'), mark):
+            return None
+        if self._hooks:
+            self._fire('retry', url=url, attempt=attempt + 1, delay=delay,
+                       error=e)
+        return delay
+
+    def _try(self, request, url, kwargs, stream=False):
+        """Makes one try of a request, hedged if it is a GET whose body is
+        not to be streamed, as a hedge reads it whole."""
+        if self.hedge is not None and request.__name__ == 'get' and \
+                not stream:
+            return self.hedge.request(self, request, url, kwargs)
+        return self._do_request(request, url, **kwargs)
+
+    def _send(self, request, url, stream=False, **kwargs):
+        """Handles retrying failed requests and error handling. JSON bodies
+        are read before returning, unless stream is true."""
+        self.retry.started()
+        started = time.time()
+        mark = body_mark(kwargs.get('data'))
+        attempt = 0
         while True:
-            if trys == retrys:
-                raise RequestError('Could not complete request after %s trys.' % trys)
-            trys += 1
+            attempt += 1
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
             try:
-                return self._do_request(request, url, **kwargs)
-            except ResponseError, e:
-                if self.throttle_wait and e.status_code == 503:
-                    m = THROTTLE_PATTERN.match(e.response.headers.get('x-throttle', ''))
-                    if m:
-                        time.sleep(float(m.group(1)))
-                        continue
-                # Failed for a reason other than throttling.
-                raise
+                response = self._try(request, url, kwargs, stream)
+                if not stream:
+                    self._read_body(response)
+            except (RequestError, ResponseError), e:
+                delay = self._retry_delay(request, url, kwargs, attempt, e,
+                                          started, mark)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+            else:
+                if self.rate_limiter is not None:
+                    self.rate_limiter.succeeded()
+                return response
+
+    def _request(self, method, endpoint, id=None, **kwargs):
+        "Makes an API call, returning the decoded response."
+        data = kwargs.get('data')
+        request, url, kwargs = self._prepare_request(method, endpoint, id=id,
+                                                     **kwargs)
+        try:
+            return self._decode_response(self._send(request, url, **kwargs))
+        finally:
+            if self.cache is not None and method != 'get':
+                self.cache.invalidate(self, url, data, _filenames(kwargs))
+
+    def _get(self, url, params):
+        "Makes a GET request to a prepared URL."
+        return self._decode_response(self._send(self.session.get, url,
+                                                params=params))
 
     def __call__(self, *args, **kwargs):
         return self.get(*args, **kwargs)
 
+    def _iter_items(self, endpoint, id, params, key):
+        """Makes a GET request, returning a generator of the items of the
+        array named key in its JSON response, decoded as they arrive."""
+        request, url, kwargs = self._prepare_request('get', endpoint, id=id,
+                                                     params=params)
+        response = self._send(request, url, stream=True, **kwargs)
+        from smartfile.stream import ItemDecoder
+        object_hook = None
+        if self.records:
+            from smartfile.records import object_hook
+
+        def items():
+            try:
+                chunks = response.iter_content(self.stream_chunk_size)
+                for item in ItemDecoder(chunks, key=key,
+                                        object_hook=object_hook):
+                    yield item
+            finally:
+                response.close()
+        return items()
+
     def get(self, endpoint, id=None, **kwargs):
-        return self._request('get', endpoint, id=id, params=kwargs)
+        """Makes a GET request. If stream_items is true, the JSON response is
+        decoded incrementally, and a generator is returned that yields the
+        items of its children array (or the array named by stream_items) as
+        they arrive."""
+        stream_items = kwargs.pop('stream_items', None)
+        if stream_items:
+            if stream_items is True:
+                stream_items = 'children'
+            return self._iter_items(endpoint, id, kwargs, stream_items)
+        if self.single_flight is not None:
+            key = request_key(self, 'get', endpoint, id, kwargs)
+            return self.single_flight.do(key, self._fetch, endpoint, id,
+                                         kwargs)
+        return self._fetch(endpoint, id, kwargs)
+
+    def _fetch(self, endpoint, id, params):
+        "Makes a GET request, through the cache if there is one."
+        if self.cache is not None:
+            return self.cache.get(self, endpoint, id, params)
+        return self._request('get', endpoint, id=id, params=params)
 
     def put(self, endpoint, id=None, **kwargs):
         return self._request('put', endpoint, id=id, data=kwargs)
@@ -123,6 +502,99 @@ class Client(object):
     def delete(self, endpoint, id=None, **kwargs):
         return self._request('delete', endpoint, id=id, data=kwargs)
 
+    def wait_for_task(self, task, timeout=None):
+        """Waits for a task, given its uuid or the value returned when it was
+        created, to finish. Returns its final status, raises TaskError if it
+        fails or does not finish within timeout seconds."""
+        return self.task_waiter.wait(task, timeout=timeout).result()
+
+    def wait_for_tasks(self, tasks, timeout=None, callback=None):
+        """Starts waiting for many tasks at once, returns a Future for each.
+        callback, if given, is called with each future as it is done."""
+        return [self.task_waiter.wait(t, timeout=timeout, callback=callback)
+                for t in tasks]
+
+    def move_many(self, pairs, chunk_size=100, workers=None, wait=True,
+                  timeout=None):
+        """Moves (src, dst) pairs, where dst is a directory, using one API
+        call per destination for up to chunk_size sources. The calls are
+        made concurrently by up to workers threads (by default, pool_size),
+        paced by the rate limiter, if any. Unless wait is false, waits for
+        every resulting task at once. Returns a BatchResult."""
+        from smartfile import batch
+        return batch.oper_many(self, 'move', pairs, chunk_size=chunk_size,
+                               workers=workers, wait=wait, timeout=timeout)
+
+    def copy_many(self, pairs, chunk_size=100, workers=None, wait=True,
+                  timeout=None):
+        "Copies (src, dst) pairs, see move_many()."
+        from smartfile import batch
+        return batch.oper_many(self, 'copy', pairs, chunk_size=chunk_size,
+                               workers=workers, wait=wait, timeout=timeout)
+
+    def remove_many(self, paths, chunk_size=100, workers=None, wait=True,
+                    timeout=None):
+        "Removes paths, up to chunk_size per API call, see move_many()."
+        from smartfile import batch
+        return batch.remove_many(self, paths, chunk_size=chunk_size,
+                                 workers=workers, wait=wait, timeout=timeout)
+
+    def walk(self, root='/', **kwargs):
+        """Lazily yields every entry below root, listing directories
+        concurrently. See tree.walk() for the options."""
+        from smartfile import tree
+        return tree.walk(self, root, **kwargs)
+
+    def sync(self, local_dir, remote_dir, dry_run=False, **kwargs):
+        """Mirrors local_dir into remote_dir, transferring only the changes
+        since the last sync. Returns the SyncPlan that was carried out, or
+        with dry_run, that would be. See sync.Syncer for the options."""
+        from smartfile.sync import Syncer
+        return Syncer(self, local_dir, remote_dir, **kwargs).run(dry_run)
+
+    def upload_many(self, pairs, workers=None):
+        """Uploads (local, remote) pairs concurrently, using up to workers
+        threads (by default, pool_size). pairs may be any iterable, and is
+        consumed lazily. Returns a TransferResult for each pair, in order."""
+        from smartfile import transfer
+        return transfer.transfer_many(transfer.upload, self, pairs,
+                                      workers or self.pool_size)
+
+    def upload_chunked(self, local, remote, workers=4, part_size=8388608):
+        """Uploads a single large local file to a remote path, sending parts
+        of it concurrently, if the server supports uploads in parts. An
+        interrupted upload resumes where it left off when called again. See
+        transfer.ChunkedUpload."""
+        from smartfile import transfer
+        return transfer.ChunkedUpload(self, local, remote, workers=workers,
+                                      part_size=part_size).run()
+
+    def download(self, remote, local, chunk_size=1048576, progress=None,
+                 checksum=None, expect=None):
+        """Downloads a remote file to a local path, copying it through a
+        reused buffer of chunk_size bytes. progress(done, total) is called
+        after each chunk, and checksum, a hashlib object, is updated as the
+        file is written. If expect is given, a mismatched hex digest raises
+        APIError. See transfer.FileSink."""
+        from smartfile import transfer
+        return transfer.download(self, remote, local, chunk_size=chunk_size,
+                                 progress=progress, checksum=checksum,
+                                 expect=expect)
+
+    def download_many(self, pairs, workers=None):
+        """Downloads (remote, local) pairs concurrently, see upload_many()."""
+        from smartfile import transfer
+        return transfer.transfer_many(transfer.download, self, pairs,
+                                      workers or self.pool_size)
+
+    def download_to(self, remote, local, workers=4, part_size=8388608):
+        """Downloads a single remote file to a local path, fetching parts of
+        it concurrently. An interrupted download resumes where it left off
+        when called again. See transfer.RangedDownload."""
+        from smartfile import transfer
+        return transfer.RangedDownload(self, remote, local, workers=workers,
+                                       part_size=part_size).run()
+
 
 class BasicClient(Client):
     """API client that uses a key and password. Layers a simple form of
@@ -135,6 +607,7 @@ class BasicClient(Client):
         if password is None:
             password = os.environ.get('SMARTFILE_API_PASSWORD')
         if key is None or password is None:
+            from netrc import netrc
             try:
                 rc = netrc(netrcfile)
             except:
@@ -150,136 +623,219 @@ class BasicClient(Client):
                     if password is None:
                         password = auth[2]
         try:
-            self.key, self.password = clean_tokens(key, password)
+            self.auth = BasicAuthProvider(key, password)
         except ValueError:
             raise APIError('Please provide an API key and password. Use '
                            'arguments or environment variables.')
+        self.key, self.password = self.auth.key, self.auth.password
+
+
+class AsyncClient(Client):
+    """API client whose get/put/post/delete return a Future instead of
+    blocking. Calls run on a shared WorkerPool over the pooled session, and
+    throttled calls are rescheduled on the pool's timer rather than sleeping
+    in a worker, so many calls can be in flight at once. Downloads resolve to
+    the same file-like object the blocking client returns."""
+    def __init__(self, *args, **kwargs):
+        workers = kwargs.pop('workers', 32)
+        pool = kwargs.pop('pool', None)
+        kwargs.setdefault('pool_size', workers)
+        super(AsyncClient, self).__init__(*args, **kwargs)
+        self._owns_pool = pool is None
+        self.pool = pool or WorkerPool(workers)
+
+    def close(self):
+        if self._owns_pool:
+            self.pool.shutdown(wait=False)
+        super(AsyncClient, self).close()
 
-    def _do_request(self, *args, **kwargs):
-        # Add the token authentication
-        kwargs['auth'] = (self.key, self.password)
-        return super(BasicClient, self)._do_request(*args, **kwargs)
+    def _request(self, method, endpoint, id=None, **kwargs):
+        future = Future()
+        data = kwargs.get('data')
+        try:
+            request, url, kwargs = self._prepare_request(method, endpoint,
+                                                         id=id, **kwargs)
+        except:
+            future.set_exception(sys.exc_info())
+        else:
+            if self.cache is not None and method != 'get':
+                files = _filenames(kwargs)
+                future.add_done_callback(
+                    lambda f: self.cache.invalidate(self, url, data, files))
+            self._start(future, request, url, kwargs)
+        return future
+
+    def get(self, endpoint, id=None, **kwargs):
+        if kwargs.get('stream_items'):
+            return self.pool.submit(Client.get, self, endpoint, id, **kwargs)
+        if self.single_flight is not None:
+            key = request_key(self, 'get', endpoint, id, kwargs)
+            return self.single_flight.do_async(key, self._fetch, endpoint, id,
+                                               kwargs)
+        return self._fetch(endpoint, id, kwargs)
+
+    def _fetch(self, endpoint, id, params):
+        if self.cache is not None:
+            return self.pool.submit(self.cache.get, self, endpoint, id, params)
+        return self._request('get', endpoint, id=id, params=params)
+
+    def _get(self, url, params):
+        future = Future()
+        self._start(future, self.session.get, url, {'params': params})
+        return future
+
+    def _start(self, future, request, url, kwargs):
+        "Schedules the first attempt of a request."
+        self.retry.started()
+        state = (time.time(), body_mark(kwargs.get('data')))
+        self._schedule(0, future, request, url, kwargs, 1, state)
+
+    def _schedule(self, delay, *args):
+        "Schedules an attempt, waiting for a rate limiter slot if needed."
+        if self.rate_limiter is not None:
+            delay = max(delay, self.rate_limiter.reserve())
+        self.pool.submit_after(delay, self._attempt, *args)
+
+    def _attempt(self, future, request, url, kwargs, attempt, state):
+        "Makes one try of a request, resolving future or scheduling a retry."
+        try:
+            response = self._try(request, url, kwargs)
+            self._read_body(response)
+            result = self._decode_response(response)
+        except (RequestError, ResponseError), e:
+            exc_info = sys.exc_info()
+            try:
+                delay = self._retry_delay(request, url, kwargs, attempt, e,
+                                          *state)
+            except:
+                exc_info = sys.exc_info()
+                delay = None
+            if delay is None:
+                future.set_exception(exc_info)
+            else:
+                self._schedule(delay, future, request, url, kwargs,
+                               attempt + 1, state)
+        except:
+            future.set_exception(sys.exc_info())
+        else:
+            if self.rate_limiter is not None:
+                self.rate_limiter.succeeded()
+            future.set_result(result)
 
 
-try:
-    from requests_oauthlib import OAuth1
-    from oauthlib.oauth1 import SIGNATURE_PLAINTEXT
+class AsyncBasicClient(AsyncClient, BasicClient):
+    "BasicClient whose calls return a Future, see AsyncClient."
+    pass
 
-    #*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~
-    #                OAuth, if available.
-    #*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~
 
-    class OAuthToken(object):
-        "Internal representation of an OAuth (token, secret) tuple."
-        def __init__(self, token=None, secret=None):
-            self.token = token and unicode(token)
-            self.secret = secret and unicode(secret)
+#*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~
+#     OAuth, oauthlib is imported on first use.
+#*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~
 
-        def __iter__(self):
-            yield self.token
-            yield self.secret
-            raise StopIteration()
+class OAuthToken(object):
+    "Internal representation of an OAuth (token, secret) tuple."
+    def __init__(self, token=None, secret=None):
+        self.token = token and unicode(token)
+        self.secret = secret and unicode(secret)
 
-        def __getitem__(self, index):
-            return (self.token, self.secret)[index]
+    def __iter__(self):
+        yield self.token
+        yield self.secret
+        raise StopIteration()
 
-        def is_valid(self):
-            try:
-                clean_tokens(self.token, self.secret)
-                return True
-            except ValueError:
-                return False
-
-    class OAuthClient(Client):
-        """API client that uses OAuth tokens. Layers a more complex form of
-        authentication useful for 3rd party access on top of the base Client."""
-        def __init__(self, client_token=None, client_secret=None, access_token=None,
-                     access_secret=None, **kwargs):
-            if client_token is None:
-                client_token = os.environ.get('SMARTFILE_CLIENT_TOKEN')
-            if client_secret is None:
-                client_secret = os.environ.get('SMARTFILE_CLIENT_SECRET')
-            if access_token is None:
-                access_token = os.environ.get('SMARTFILE_ACCESS_TOKEN')
-            if access_secret is None:
-                access_secret = os.environ.get('SMARTFILE_ACCESS_SECRET')
-            self._client = OAuthToken(client_token, client_secret)
-            if not self._client.is_valid():
-                raise APIError('You must provide a client_token and client_secret '
-                               'for OAuth.')
-            self._access = OAuthToken(access_token, access_secret)
-            super(OAuthClient, self).__init__(**kwargs)
-
-        def _do_request(self, *args, **kwargs):
-            if not self._access.is_valid():
-                raise APIError('You must obtain an access token before making API '
-                               'calls.')
-            # Add the OAuth parameters.
-            kwargs['auth'] = OAuth1(self._client.token,
-                                    client_secret=self._client.secret,
-                                    resource_owner_key=self._access.token,
-                                    resource_owner_secret=self._access.secret,
-                                    signature_method=SIGNATURE_PLAINTEXT)
-            return super(OAuthClient, self)._do_request(*args, **kwargs)
-
-        def get_request_token(self, callback=None):
-            "The first step of the OAuth workflow."
-            if callback:
-                callback = unicode(callback)
-            oauth = OAuth1(self._client.token,
-                           client_secret=self._client.secret,
-                           callback_uri=callback,
-                           signature_method=SIGNATURE_PLAINTEXT)
-            r = requests.post(urlparse.urljoin(self.url, 'oauth/request_token/'), auth=oauth)
-            credentials = urlparse.parse_qs(r.text)
-            self.__request = OAuthToken(credentials.get('oauth_token')[0],
-                                        credentials.get('oauth_token_secret')[0])
-            return self.__request
-
-        def get_authorization_url(self, request=None):
-            "The second step of the OAuth workflow."
-            if request is None:
-                if not self.__request.is_valid():
-                    raise APIError('You must obtain a request token to request '
-                                   'and access token. Use get_request_token() '
-                                   'first.')
-                request = self.__request
-            url = urlparse.urljoin(self.url, 'oauth/authorize/')
-            return url + '?' + urllib.urlencode(dict(oauth_token=request.token))
-
-        def get_access_token(self, request=None, verifier=None):
-            """The final step of the OAuth workflow. After this the client can make
-            API calls."""
-            if verifier:
-                verifier = unicode(verifier)
-            if request is None:
-                if not self.__request.is_valid():
-                    raise APIError('You must obtain a request token to request '
-                                   'and access token. Use get_request_token() '
-                                   'first.')
-                request = self.__request
-            oauth = OAuth1(self._client.token,
-                           client_secret=self._client.secret,
-                           resource_owner_key=request.token,
-                           resource_owner_secret=request.secret,
-                           verifier=unicode(verifier),
-                           signature_method=SIGNATURE_PLAINTEXT)
-            r = requests.post(urlparse.urljoin(self.url, 'oauth/access_token/'), auth=oauth)
-            credentials = urlparse.parse_qs(r.text)
-            self._access = OAuthToken(credentials.get('oauth_token')[0],
-                                      credentials.get('oauth_token_secret')[0])
-            return self._access
-
-
-except ImportError:
-    #*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~
-    #              OAuth, if not available.
-    #*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~*~
-
-    # Instead of a class, define this as a function, thus when a user tries to
-    # "instantiate" it, they receive an exception.
-    def OAuthClient(*args, **kwargs):
-        raise NotImplementedError('You must install oauthlib and '
-                                  'requests_oauthlib to use the OAuthClient. '
-                                  'Try "pip install requests_oauthlib" to '
-                                  'install both.')
+    def __getitem__(self, index):
+        return (self.token, self.secret)[index]
+
+    def is_valid(self):
+        try:
+            clean_tokens(self.token, self.secret)
+            return True
+        except ValueError:
+            return False
+
+
+class OAuthClient(Client):
+    """API client that uses OAuth tokens. Layers a more complex form of
+    authentication useful for 3rd party access on top of the base Client."""
+    def __init__(self, client_token=None, client_secret=None, access_token=None,
+                 access_secret=None, **kwargs):
+        # Fails early if oauthlib is not installed.
+        oauth1()
+        if client_token is None:
+            client_token = os.environ.get('SMARTFILE_CLIENT_TOKEN')
+        if client_secret is None:
+            client_secret = os.environ.get('SMARTFILE_CLIENT_SECRET')
+        if access_token is None:
+            access_token = os.environ.get('SMARTFILE_ACCESS_TOKEN')
+        if access_secret is None:
+            access_secret = os.environ.get('SMARTFILE_ACCESS_SECRET')
+        self._client = OAuthToken(client_token, client_secret)
+        if not self._client.is_valid():
+            raise APIError('You must provide a client_token and client_secret '
+                           'for OAuth.')
+        super(OAuthClient, self).__init__(**kwargs)
+        self._access = OAuthToken(access_token, access_secret)
+
+    def _get_access(self):
+        return self.auth.access
+
+    def _set_access(self, access):
+        # Swapping the provider replaces the signer for all threads at once.
+        self.auth = OAuthProvider(self._client, access)
+
+    _access = property(_get_access, _set_access)
+
+    def get_request_token(self, callback=None):
+        "The first step of the OAuth workflow."
+        if callback:
+            callback = unicode(callback)
+        OAuth1, SIGNATURE_PLAINTEXT = oauth1()
+        oauth = OAuth1(self._client.token,
+                       client_secret=self._client.secret,
+                       callback_uri=callback,
+                       signature_method=SIGNATURE_PLAINTEXT)
+        r = self.session.post(urlparse.urljoin(self.url, 'oauth/request_token/'), auth=oauth)
+        credentials = urlparse.parse_qs(r.text)
+        self.__request = OAuthToken(credentials.get('oauth_token')[0],
+                                    credentials.get('oauth_token_secret')[0])
+        return self.__request
+
+    def get_authorization_url(self, request=None):
+        "The second step of the OAuth workflow."
+        if request is None:
+            if not self.__request.is_valid():
+                raise APIError('You must obtain a request token to request '
+                               'and access token. Use get_request_token() '
+                               'first.')
+            request = self.__request
+        url = urlparse.urljoin(self.url, 'oauth/authorize/')
+        return url + '?' + urllib.urlencode(dict(oauth_token=request.token))
+
+    def get_access_token(self, request=None, verifier=None):
+        """The final step of the OAuth workflow. After this the client can make
+        API calls."""
+        if verifier:
+            verifier = unicode(verifier)
+        if request is None:
+            if not self.__request.is_valid():
+                raise APIError('You must obtain a request token to request '
+                               'and access token. Use get_request_token() '
+                               'first.')
+            request = self.__request
+        OAuth1, SIGNATURE_PLAINTEXT = oauth1()
+        oauth = OAuth1(self._client.token,
+                       client_secret=self._client.secret,
+                       resource_owner_key=request.token,
+                       resource_owner_secret=request.secret,
+                       verifier=unicode(verifier),
+                       signature_method=SIGNATURE_PLAINTEXT)
+        r = self.session.post(urlparse.urljoin(self.url, 'oauth/access_token/'), auth=oauth)
+        credentials = urlparse.parse_qs(r.text)
+        self._access = OAuthToken(credentials.get('oauth_token')[0],
+                                  credentials.get('oauth_token_secret')[0])
+        return self._access
+
+
+class AsyncOAuthClient(AsyncClient, OAuthClient):
+    "OAuthClient whose calls return a Future, see AsyncClient."
+    pass
@@ -0,0 +1,75 @@
+import string
+
+from requests.auth import HTTPBasicAuth
+
+from smartfile.errors import APIError
+
+
+def clean_tokens(*args):
+    "Strips and checks tokens, raising ValueError if one is missing or bad."
+    for arg in args:
+        if not isinstance(arg, basestring):
+            raise ValueError("Missing")
+    args = map(string.strip, args)
+    for i, arg in enumerate(args):
+        if len(arg) < 30:
+            raise ValueError("Too short")
+        if not isinstance(arg, unicode):
+            arg = unicode(arg)
+        args[i] = arg
+    return args
+
+
+def oauth1():
+    """Returns requests_oauthlib's OAuth1 and the PLAINTEXT signature method,
+    importing them on first use so that only OAuth users pay for loading
+    oauthlib. Raises NotImplementedError if they are not installed."""
+    try:
+        from requests_oauthlib import OAuth1
+        from oauthlib.oauth1 import SIGNATURE_PLAINTEXT
+    except ImportError:
+        raise NotImplementedError('You must install oauthlib and '
+                                  'requests_oauthlib to use OAuth. Try "pip '
+                                  'install requests_oauthlib" to install both.')
+    return OAuth1, SIGNATURE_PLAINTEXT
+
+
+class AuthProvider(object):
+    """Supplies the requests auth object (the signer) that a client attaches
+    to each request. Credentials are validated once, when the provider is
+    created, and the signer is shared by every request and thread. A client
+    changes credentials by replacing its provider, which is atomic."""
+    signer = None
+
+
+class BasicAuthProvider(AuthProvider):
+    "HTTP Basic authentication with an API key and password."
+    def __init__(self, key, password):
+        self.key, self.password = clean_tokens(key, password)
+        self.signer = HTTPBasicAuth(self.key, self.password)
+
+
+class OAuthProvider(AuthProvider):
+    """OAuth 1 authentication, signing with the client and access tokens. If
+    the access token is not valid, using the signer raises APIError."""
+    def __init__(self, client, access):
+        OAuth1, SIGNATURE_PLAINTEXT = oauth1()
+        self.client = client
+        self.access = access
+        try:
+            clean_tokens(access.token, access.secret)
+        except ValueError:
+            self._signer = None
+        else:
+            self._signer = OAuth1(client.token,
+                                  client_secret=client.secret,
+                                  resource_owner_key=access.token,
+                                  resource_owner_secret=access.secret,
+                                  signature_method=SIGNATURE_PLAINTEXT)
+
+    @property
+    def signer(self):
+        if self._signer is None:
+            raise APIError('You must obtain an access token before making API '
+                           'calls.')
+        return self._signer
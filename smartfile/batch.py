@@ -0,0 +1,120 @@
+from smartfile.pool import WorkerPool
+from smartfile.transfer import _resolve
+
+
+class BatchCall(object):
+    """One API call of a batch operation: the sources it covered, the task
+    it started, and its final status or error."""
+    __slots__ = ('operation', 'dst', 'sources', 'task', 'status', 'error')
+
+    def __init__(self, operation, dst, sources):
+        self.operation = operation
+        self.dst = dst
+        self.sources = sources
+        self.task = None
+        self.status = None
+        self.error = None
+
+    def __repr__(self):
+        return '<BatchCall %s %s paths: %s>' % (
+            self.operation, len(self.sources), self.error or 'ok')
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class BatchResult(object):
+    """The outcome of a batch operation, one BatchCall per API call. A call
+    that failed, or whose task failed, records its error rather than
+    stopping the others."""
+    def __init__(self, calls):
+        self.calls = calls
+
+    def __len__(self):
+        return len(self.calls)
+
+    def __repr__(self):
+        return '<BatchResult %s calls, %s failed>' % (len(self.calls),
+                                                      len(self.errors))
+
+    @property
+    def ok(self):
+        return all(c.ok for c in self.calls)
+
+    @property
+    def errors(self):
+        return [c.error for c in self.calls if not c.ok]
+
+    @property
+    def failed(self):
+        "The source paths of every call that failed."
+        return [s for c in self.calls if not c.ok for s in c.sources]
+
+    @property
+    def tasks(self):
+        return [c.task for c in self.calls if c.task is not None]
+
+
+def group(pairs):
+    """Groups (src, dst) pairs into [(dst, [src, ...])], in the order each
+    destination first appears."""
+    groups, order = {}, []
+    for src, dst in pairs:
+        dst = '/' + dst.strip('/')
+        if dst not in groups:
+            groups[dst] = []
+            order.append(dst)
+        groups[dst].append(src)
+    return [(d, groups[d]) for d in order]
+
+
+def split(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def run(client, operation, calls, workers=None, wait=True, timeout=None):
+    """Sends the calls to /path/oper/<operation> concurrently, then, unless
+    wait is false, waits for all of their tasks at once."""
+    def send(call):
+        data = {'path': call.sources}
+        if call.dst is not None:
+            data = {'src': call.sources, 'dst': call.dst}
+        try:
+            result = _resolve(client.post('/path/oper/' + operation, **data))
+        except Exception, e:
+            call.error = e
+        else:
+            if isinstance(result, dict) and 'uuid' in result:
+                call.task = result
+            else:
+                call.status = result
+        return call
+    with WorkerPool(workers or client.pool_size) as pool:
+        for future in pool.map(send, calls):
+            future.result()
+    if wait:
+        started = [c for c in calls if c.task is not None]
+        futures = client.wait_for_tasks([c.task for c in started],
+                                        timeout=timeout)
+        for call, future in zip(started, futures):
+            call.error = future.exception()
+            if call.error is None:
+                call.status = future.result()
+    return BatchResult(calls)
+
+
+def oper_many(client, operation, pairs, chunk_size=100, **kwargs):
+    "Moves or copies (src, dst) pairs, see Client.move_many()."
+    calls = []
+    for dst, sources in group(pairs):
+        for chunk in split(sources, chunk_size):
+            calls.append(BatchCall(operation, dst, chunk))
+    return run(client, operation, calls, **kwargs)
+
+
+def remove_many(client, paths, chunk_size=100, **kwargs):
+    "Removes paths, see Client.remove_many()."
+    calls = [BatchCall('remove', None, chunk)
+             for chunk in split(list(paths), chunk_size)]
+    return run(client, 'remove', calls, **kwargs)
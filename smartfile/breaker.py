@@ -0,0 +1,103 @@
+import time
+import threading
+
+from smartfile.errors import RequestError
+from smartfile.metrics import endpoint_key
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(RequestError):
+    "A request was refused because its endpoint's circuit is open."
+    def __init__(self, key, retry_in):
+        self.key = key
+        self.retry_in = retry_in
+        super(CircuitOpenError, self).__init__(
+            'Circuit for %s is open, retrying in %.1f seconds.' % (
+                key or '/', retry_in))
+
+
+class Circuit(object):
+    __slots__ = ('state', 'failures', 'opened', 'trial')
+
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0.0
+        self.trial = False
+
+
+class CircuitBreaker(object):
+    """Fails requests fast while an endpoint is down, rather than letting
+    every caller wait out its timeouts and retries.
+
+    Each endpoint (e.g. path/info) has a circuit. After threshold failures
+    in a row (connection errors, timeouts and 5xx responses other than
+    throttling) it opens, and requests to the endpoint raise
+    CircuitOpenError without being sent. After reset_timeout seconds, one
+    trial request is let through: if it succeeds the circuit closes, if not
+    it opens again. Any other response, including 4xx errors, shows the
+    endpoint is up. A breaker may be shared between clients."""
+    def __init__(self, threshold=5, reset_timeout=30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._circuits = {}
+        self._lock = threading.Lock()
+
+    def _circuit(self, key):
+        circuit = self._circuits.get(key)
+        if circuit is None:
+            circuit = self._circuits[key] = Circuit()
+        return circuit
+
+    def state(self, key):
+        "Returns the state of an endpoint's circuit."
+        with self._lock:
+            return self._circuit(key).state
+
+    def before(self, client, url):
+        """Called before a request is sent. Returns the endpoint key, or
+        raises CircuitOpenError."""
+        key = endpoint_key(client, url)
+        with self._lock:
+            circuit = self._circuit(key)
+            if circuit.state == CLOSED:
+                return key
+            retry_in = circuit.opened + self.reset_timeout - time.time()
+            if circuit.state == OPEN and retry_in <= 0:
+                circuit.state = HALF_OPEN
+                circuit.trial = False
+            if circuit.state == HALF_OPEN and not circuit.trial:
+                circuit.trial = True
+                return key
+        raise CircuitOpenError(key, max(retry_in, 0))
+
+    def release(self, key):
+        """Called once a request is done. Lets another trial through if this
+        one recorded neither a success nor a failure, e.g. as it raised
+        before it was sent."""
+        with self._lock:
+            circuit = self._circuit(key)
+            if circuit.state == HALF_OPEN:
+                circuit.trial = False
+
+    def success(self, key):
+        with self._lock:
+            circuit = self._circuit(key)
+            circuit.state = CLOSED
+            circuit.failures = 0
+
+    def failure(self, key):
+        "Records a failure, returns True if it opened the circuit."
+        with self._lock:
+            circuit = self._circuit(key)
+            circuit.failures += 1
+            if circuit.state == HALF_OPEN or (
+                    circuit.state == CLOSED and
+                    circuit.failures >= self.threshold):
+                circuit.state = OPEN
+                circuit.opened = time.time()
+                return True
+            return False
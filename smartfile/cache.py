@@ -0,0 +1,193 @@
+import time
+import posixpath
+import threading
+
+from requests.models import RequestEncodingMixin
+
+# Indexes into the links of LRU's list.
+PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+# Form fields of write operations that name paths.
+PATH_FIELDS = ('path', 'src', 'dst')
+# Endpoints whose responses change on their own, such as task status.
+UNCACHED = frozenset(['task'])
+
+
+class LRU(object):
+    """A mapping that holds at most maxsize items, discarding the least
+    recently used. Not thread-safe, callers must lock."""
+    def __init__(self, maxsize, on_evict=None):
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self._map = {}
+        # A circular, doubly linked list, most recently used first.
+        self._root = root = []
+        root[:] = [root, root, None, None]
+
+    def __len__(self):
+        return len(self._map)
+
+    def __contains__(self, key):
+        return key in self._map
+
+    def keys(self):
+        return self._map.keys()
+
+    def _unlink(self, link):
+        link[PREV][NEXT] = link[NEXT]
+        link[NEXT][PREV] = link[PREV]
+
+    def _push(self, link):
+        root = self._root
+        link[PREV], link[NEXT] = root, root[NEXT]
+        root[NEXT][PREV] = link
+        root[NEXT] = link
+
+    def get(self, key, default=None):
+        link = self._map.get(key)
+        if link is None:
+            return default
+        self._unlink(link)
+        self._push(link)
+        return link[VALUE]
+
+    def __setitem__(self, key, value):
+        link = self._map.get(key)
+        if link is not None:
+            self._unlink(link)
+            link[VALUE] = value
+        else:
+            link = self._map[key] = [None, None, key, value]
+        self._push(link)
+        while len(self._map) > self.maxsize:
+            self.pop(self._root[PREV][KEY])
+
+    def pop(self, key, default=None):
+        link = self._map.pop(key, None)
+        if link is None:
+            return default
+        self._unlink(link)
+        if self.on_evict is not None:
+            self.on_evict(key, link[VALUE])
+        return link[VALUE]
+
+
+class CacheEntry(object):
+    __slots__ = ('resource', 'value', 'etag', 'modified', 'expires')
+
+    def __init__(self, resource, value, etag, modified, expires):
+        self.resource = resource
+        self.value = value
+        self.etag = etag
+        self.modified = modified
+        self.expires = expires
+
+
+def resource(client, url):
+    """Returns the (endpoint, path) a URL refers to, for invalidation. For
+    /path/ endpoints this is the file path, so that /path/info/a/ and
+    /path/data/a/ are the same resource."""
+    parts = url[len(client.url):].strip('/').split('/')[2:] or ['']
+    if parts[0] == 'path':
+        # Skip the operation, e.g. info or data.
+        return 'path', '/' + '/'.join(parts[2:])
+    return parts[0], '/' + '/'.join(parts[1:])
+
+
+class ResponseCache(object):
+    """An LRU cache of decoded JSON responses to GET requests, keyed by URL
+    and parameters, holding at most maxsize entries.
+
+    Entries are returned without contacting the API for ttl seconds. After
+    that, they are revalidated using the ETag and Last-Modified headers of
+    the original response, so an unchanged resource costs a 304 response
+    with no body. Entries without either header are simply dropped once
+    they expire. PUT, POST and DELETE requests made through the client
+    invalidate entries for the paths they touch, and their parents.
+    Endpoints in UNCACHED, such as /task, are never cached.
+
+    Cached values are shared between callers, and should not be modified."""
+    def __init__(self, maxsize=1024, ttl=30):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = LRU(maxsize, on_evict=self._evicted)
+        self._resources = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _evicted(self, key, entry):
+        keys = self._resources.get(entry.resource)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._resources[entry.resource]
+
+    def _store(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._resources.setdefault(entry.resource, set()).add(key)
+
+    def get(self, client, endpoint, id, params):
+        "Performs a GET request through client, using the cache."
+        request, url, kwargs = client._prepare_request('get', endpoint, id=id,
+                                                       params=params)
+        if resource(client, url)[0] in UNCACHED:
+            return client._decode_response(client._send(request, url,
+                                                        **kwargs))
+        key = url + '?' + RequestEncodingMixin._encode_params(
+            sorted(params.items()))
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None:
+            if entry.expires > now:
+                return entry.value
+            headers = kwargs.setdefault('headers', {})
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.modified:
+                headers['If-Modified-Since'] = entry.modified
+        response = client._send(request, url, **kwargs)
+        if response.status_code == 304 and entry is not None:
+            response.close()
+            entry.expires = now + self.ttl
+            self._store(key, entry)
+            return entry.value
+        value = client._decode_response(response)
+        if response.headers.get('content-type') == 'application/json':
+            etag = response.headers.get('etag')
+            modified = response.headers.get('last-modified')
+            if self.ttl or etag or modified:
+                self._store(key, CacheEntry(resource(client, url), value, etag,
+                                            modified, now + self.ttl))
+        return value
+
+    def invalidate(self, client, url, data=None, files=()):
+        """Drops entries for the resource a write request was made to, for
+        any paths named in its data and for the files, by name, it uploaded
+        into it, as well as their parents."""
+        touched = []
+        endpoint, path = resource(client, url)
+        if not (endpoint == 'path' and '/oper/' in url):
+            touched.append((endpoint, path))
+        if endpoint == 'path':
+            for name in files or ():
+                touched.append(('path', posixpath.join(path, name)))
+        if endpoint == 'path' and isinstance(data, dict):
+            for name in PATH_FIELDS:
+                paths = data.get(name)
+                if isinstance(paths, basestring):
+                    paths = [paths]
+                for p in paths or ():
+                    touched.append(('path', '/' + p.strip('/')))
+        with self._lock:
+            for endpoint, path in touched:
+                for p in (path, posixpath.dirname(path)):
+                    for key in list(self._resources.get((endpoint, p), ())):
+                        self._entries.pop(key)
+
+    def clear(self):
+        with self._lock:
+            for key in self._entries.keys():
+                self._entries.pop(key)
@@ -0,0 +1,247 @@
+"""
+The smartfile command line client.
+
+    smartfile [options] COMMAND [ARGS...]
+    smartfile [options] batch < commands
+
+Commands:
+
+    get|put|post|delete ENDPOINT [ID] [NAME=VALUE ...]
+    upload LOCAL REMOTE
+    download REMOTE LOCAL
+    ls [PATH]
+    mv SRC... DIR
+    cp SRC... DIR
+    rm PATH...
+    wait UUID...
+    sync LOCAL REMOTE
+
+Results are printed as JSON, except files fetched with get, which are copied
+to standard output.
+
+In batch mode, commands are read from standard input, one per line (blank
+lines and lines starting with # are skipped), and run over a single client,
+so credentials are checked and connections opened only once. Up to --jobs
+commands run at a time, so commands that depend on earlier ones need
+--jobs 1. For each command, one line of JSON is printed, in input order:
+{"line": N, "result": ...} or {"line": N, "error": "..."}.
+The exit status is 1 if any command failed.
+
+Credentials are taken from the options, the SMARTFILE_* environment
+variables or ~/.netrc, as with BasicClient and OAuthClient.
+"""
+
+import sys
+import json
+import Queue
+import shlex
+import shutil
+import threading
+
+from optparse import OptionParser
+
+from smartfile import BasicClient
+from smartfile import OAuthClient
+from smartfile.errors import APIError
+from smartfile.pool import WorkerPool
+
+
+class UsageError(APIError):
+    "A command was given the wrong arguments."
+    pass
+
+
+def parse_params(args):
+    "Parses NAME=VALUE arguments, a repeated NAME gives a list of values."
+    params = {}
+    for arg in args:
+        name, sep, value = arg.partition('=')
+        if not sep:
+            raise UsageError('Expected NAME=VALUE, got %r.' % arg)
+        if name in params:
+            if not isinstance(params[name], list):
+                params[name] = [params[name]]
+            params[name].append(value)
+        else:
+            params[name] = value
+    return params
+
+
+def _call(method):
+    def call(client, args):
+        if not args:
+            raise UsageError('%s ENDPOINT [ID] [NAME=VALUE ...]' % method)
+        id = None
+        if len(args) > 1 and '=' not in args[1]:
+            id = args[1]
+            del args[1]
+        return getattr(client, method)(args[0], id, **parse_params(args[1:]))
+    return call
+
+
+def _args(args, count, usage):
+    if len(args) != count:
+        raise UsageError(usage)
+    return args
+
+
+def upload(client, args):
+    from smartfile import transfer
+    return transfer.upload(client, *_args(args, 2, 'upload LOCAL REMOTE'))
+
+
+def download(client, args):
+    from smartfile import transfer
+    return transfer.download(client, *_args(args, 2, 'download REMOTE LOCAL'))
+
+
+def ls(client, args):
+    path = args and _args(args, 1, 'ls [PATH]')[0] or '/'
+    return sorted(e['path'] for e in client.walk(path, maxdepth=1))
+
+
+def _transfer(operation):
+    def run(client, args):
+        if len(args) < 2:
+            raise UsageError('%s SRC... DIR' % operation)
+        result = getattr(client, operation + '_many')([(src, args[-1])
+                                                      for src in args[:-1]])
+        if not result.ok:
+            raise result.errors[0]
+        return [call.status for call in result.calls]
+    return run
+
+
+def rm(client, args):
+    if not args:
+        raise UsageError('rm PATH...')
+    result = client.remove_many(args)
+    if not result.ok:
+        raise result.errors[0]
+    return [call.status for call in result.calls]
+
+
+def wait(client, args):
+    if not args:
+        raise UsageError('wait UUID...')
+    return [f.result() for f in client.wait_for_tasks(args)]
+
+
+def sync(client, args):
+    plan = client.sync(*_args(args, 2, 'sync LOCAL REMOTE'))
+    errors = [str(r.error) for r in plan.results if not r.ok]
+    if errors:
+        raise APIError('; '.join(errors))
+    return {'uploads': len(plan.uploads), 'moves': len(plan.moves),
+            'deletes': len(plan.deletes), 'unchanged': plan.unchanged}
+
+
+COMMANDS = {
+    'get': _call('get'),
+    'put': _call('put'),
+    'post': _call('post'),
+    'delete': _call('delete'),
+    'upload': upload,
+    'download': download,
+    'ls': ls,
+    'mv': _transfer('move'),
+    'cp': _transfer('copy'),
+    'rm': rm,
+    'wait': wait,
+    'sync': sync,
+}
+
+
+def run(client, args):
+    "Runs one command, given as a list of arguments. Returns its result."
+    if not args or args[0] not in COMMANDS:
+        raise UsageError('Unknown command: %s' % ' '.join(args[:1]))
+    return COMMANDS[args[0]](client, list(args[1:]))
+
+
+def run_batch(client, lines, out, jobs=1):
+    """Runs a command per line of lines, up to jobs at a time, writing a line
+    of JSON for each to out. Each result is written as soon as it and those
+    before it are done, so a process feeding commands one at a time gets
+    its answers as it goes. Returns the number of commands that failed."""
+    def execute(number, line):
+        try:
+            result = run(client, shlex.split(line))
+            if hasattr(result, 'read'):
+                raise UsageError('Use download to fetch files in batch mode.')
+        except Exception, e:
+            return {'line': number, 'error': str(e) or repr(e)}
+        return {'line': number, 'result': result}
+
+    # Futures in input order, bounded so that reading waits for the writer.
+    done = Queue.Queue(jobs * 2)
+    failed = [0]
+
+    def write():
+        while True:
+            future = done.get()
+            if future is None:
+                return
+            outcome = future.result()
+            failed[0] += 'error' in outcome
+            out.write(json.dumps(outcome) + '\n')
+            out.flush()
+    writer = threading.Thread(target=write)
+    writer.start()
+    try:
+        with WorkerPool(jobs) as pool:
+            for number, line in enumerate(lines, 1):
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    done.put(pool.submit(execute, number, line))
+    finally:
+        done.put(None)
+        writer.join()
+    return failed[0]
+
+
+def get_client(options):
+    kwargs = {'pool_size': max(options.jobs, 1)}
+    if options.url:
+        kwargs['url'] = options.url
+    if options.oauth:
+        return OAuthClient(**kwargs)
+    return BasicClient(options.key, options.password, **kwargs)
+
+
+def main(argv=None):
+    parser = OptionParser(usage=__doc__.strip())
+    parser.disable_interspersed_args()
+    parser.add_option('--url', help='the API URL')
+    parser.add_option('--key', help='API key')
+    parser.add_option('--password', help='API password')
+    parser.add_option('--oauth', action='store_true',
+                      help='use OAuth tokens from the environment')
+    parser.add_option('-j', '--jobs', type='int', default=4,
+                      help='commands to run at once in batch mode [%default]')
+    options, args = parser.parse_args(argv)
+    if not args:
+        parser.error('No command given.')
+    try:
+        with get_client(options) as client:
+            if args == ['batch']:
+                # Not "for line in sys.stdin", which reads ahead.
+                lines = iter(sys.stdin.readline, '')
+                return run_batch(client, lines, sys.stdout,
+                                 options.jobs) and 1 or 0
+            result = run(client, args)
+            if hasattr(result, 'read'):
+                shutil.copyfileobj(result, sys.stdout)
+            else:
+                json.dump(result, sys.stdout, indent=2)
+                sys.stdout.write('\n')
+    except UsageError, e:
+        parser.error(str(e))
+    except (APIError, NotImplementedError), e:
+        sys.stderr.write('smartfile: %s\n' % e)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,61 @@
+def normalize(path):
+    "Collapses repeated slashes, as the URL builder always has."
+    while '//' in path:
+        path = path.replace('//', '/')
+    return path
+
+
+class Endpoint(object):
+    """A reusable handle for one API endpoint, returned by Client.endpoint().
+    Its URL is built once, and again only if the client's url or version
+    change, so calls made through it only append the id. GET requests go
+    straight to the session, skipping the search for files in the call's
+    data."""
+    def __init__(self, client, endpoint):
+        self.client = client
+        self.endpoint = endpoint
+        self._prefix = (None, None)
+
+    def __repr__(self):
+        return '<Endpoint %s>' % self.url
+
+    @property
+    def url(self):
+        client = self.client
+        key = (client.url, client.version)
+        built, url = self._prefix
+        if built != key:
+            path = normalize('/'.join(['api', client.version, self.endpoint]) +
+                             '/')
+            url = client.url + path
+            self._prefix = (key, url)
+        return url
+
+    def url_for(self, id=None):
+        "Returns the URL of the object with the given id."
+        url = self.url
+        if not id:
+            return url
+        path = normalize(str(id)).strip('/')
+        if not path:
+            return url
+        return url + path + '/'
+
+    def __call__(self, id=None, **kwargs):
+        return self.get(id, **kwargs)
+
+    def get(self, id=None, **kwargs):
+        client = self.client
+        if client.cache is not None or client.single_flight is not None or \
+                kwargs.get('stream_items'):
+            return self.client.get(self.endpoint, id, **kwargs)
+        return self.client._get(self.url_for(id), kwargs)
+
+    def put(self, id=None, **kwargs):
+        return self.client.put(self.endpoint, id, **kwargs)
+
+    def post(self, id=None, **kwargs):
+        return self.client.post(self.endpoint, id, **kwargs)
+
+    def delete(self, id=None, **kwargs):
+        return self.client.delete(self.endpoint, id, **kwargs)
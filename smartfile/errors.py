@@ -37,3 +37,14 @@ class ResponseError(APIError):
 
     def __str__(self):
         return 'Response {0}: {1}'.format(self.status_code, self.detail)
+
+
+class TaskError(APIError):
+    """ Exception for tasks that failed, or did not finish in time. """
+    def __init__(self, task, detail, *args, **kwargs):
+        self.task = task
+        self.detail = detail
+        super(TaskError, self).__init__(*args, **kwargs)
+
+    def __str__(self):
+        return 'Task {0}: {1}'.format(self.task.get('uuid'), self.detail)
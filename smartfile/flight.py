@@ -0,0 +1,107 @@
+import sys
+import threading
+
+from requests.models import RequestEncodingMixin
+
+from smartfile.pool import Future
+
+
+def request_key(client, method, endpoint, id, params):
+    "Returns the key of an API call, its method, URL and sorted parameters."
+    url = client.endpoint(endpoint).url_for(id)
+    query = RequestEncodingMixin._encode_params(sorted(params.items()))
+    return '%s %s?%s' % (method.upper(), url, query)
+
+
+def _copy(source, target):
+    "Resolves the target future as the source future was resolved."
+    if source._exc_info is not None:
+        target.set_exception(source._exc_info)
+    else:
+        target.set_result(source._result)
+
+
+class SingleFlight(object):
+    """Coalesces identical calls that are in flight at the same time: the
+    first caller makes the call, and callers that ask for the same key
+    before it finishes wait for it and share its result, or its error.
+    Nothing is kept once a call finishes; see cache.ResponseCache for that.
+
+    Shared results are the same object for every caller, and should not be
+    modified. Files are not shared, as a stream can only be read once:
+    callers that joined a call which returned one make their own.
+
+    do() is for blocking calls and is thread-safe. do_async() is for calls
+    that return a pool.Future, as AsyncClient's do. Share a SingleFlight
+    only between clients with the same credentials."""
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._calls)
+
+    def _join(self, key):
+        """Returns (future, leader), where leader is True if the caller
+        should make the call and resolve the future."""
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                self.shared += 1
+                return future, False
+            future = self._calls[key] = Future()
+            return future, True
+
+    def _leave(self, key):
+        with self._lock:
+            del self._calls[key]
+
+    def do(self, key, fn, *args, **kwargs):
+        "Returns fn(*args, **kwargs), or the result of the same call in flight."
+        future, leader = self._join(key)
+        if not leader:
+            result = future.result()
+            if hasattr(result, 'read'):
+                return fn(*args, **kwargs)
+            return result
+        try:
+            result = fn(*args, **kwargs)
+        except:
+            exc_info = sys.exc_info()
+            self._leave(key)
+            future.set_exception(exc_info)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self._leave(key)
+        future.set_result(result)
+        return result
+
+    def do_async(self, key, fn, *args, **kwargs):
+        """Returns the Future returned by fn(*args, **kwargs), or a Future
+        of the result of the same call in flight."""
+        shared, leader = self._join(key)
+        if not leader:
+            future = Future()
+
+            def relay(f):
+                if f.exception() is None and hasattr(f.result(), 'read'):
+                    try:
+                        f = fn(*args, **kwargs)
+                    except:
+                        future.set_exception(sys.exc_info())
+                        return
+                f.add_done_callback(lambda f: _copy(f, future))
+            shared.add_done_callback(relay)
+            return future
+
+        def finish(f):
+            self._leave(key)
+            _copy(f, shared)
+        try:
+            future = fn(*args, **kwargs)
+        except:
+            self._leave(key)
+            shared.set_exception(sys.exc_info())
+            raise
+        future.add_done_callback(finish)
+        return future
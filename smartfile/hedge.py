@@ -0,0 +1,112 @@
+import sys
+import time
+import Queue
+import threading
+
+from smartfile.metrics import endpoint_key
+from smartfile.metrics import Histogram
+from smartfile.pool import WorkerPool
+from smartfile.retry import RetryBudget
+
+
+class Hedge(object):
+    """Hedges GET requests: if a request has not been answered after about
+    the percentile-th percentile of its endpoint's recent latency, a second
+    copy is sent, and whichever answers first is used. The other is closed
+    when it finishes. This cuts the tail latency that a stalled connection
+    adds, for little extra load.
+
+    Until an endpoint has min_samples latencies, initial seconds are used,
+    and never less than min_delay. Latencies are forgotten every window
+    samples so that the delay follows the API. budget, a RetryBudget, caps
+    hedges at a fraction of requests (10% by default). Hedges run on a pool
+    of up to workers threads, so a Hedge may be shared by clients. Each
+    first copy runs on a thread of its own, so that requests never queue
+    behind each other for the pool."""
+    def __init__(self, percentile=95, initial=1.0, min_delay=0.01,
+                 min_samples=20, window=1000, budget=None, workers=32):
+        self.percentile = percentile
+        self.initial = initial
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.window = window
+        self.budget = budget or RetryBudget(ratio=0.1, capacity=10)
+        self.pool = WorkerPool(workers)
+        self._latency = {}
+        self._lock = threading.Lock()
+
+    def delay(self, key):
+        "Returns the seconds to wait before hedging a request to key."
+        with self._lock:
+            histogram = self._latency.get(key)
+            if histogram is None or histogram.count < self.min_samples:
+                return self.initial
+            return max(histogram.percentile(self.percentile), self.min_delay)
+
+    def record(self, key, elapsed):
+        with self._lock:
+            histogram = self._latency.get(key)
+            if histogram is None or histogram.count >= self.window:
+                histogram = self._latency[key] = Histogram()
+            histogram.record(elapsed)
+
+    def request(self, client, request, url, kwargs):
+        """Makes a request through client._do_request(), hedging it if it
+        is slow. Returns the first response, or raises the error of the last
+        request to fail."""
+        key = endpoint_key(client, url)
+        self.budget.deposit()
+        answers = Queue.Queue()
+        lock = threading.Lock()
+        state = {'sent': 1, 'answered': False}
+
+        def attempt(start):
+            try:
+                response = client._do_request(request, url, **kwargs)
+                if response.headers.get('content-type') == \
+                        'application/json':
+                    # Race the whole of a metadata response, not just its
+                    # headers.
+                    response.content
+            except:
+                answers.put((None, sys.exc_info()))
+                return
+            with lock:
+                first = not state['answered']
+                state['answered'] = True
+            if first:
+                self.record(key, time.time() - start)
+                answers.put((response, None))
+            else:
+                response.close()
+
+        def hedge():
+            with lock:
+                if state['answered'] or not self.budget.withdraw():
+                    return
+                state['sent'] += 1
+            if client._hooks:
+                client._fire('hedge', url=url, delay=delay)
+            attempt(time.time())
+
+        delay = self.delay(key)
+        # The caller waits for whichever copy answers first, so the first
+        # copy cannot run on the calling thread.
+        first = threading.Thread(target=attempt, args=(time.time(),))
+        first.daemon = True
+        first.start()
+        self.pool.submit_after(delay, hedge)
+        failures = 0
+        while True:
+            response, exc_info = answers.get()
+            if response is not None:
+                return response
+            failures += 1
+            with lock:
+                if failures >= state['sent']:
+                    # Stop a hedge that has not been sent yet.
+                    state['answered'] = True
+                    raise exc_info[0], exc_info[1], exc_info[2]
+
+    def close(self):
+        self.pool.shutdown(wait=False)
@@ -0,0 +1,180 @@
+import math
+import threading
+
+# Histogram buckets grow by this factor, so percentiles are within ~10%.
+BUCKET_FACTOR = 1.2
+BUCKET_MIN = 0.0001
+
+
+def endpoint_key(client, url):
+    """Returns the endpoint a URL belongs to, e.g. path/info or
+    path/oper/move, without the path or id that follows it."""
+    parts = url[len(client.url):].split('?')[0].strip('/').split('/')[2:]
+    if parts and parts[0] == 'path':
+        count = len(parts) > 1 and parts[1] == 'oper' and 3 or 2
+        return '/'.join(parts[:count])
+    return '/'.join(parts[:1])
+
+
+class Histogram(object):
+    """Counts values in logarithmic buckets, in constant space. Percentiles
+    are approximate, reported as the upper bound of their bucket."""
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        if value <= BUCKET_MIN:
+            bucket = 0
+        else:
+            bucket = int(math.ceil(math.log(value / BUCKET_MIN, BUCKET_FACTOR)))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        "Adds the values recorded by another histogram to this one."
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self):
+        return self.count and self.total / self.count or 0.0
+
+    def percentile(self, p):
+        "Returns the value below which p percent of the values fall."
+        if not self.count:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(BUCKET_MIN * BUCKET_FACTOR ** bucket, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.mean,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+        }
+
+
+class EndpointStats(object):
+    __slots__ = ('requests', 'errors', 'retries', 'throttles', 'throttle_wait',
+                 'bytes_sent', 'bytes_received', 'latency', 'ttfb')
+
+    def __init__(self):
+        self.requests = self.errors = self.retries = self.throttles = 0
+        self.throttle_wait = 0.0
+        self.bytes_sent = self.bytes_received = 0
+        self.latency = Histogram()
+        self.ttfb = Histogram()
+
+    def merge(self, other):
+        for name in self.__slots__:
+            value = getattr(other, name)
+            if isinstance(value, Histogram):
+                getattr(self, name).merge(value)
+            else:
+                setattr(self, name, getattr(self, name) + value)
+
+    def snapshot(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'retries': self.retries,
+            'throttles': self.throttles,
+            'throttle_wait': self.throttle_wait,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+            'latency': self.latency.snapshot(),
+            'ttfb': self.ttfb.snapshot(),
+        }
+
+
+class MetricsCollector(object):
+    """Collects per-endpoint request counts, errors, retries, throttling,
+    bytes and latency histograms from the hooks of one or more clients.
+
+    Latency is the time until the response headers were received, the body
+    of a streamed response is not included. ttfb is the same, as measured by
+    requests, without the time spent signing and queueing the request. Byte
+    counts are taken from Content-Length headers, so chunked bodies are not
+    counted."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def install(self, client):
+        "Registers the collector's hooks on client, returns the client."
+        for event in ('response', 'error', 'retry', 'throttle'):
+            client.on(event, getattr(self, '_on_' + event))
+        return client
+
+    def _get(self, info):
+        key = endpoint_key(info['client'], info['url'])
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = EndpointStats()
+        return stats
+
+    def _on_response(self, info):
+        response = info['response']
+        sent = response.request.headers.get('Content-Length')
+        received = response.headers.get('Content-Length')
+        with self._lock:
+            stats = self._get(info)
+            stats.requests += 1
+            stats.latency.record(info['elapsed'])
+            stats.ttfb.record(response.elapsed.total_seconds())
+            if sent:
+                stats.bytes_sent += int(sent)
+            if received:
+                stats.bytes_received += int(received)
+
+    def _on_error(self, info):
+        with self._lock:
+            stats = self._get(info)
+            stats.errors += 1
+            if getattr(info['error'], 'response', None) is None:
+                # No response, so _on_response did not count it.
+                stats.requests += 1
+                stats.latency.record(info['elapsed'])
+
+    def _on_retry(self, info):
+        with self._lock:
+            self._get(info).retries += 1
+
+    def _on_throttle(self, info):
+        with self._lock:
+            stats = self._get(info)
+            stats.throttles += 1
+            stats.throttle_wait += info['delay']
+
+    def snapshot(self):
+        "Returns the collected metrics as {endpoint: {name: value}}."
+        with self._lock:
+            return dict((k, s.snapshot()) for k, s in self._stats.items())
+
+    def totals(self):
+        "Returns the metrics of every endpoint combined, as {name: value}."
+        total = EndpointStats()
+        with self._lock:
+            for stats in self._stats.values():
+                total.merge(stats)
+        return total.snapshot()
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
@@ -0,0 +1,150 @@
+import os
+import uuid
+
+CRLF = '\r\n'
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _remaining(f):
+    "Returns the number of bytes left to read from f, or None if unknown."
+    try:
+        return os.fstat(f.fileno()).st_size - f.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        pass
+    try:
+        pos = f.tell()
+        f.seek(0, 2)
+        end = f.tell()
+        f.seek(pos)
+        return end - pos
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+
+
+class MultipartStream(object):
+    """A multipart/form-data body that is produced chunk_size bytes at a time
+    as it is read, rather than built in memory. Files may be file-like
+    objects, iterators of strings, or (filename, file[, content_type])
+    tuples of either.
+
+    When the size of every file is known, the body's length is exposed as
+    ``len`` and it is sent with a Content-Length, otherwise requests sends it
+    using chunked transfer encoding.
+
+    If every file can seek, rewind() restarts the body, so that a failed
+    request can be retried. filenames lists the names the files are sent
+    as."""
+    def __init__(self, fields, files, chunk_size=65536):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = 'multipart/form-data; boundary=%s' % self.boundary
+        self.chunk_size = chunk_size
+        self._parts = []
+        self.filenames = []
+        for name, value in fields.items():
+            if not isinstance(value, (list, tuple)):
+                value = [value]
+            for v in value:
+                self._add(name, None, None, _encode(v))
+        for name, value in files.items():
+            if isinstance(value, tuple):
+                filename, source = value[:2]
+                content_type = len(value) > 2 and value[2] or None
+            else:
+                filename, source, content_type = None, value, None
+            if filename is None:
+                filename = os.path.basename(getattr(source, 'name', '') or name)
+            self.filenames.append(filename)
+            self._add(name, filename, content_type, source)
+        self._tail = '--%s--%s' % (self.boundary, CRLF)
+        self.len = self._length()
+        self._starts = [self._tell(part[1]) for part in self._parts]
+        self._chunks = self._generate()
+        self._buffer = ''
+
+    def _tell(self, source):
+        if isinstance(source, str):
+            return 0
+        try:
+            return source.tell()
+        except (AttributeError, IOError, OSError, ValueError):
+            return None
+
+    def rewind(self):
+        "Restarts the body from the beginning, returns False if it cannot."
+        if None in self._starts:
+            return False
+        for (header, source), start in zip(self._parts, self._starts):
+            if not isinstance(source, str):
+                source.seek(start)
+        self._chunks = self._generate()
+        self._buffer = ''
+        return True
+
+    def _add(self, name, filename, content_type, source):
+        header = ['--%s' % self.boundary]
+        disposition = 'Content-Disposition: form-data; name="%s"' % _encode(name)
+        if filename is not None:
+            disposition += '; filename="%s"' % _encode(filename)
+            content_type = content_type or 'application/octet-stream'
+        header.append(disposition)
+        if content_type:
+            header.append('Content-Type: %s' % content_type)
+        self._parts.append((CRLF.join(header) + CRLF * 2, source))
+
+    def _length(self):
+        length = len(self._tail)
+        for header, source in self._parts:
+            if isinstance(source, str):
+                size = len(source)
+            elif hasattr(source, 'read'):
+                size = _remaining(source)
+            else:
+                size = None
+            if size is None:
+                return None
+            length += len(header) + size + len(CRLF)
+        return length
+
+    def _generate(self):
+        for header, source in self._parts:
+            yield header
+            if isinstance(source, str):
+                yield source
+            elif hasattr(source, 'read'):
+                while True:
+                    chunk = source.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+            else:
+                for chunk in source:
+                    if chunk:
+                        yield chunk
+            yield CRLF
+        yield self._tail
+
+    def read(self, size=-1):
+        "Returns up to size bytes of the body, or all of it if size < 0."
+        if size is None or size < 0:
+            chunks, self._buffer = [self._buffer], ''
+            chunks.extend(self._chunks)
+            return ''.join(chunks)
+        while len(self._buffer) < size:
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                break
+        chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
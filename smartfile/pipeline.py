@@ -0,0 +1,283 @@
+import os
+import sys
+import zlib
+import Queue
+import hashlib
+import posixpath
+import threading
+import multiprocessing
+
+from smartfile.errors import APIError
+from smartfile.pool import Future
+from smartfile.pool import WorkerPool
+from smartfile.transfer import TransferResult
+from smartfile.transfer import _resolve
+from smartfile.transfer import ranged_uploads
+
+# Set in each process of the pool by _init().
+_buffer = None
+_slot_size = None
+
+
+def _init(buffer, slot_size):
+    global _buffer, _slot_size
+    _buffer, _slot_size = buffer, slot_size
+
+
+def _put(view, pos, data):
+    "Writes data into view at pos, returns the position after it."
+    if pos + len(data) > len(view):
+        raise APIError('Compressed part does not fit in its slot.')
+    view[pos:pos + len(data)] = data
+    return pos + len(data)
+
+
+def _prepare(path, start, length, slot, level, algorithm, chunk_size):
+    """Runs in a pool process: reads length bytes of the file at path from
+    start into a slot of the shared buffer, gzipped at level unless it is
+    None. Returns the bytes in the slot and the hex digest of the data."""
+    view = memoryview(_buffer)[slot * _slot_size:(slot + 1) * _slot_size]
+    digest = hashlib.new(algorithm)
+    pos = 0
+    with open(path, 'rb') as f:
+        f.seek(start)
+        if level is None:
+            while pos < length:
+                read = f.readinto(view[pos:length])
+                if not read:
+                    break
+                pos += read
+            digest.update(view[:pos])
+            if pos < length:
+                raise APIError('%s changed while it was being uploaded.' % path)
+            return pos, digest.hexdigest()
+        gz = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        while length > 0:
+            chunk = f.read(min(chunk_size, length))
+            if not chunk:
+                raise APIError('%s changed while it was being uploaded.' % path)
+            length -= len(chunk)
+            digest.update(chunk)
+            pos = _put(view, pos, gz.compress(chunk))
+        pos = _put(view, pos, gz.flush())
+        return pos, digest.hexdigest()
+
+
+class SlotFile(object):
+    """A read-only file over length bytes of a shared buffer, from offset.
+    Reads are slices, so threads can read different slots at once."""
+    def __init__(self, buffer, offset, length):
+        self.buffer = buffer
+        self.offset = offset
+        self.length = length
+        self._pos = 0
+
+    def read(self, size=-1):
+        left = self.length - self._pos
+        if size is None or size < 0 or size > left:
+            size = left
+        start = self.offset + self._pos
+        self._pos += size
+        return self.buffer[start:start + size]
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self._pos
+        elif whence == 2:
+            pos += self.length
+        self._pos = pos
+
+
+class _Upload(object):
+    "The state of one file going through the pipeline."
+    def __init__(self, local, remote, name, size, parts):
+        self.local = local
+        self.remote = remote
+        self.dirname = posixpath.dirname(remote)
+        self.name = name
+        self.size = size
+        self.parts = parts
+        # The prepared length of each part, as a Future.
+        self.lengths = []
+        self.digests = [None] * parts
+        self.sent = 0
+        self.error = None
+        self.future = Future()
+        self._left = parts
+        self._lock = threading.Lock()
+
+    def failed(self, error):
+        with self._lock:
+            if self.error is None:
+                self.error = error
+
+    def finished(self, parts=1, sent=0):
+        with self._lock:
+            self.sent += sent
+            self._left -= parts
+            if self._left:
+                return
+        if self.error is not None:
+            result = TransferResult(self.local, self.remote, error=self.error)
+        else:
+            result = TransferResult(self.local, self.remote, result={
+                'path': posixpath.join(self.dirname, self.name),
+                'size': self.size, 'sent': self.sent,
+                'digests': self.digests})
+        self.future.set_result(result)
+
+
+class ProcessPipeline(object):
+    """Uploads many files, running the CPU-bound stages in a pool of
+    processes and the network stage on a pool of threads, so that hashing
+    and compression scale with the number of cores.
+
+    Each file is cut into parts of part_size bytes. A process reads a part
+    into a slot of a buffer shared with the processes, hashes it with
+    checksum (a hashlib algorithm name) and, with compress, gzips it in
+    place. A thread then uploads the slot, as the whole file or as one part
+    of a chunked upload (see transfer.ChunkedUpload), and frees it. Data is
+    never pickled between the stages, and memory use is bounded by slots.
+
+    Compressed files are uploaded with .gz appended to their names, each
+    part a gzip member of its own. As the size of a compressed file is only
+    known once it has been compressed, parts before the last are sent with
+    a Content-Range of unknown length, ``bytes <first>-<last>/*``.
+
+    Assembling parts by Content-Range is not part of the documented API.
+    Before the first file larger than a part is uploaded, ranged_uploads()
+    checks that the server supports it; if not, such files fail with
+    APIError without being sent, rather than each part overwriting the
+    last. Files no larger than a part are sent whole either way.
+
+    Processes are forked when the pipeline is created, and close() stops
+    them; the pipeline can be used as a context manager."""
+    chunk_size = 1048576
+
+    def __init__(self, client, processes=None, threads=None, slots=None,
+                 part_size=8388608, compress=False, compress_level=6,
+                 checksum='md5'):
+        self.client = client
+        self.part_size = part_size
+        self.level = compress and compress_level or None
+        self.checksum = checksum
+        hashlib.new(checksum)
+        processes = processes or multiprocessing.cpu_count()
+        threads = threads or client.pool_size
+        slots = slots or processes + threads
+        # Room for gzip's worst case, a little larger than its input.
+        self.slot_size = part_size + part_size // 100 + 1024
+        self._buffer = multiprocessing.RawArray('c', slots * self.slot_size)
+        self._free = Queue.Queue()
+        for slot in range(slots):
+            self._free.put(slot)
+        self._processes = multiprocessing.Pool(
+            processes, _init, (self._buffer, self.slot_size))
+        self._threads = WorkerPool(threads)
+        self._ranged = None
+        self._probe_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        "Stops the processes and threads once queued work is done."
+        self._processes.close()
+        self._processes.join()
+        self._threads.shutdown()
+
+    def upload_many(self, pairs):
+        """Uploads (local, remote) pairs, where a remote path ending in / is
+        a directory, and the file keeps its local name. Returns a
+        TransferResult for each pair, in order, whose result has the remote
+        path, the size of the file, the bytes sent and the digest of each
+        part."""
+        return [f.result() for f in
+                [self.upload(local, remote) for local, remote in pairs]]
+
+    def upload(self, local, remote):
+        """Starts uploading the local file, returns a Future of its
+        TransferResult. Blocks while every slot is in use."""
+        name = posixpath.basename(remote) or os.path.basename(local)
+        if self.level is not None:
+            name += '.gz'
+        try:
+            size = os.path.getsize(local)
+            parts = max(1, (size + self.part_size - 1) // self.part_size)
+            if parts > 1 and not self._ranged_uploads(remote):
+                raise APIError('The server does not assemble uploads sent in '
+                               'parts, and %s is larger than a part.' % local)
+        except (OSError, APIError), e:
+            future = Future()
+            future.set_result(TransferResult(local, remote, error=e))
+            return future
+        upload = _Upload(local, remote, name, size, parts)
+        for part in range(parts):
+            slot = self._free.get()
+            if upload.error is not None:
+                self._free.put(slot)
+                upload.finished(parts - part)
+                break
+            start = part * self.part_size
+            length = min(self.part_size, size - start)
+            prepared = self._processes.apply_async(_prepare, (
+                local, start, length, slot, self.level, self.checksum,
+                self.chunk_size))
+            upload.lengths.append(Future())
+            self._threads.submit(self._send, upload, part, slot, prepared)
+        return upload.future
+
+    def _ranged_uploads(self, remote):
+        "Returns whether the server assembles parts, probing it once."
+        with self._probe_lock:
+            if self._ranged is None:
+                self._ranged = ranged_uploads(self.client,
+                                              posixpath.dirname(remote))
+            return self._ranged
+
+    def _send(self, upload, part, slot, prepared):
+        "Uploads a part once it is prepared, in a thread."
+        sent = 0
+        try:
+            # Only this thread waits on prepared, as an AsyncResult wakes
+            # one waiter. The parts after it wait on its length instead.
+            try:
+                length, digest = prepared.get()
+            except Exception:
+                upload.lengths[part].set_exception(sys.exc_info())
+                raise
+            upload.lengths[part].set_result(length)
+            if upload.error is None:
+                offset = sum(f.result() for f in upload.lengths[:part])
+                self._post(upload, part, slot, offset, length)
+                upload.digests[part] = digest
+                sent = length
+        except Exception:
+            upload.failed(sys.exc_info()[1])
+        finally:
+            self._free.put(slot)
+            upload.finished(sent=sent)
+
+    def _post(self, upload, part, slot, offset, length):
+        headers = {}
+        if upload.parts > 1:
+            if self.level is None:
+                total = upload.size
+            elif part == upload.parts - 1:
+                total = offset + length
+            else:
+                total = '*'
+            headers['Content-Range'] = 'bytes %s-%s/%s' % (
+                offset, offset + length - 1, total)
+        body = SlotFile(self._buffer, slot * self.slot_size, length)
+        content_type = self.level is not None and 'application/gzip' or \
+            'application/octet-stream'
+        _resolve(self.client._request(
+            'post', '/path/data', id=upload.dirname, headers=headers,
+            data={'file': (upload.name, body, content_type)}))
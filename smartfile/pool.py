@@ -0,0 +1,177 @@
+import sys
+import time
+import heapq
+import Queue
+import threading
+
+from smartfile.errors import RequestError
+
+
+class Future(object):
+    "The eventual result of a call, set by whoever performs the call."
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done.is_set()
+
+    def _wait(self, timeout):
+        self._done.wait(timeout)
+        if not self._done.is_set():
+            raise RequestError('Timed out after %s seconds.' % timeout)
+
+    def result(self, timeout=None):
+        "Waits for and returns the result, re-raising any exception."
+        self._wait(timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        "Waits for and returns the exception raised by the call, if any."
+        self._wait(timeout)
+        if self._exc_info is not None:
+            return self._exc_info[1]
+
+    def add_done_callback(self, fn):
+        """Calls fn with this future once it is done, immediately if it is
+        already."""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                pass
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc_info):
+        "Accepts either an exception instance or a sys.exc_info() tuple."
+        if not isinstance(exc_info, tuple):
+            exc_info = (type(exc_info), exc_info, None)
+        self._exc_info = exc_info
+        self._finish()
+
+
+class WorkerPool(object):
+    """A bounded pool of daemon threads that run submitted calls. Threads are
+    started as work arrives, up to size. Delayed calls are held by a single
+    timer thread instead of occupying a worker while they wait."""
+    def __init__(self, size=8):
+        self.size = size
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._timers = []
+        self._timer_cond = threading.Condition(self._lock)
+        self._timer_thread = None
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+    def _start(self, target):
+        thread = threading.Thread(target=target)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            future, fn, args, kwargs = item
+            try:
+                result = fn(*args, **kwargs)
+            except:
+                future.set_exception(sys.exc_info())
+            else:
+                future.set_result(result)
+
+    def _run_timers(self):
+        with self._lock:
+            while not self._closed:
+                if not self._timers:
+                    self._timer_cond.wait()
+                    continue
+                delay = self._timers[0][0] - time.time()
+                if delay > 0:
+                    self._timer_cond.wait(delay)
+                    continue
+                item = heapq.heappop(self._timers)[2]
+                self._queue.put(item)
+
+    def submit(self, fn, *args, **kwargs):
+        "Schedules fn(*args, **kwargs) to run, returns a Future."
+        return self.submit_after(0, fn, *args, **kwargs)
+
+    def submit_after(self, delay, fn, *args, **kwargs):
+        """Schedules fn(*args, **kwargs) to run once delay seconds have
+        passed, returns a Future."""
+        future = Future()
+        item = (future, fn, args, kwargs)
+        with self._lock:
+            if self._closed:
+                raise RequestError('Worker pool is shut down.')
+            if len(self._threads) < self.size:
+                self._threads.append(self._start(self._work))
+            if delay > 0:
+                if self._timer_thread is None:
+                    self._timer_thread = self._start(self._run_timers)
+                # The id() breaks ties without comparing the items.
+                heapq.heappush(self._timers, (time.time() + delay, id(item), item))
+                self._timer_cond.notify()
+            else:
+                self._queue.put(item)
+        return future
+
+    def map(self, fn, iterable, window=None):
+        """Runs fn over each item of iterable, yielding futures in order. At
+        most window calls (default twice the pool size) are outstanding, so
+        iterable is consumed lazily."""
+        window = window or self.size * 2
+        pending = []
+        for item in iterable:
+            pending.append(self.submit(fn, item))
+            if len(pending) >= window:
+                pending[0]._wait(None)
+                yield pending.pop(0)
+        for future in pending:
+            future._wait(None)
+            yield future
+
+    def shutdown(self, wait=True):
+        "Stops the worker threads once queued work has been completed."
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._timer_cond.notify()
+            threads = list(self._threads)
+            timers, self._timers = self._timers, []
+        for timer in timers:
+            timer[2][0].set_exception(RequestError('Worker pool is shut down.'))
+        for thread in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
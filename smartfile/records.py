@@ -0,0 +1,121 @@
+import datetime
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+# The fields of a /path/info entry that records keep in slots.
+FIELDS = ('acl', 'attributes', 'extension', 'id', 'isdir', 'mime', 'name',
+          'path', 'size', 'tags', 'time', 'url')
+
+# Values shared between records, by key. Mime types, extensions and acls
+# repeat across entries, so these stay small; once a table holds
+# max_shared values, new ones are no longer shared.
+max_shared = 4096
+_strings = {}
+_acls = {}
+
+
+def share(table, key, value):
+    """Returns the value held in table for key, adding value if there is
+    room. Values whose key cannot be hashed are not shared."""
+    try:
+        shared = table.get(key)
+    except TypeError:
+        return value
+    if shared is not None:
+        return shared
+    if len(table) < max_shared:
+        return table.setdefault(key, value)
+    return value
+
+
+class PathInfo(object):
+    """A /path/info entry held in slots, rather than a dict. The mime type
+    and extension strings, and the acl dict, are shared between records
+    with the same values, and should not be modified.
+
+    Fields are attributes, None if the API left them out. time is parsed
+    into a datetime when it is first read; time_string is the value the API
+    returned. Other values, such as the children and pages of a listing,
+    are kept in the extra dict.
+
+    Records can also be read as the dicts they replace, with [], get(), in
+    and keys(), which only see the fields the API returned, and where
+    'time' is the string. to_dict() returns a copy."""
+    __slots__ = ('acl', 'attributes', 'extension', 'id', 'isdir', 'mime',
+                 'name', 'path', 'size', 'tags', 'time_string', '_time', 'url',
+                 'extra')
+
+    def __init__(self, d):
+        d = dict(d)
+        for key in FIELDS:
+            if key not in d:
+                continue
+            value = d.pop(key)
+            if key == 'acl' and isinstance(value, dict):
+                value = share(_acls, tuple(sorted(value.items())), value)
+            elif key in ('extension', 'mime') and value is not None:
+                value = share(_strings, value, value)
+            elif key == 'time':
+                key = 'time_string'
+            setattr(self, key, value)
+        self._time = None
+        self.extra = d or None
+
+    def __getattr__(self, name):
+        # Only called for fields the API left out, whose slots are unset.
+        if name in FIELDS or name == 'time_string':
+            return None
+        raise AttributeError(name)
+
+    def __repr__(self):
+        return '<PathInfo %s>' % self.path
+
+    @property
+    def time(self):
+        if self._time is None and self.time_string:
+            self._time = datetime.datetime.strptime(self.time_string[:19],
+                                                    TIME_FORMAT)
+        return self._time
+
+    def keys(self):
+        return [k for k in FIELDS if k in self] + \
+            (self.extra and self.extra.keys() or [])
+
+    def __getitem__(self, key):
+        if key in FIELDS:
+            if key not in self:
+                raise KeyError(key)
+            if key == 'time':
+                return self.time_string
+            return getattr(self, key)
+        if self.extra is None or key not in self.extra:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __contains__(self, key):
+        if key in FIELDS:
+            try:
+                # Bypasses __getattr__, to tell unset slots from None.
+                object.__getattribute__(self, key == 'time' and
+                                        'time_string' or key)
+            except AttributeError:
+                return False
+            return True
+        return self.extra is not None and key in self.extra
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self):
+        return dict((k, self[k]) for k in self.keys())
+
+
+def object_hook(d):
+    """A JSON object_hook that decodes /path/info entries, objects with a
+    path and isdir, into PathInfo records."""
+    if 'path' in d and 'isdir' in d:
+        return PathInfo(d)
+    return d
@@ -0,0 +1,134 @@
+import random
+import threading
+
+from requests.exceptions import ChunkedEncodingError
+from requests.exceptions import ConnectionError
+from requests.exceptions import ConnectTimeout
+from requests.exceptions import Timeout
+
+from smartfile.errors import ResponseError
+
+# Methods that can be repeated without changing the result.
+IDEMPOTENT = frozenset(['GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'])
+# Responses of overloaded or restarting servers and load balancers.
+TRANSIENT = frozenset([502, 503, 504])
+
+
+class RetryBudget(object):
+    """Caps retries at a fraction of requests, so that when the API is down,
+    retries cannot multiply the load on it. Each request earns ratio of a
+    retry, each retry spends one, and at most capacity are saved up. It
+    starts full, so a quiet client can still retry. Share one budget between
+    clients to cap them together."""
+    def __init__(self, ratio=0.2, capacity=10):
+        self.ratio = ratio
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        "Records a request."
+        with self._lock:
+            self._tokens = min(self._tokens + self.ratio, self.capacity)
+
+    def withdraw(self):
+        "Returns True if a retry may be made, and records it."
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+
+class RetryPolicy(object):
+    """Decides whether, and after how long, a failed request is retried.
+
+    A request is tried at most tries times. Throttled requests are retried
+    after the delay the API asks for. Otherwise, responses with a status in
+    statuses, and connection errors, timeouts and truncated JSON responses
+    are retried only for methods in methods, as the first try may have taken
+    effect. Connection timeouts, which never reached the API, are retried for
+    any method.
+
+    Retries back off exponentially from backoff seconds by factor, up to
+    max_backoff, with full jitter (a random delay up to that) so that many
+    clients do not retry in step. No retry is made that would end more than
+    max_elapsed seconds after the first try. Retries of failures, as opposed
+    to throttling, are also limited by budget, a RetryBudget."""
+    def __init__(self, tries=3, backoff=0.1, factor=2.0, max_backoff=10.0,
+                 jitter=True, max_elapsed=None, statuses=TRANSIENT,
+                 methods=IDEMPOTENT, budget=None):
+        self.tries = tries
+        self.backoff = backoff
+        self.factor = factor
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.max_elapsed = max_elapsed
+        self.statuses = statuses
+        self.methods = methods
+        self.budget = budget or RetryBudget()
+
+    def retryable(self, method, error):
+        "Returns True if a request that failed with error may be retried."
+        if isinstance(error, ResponseError):
+            return error.status_code in self.statuses and method in self.methods
+        exc = getattr(error, 'exc', None)
+        if isinstance(exc, ConnectTimeout):
+            return True
+        if isinstance(exc, (ConnectionError, Timeout, ChunkedEncodingError)):
+            return method in self.methods
+        return False
+
+    def backoff_delay(self, attempt):
+        "Returns the seconds to wait after the given (1 based) failed try."
+        delay = min(self.backoff * self.factor ** (attempt - 1),
+                    self.max_backoff)
+        if self.jitter:
+            delay = random.uniform(0, delay)
+        return delay
+
+    def started(self):
+        "Called once for each request, before its first try."
+        self.budget.deposit()
+
+    def delay(self, method, attempt, error, elapsed, throttle=None):
+        """Returns the seconds to wait before retrying a request that failed
+        with error on the given try, elapsed seconds after the first began,
+        or None if it should not be retried. throttle is the delay the API
+        asked for, if it throttled the request."""
+        if attempt >= self.tries:
+            return None
+        if throttle is not None:
+            delay = throttle
+        elif self.retryable(method, error):
+            delay = self.backoff_delay(attempt)
+        else:
+            return None
+        if self.max_elapsed is not None and elapsed + delay > self.max_elapsed:
+            return None
+        # Throttling is the API pacing us, not failing, and is not budgeted.
+        if throttle is None and not self.budget.withdraw():
+            return None
+        return delay
+
+
+def body_mark(body):
+    "Returns what rewind_body() needs to send body again."
+    if hasattr(body, 'tell') and hasattr(body, 'seek'):
+        try:
+            return body.tell()
+        except (IOError, OSError, ValueError):
+            pass
+
+
+def rewind_body(body, mark):
+    """Prepares a request body to be sent again. Returns False if it cannot
+    be, e.g. an iterator that has been consumed."""
+    if body is None or isinstance(body, (basestring, dict, list, tuple)):
+        return True
+    if hasattr(body, 'rewind'):
+        return body.rewind()
+    if mark is not None:
+        body.seek(mark)
+        return True
+    return False
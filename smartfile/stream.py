@@ -0,0 +1,97 @@
+import json
+import codecs
+
+WHITESPACE = ' \t\n\r'
+
+
+class ItemDecoder(object):
+    """Decodes a JSON document from an iterable of byte strings, yielding
+    the items of one array as soon as each has arrived. The array is either
+    the document itself, or the value of key in the top level object. Only
+    one item, plus what has been read past it, is held in memory at a time.
+    Other values of the top level object are decoded and discarded.
+    object_hook is passed on to json.JSONDecoder."""
+    def __init__(self, chunks, key='children', encoding='utf-8',
+                 object_hook=None):
+        self.chunks = iter(chunks)
+        self.key = key
+        self._decode = codecs.getincrementaldecoder(encoding)().decode
+        self._json = json.JSONDecoder(object_hook=object_hook)
+        self.buf = u''
+        self.pos = 0
+        self.eof = False
+
+    def _more(self):
+        "Reads another chunk onto the buffer, returns False at the end."
+        if self.eof:
+            return False
+        if self.pos:
+            self.buf, self.pos = self.buf[self.pos:], 0
+        try:
+            self.buf += self._decode(next(self.chunks))
+        except StopIteration:
+            self.buf += self._decode('', True)
+            self.eof = True
+        return True
+
+    def _peek(self):
+        "Skips whitespace, returns the next character."
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._more():
+                raise ValueError('Unexpected end of JSON document.')
+
+    def _expect(self, chars):
+        c = self._peek()
+        if c not in chars:
+            raise ValueError('Expected %r at %r' % (chars, c))
+        self.pos += 1
+        return c
+
+    def _value(self):
+        "Decodes the next complete value."
+        self._peek()
+        while True:
+            try:
+                value, end = self._json.raw_decode(self.buf, self.pos)
+            except ValueError:
+                if not self._more():
+                    raise
+                continue
+            # A number at the end of the buffer may continue in the next chunk.
+            if end < len(self.buf) or not self._more():
+                self.pos = end
+                return value
+
+    def _items(self):
+        "Yields the items of the array whose [ has just been read."
+        if self._peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self._value()
+            if self._expect(',]') == ']':
+                return
+
+    def __iter__(self):
+        c = self._expect('[{')
+        if c == '[':
+            for item in self._items():
+                yield item
+            return
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == self.key and self._peek() == '[':
+                self.pos += 1
+                for item in self._items():
+                    yield item
+            else:
+                self._value()
+            if self._expect(',}') == '}':
+                return
@@ -0,0 +1,276 @@
+import os
+import time
+import hashlib
+import sqlite3
+import calendar
+import posixpath
+import threading
+
+from smartfile import tree
+from smartfile.pool import WorkerPool
+from smartfile.transfer import TransferResult
+from smartfile.transfer import _resolve
+from smartfile.transfer import upload
+
+INDEX_NAME = '.smartfile-sync'
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def file_hash(path, chunk_size=65536):
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), ''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def remote_mtime(entry):
+    "Returns the modification time of a /path/info entry, in seconds."
+    try:
+        return calendar.timegm(time.strptime(entry['time'][:19], TIME_FORMAT))
+    except (KeyError, TypeError, ValueError):
+        return 0
+
+
+class SyncIndex(object):
+    """The size, mtime and (optionally) hash of each file as of its last
+    sync, kept in a sqlite database. Files whose size and mtime still match
+    are known to be unchanged without asking the API.
+
+    With readonly, the index is only read: a missing index is not created,
+    and one for a different remote directory reads as empty rather than
+    being cleared."""
+    def __init__(self, path, remote, readonly=False):
+        self._lock = threading.Lock()
+        self._db = None
+        self._files = {}
+        if readonly:
+            if os.path.exists(path):
+                db = sqlite3.connect(path, check_same_thread=False)
+                try:
+                    row = db.execute("SELECT value FROM meta WHERE key = "
+                                     "'remote'").fetchone()
+                    if row is not None and row[0] == remote:
+                        self._files = self._read(db)
+                except sqlite3.OperationalError:
+                    # No tables yet.
+                    pass
+                db.close()
+            return
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS meta '
+                         '(key TEXT PRIMARY KEY, value TEXT)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS files (path TEXT '
+                         'PRIMARY KEY, size INTEGER, mtime REAL, hash TEXT)')
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'remote'"
+                               ).fetchone()
+        if row is None or row[0] != remote:
+            # The index describes a different remote directory.
+            self._db.execute('DELETE FROM files')
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES ('remote', ?)",
+                             (remote, ))
+        self._db.commit()
+
+    def _read(self, db):
+        rows = db.execute('SELECT * FROM files').fetchall()
+        return dict((r[0], r[1:]) for r in rows)
+
+    def files(self):
+        "Returns {path: (size, mtime, hash)} for every indexed file."
+        if self._db is None:
+            return dict(self._files)
+        with self._lock:
+            return self._read(self._db)
+
+    def put(self, path, size, mtime, hash=None):
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                             (path, size, mtime, hash))
+            self._db.commit()
+
+    def remove(self, path):
+        with self._lock:
+            self._db.execute('DELETE FROM files WHERE path = ?', (path, ))
+            self._db.commit()
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+
+
+class SyncPlan(object):
+    """The actions needed to bring a remote directory up to date. Paths in
+    uploads are (local, remote) pairs, moves are (remote, remote) pairs and
+    deletes are remote paths. After the plan is run, results holds a
+    TransferResult for each action.
+
+    versions holds the (size, mtime, hash) of each file to upload or move,
+    by its path relative to local_dir, as it was planned; those are what
+    the index records.
+    refresh holds the same for unchanged files whose index entries are out
+    of date. Planning writes nothing; run() applies both."""
+    def __init__(self):
+        self.uploads = []
+        self.moves = []
+        self.deletes = []
+        self.unchanged = 0
+        self.versions = {}
+        self.refresh = {}
+        self.results = []
+
+    def __len__(self):
+        return len(self.uploads) + len(self.moves) + len(self.deletes)
+
+    def __repr__(self):
+        return '<SyncPlan %s uploads, %s moves, %s deletes>' % (
+               len(self.uploads), len(self.moves), len(self.deletes))
+
+
+class Syncer(object):
+    """Mirrors a local directory into a remote one, transferring only what
+    changed since the last run.
+
+    Local files are compared against an index of what was last synced (by
+    default, a file named .smartfile-sync in local_dir). Files that are not
+    in the index yet are compared against the remote listing, which is only
+    fetched when needed. With checksum, files are also compared by MD5, so
+    a file that was touched but not changed is not uploaded again.
+
+    With delete, remote files whose local copies were removed are deleted,
+    and a removal paired with an identical new file of the same name
+    elsewhere becomes a remote move instead of an upload."""
+    def __init__(self, client, local_dir, remote_dir, index=None,
+                 checksum=False, delete=False, workers=4):
+        self.client = client
+        self.local_dir = local_dir
+        self.remote_dir = '/' + remote_dir.strip('/')
+        self.index_path = index or os.path.join(local_dir, INDEX_NAME)
+        self.checksum = checksum
+        self.delete = delete
+        self.workers = workers
+        self._remote = None
+
+    def remote_path(self, path):
+        return posixpath.join(self.remote_dir, path)
+
+    def scan(self):
+        "Returns {path: (size, mtime)} for the files below local_dir."
+        found = {}
+        index = os.path.abspath(self.index_path)
+        for dirpath, dirnames, filenames in os.walk(self.local_dir):
+            for name in filenames:
+                local = os.path.join(dirpath, name)
+                if os.path.abspath(local) in (index, index + '-journal'):
+                    continue
+                st = os.stat(local)
+                path = os.path.relpath(local, self.local_dir)
+                found[path.replace(os.sep, '/')] = (st.st_size, st.st_mtime)
+        return found
+
+    def remote_files(self):
+        "Returns {path: entry} for the remote files, listing them once."
+        if self._remote is None:
+            self._remote = {}
+            prefix = self.remote_dir.rstrip('/') + '/'
+            for entry in tree.walk(self.client, self.remote_dir,
+                                   workers=self.workers):
+                if not entry.get('isdir') and entry['path'].startswith(prefix):
+                    self._remote[entry['path'][len(prefix):]] = entry
+        return self._remote
+
+    def plan(self, index):
+        plan = SyncPlan()
+        indexed = index.files()
+        new = {}
+        for path, (size, mtime) in sorted(self.scan().items()):
+            local = os.path.join(self.local_dir, path)
+            known = indexed.pop(path, None)
+            if known is not None and known[:2] == (size, mtime):
+                plan.unchanged += 1
+                continue
+            hash = self.checksum and file_hash(local) or None
+            if known is not None:
+                if hash is not None and known[2] == hash:
+                    # Touched, but not changed.
+                    plan.refresh[path] = (size, mtime, hash)
+                    plan.unchanged += 1
+                else:
+                    plan.versions[path] = (size, mtime, hash)
+                    plan.uploads.append((local, self.remote_path(path)))
+                continue
+            entry = self.remote_files().get(path)
+            if entry is not None and entry.get('size') == size and \
+                    remote_mtime(entry) >= int(mtime):
+                # Already uploaded by someone else, or before we had an index.
+                plan.refresh[path] = (size, mtime, hash)
+                plan.unchanged += 1
+                continue
+            plan.versions[path] = (size, mtime, hash)
+            new[(posixpath.basename(path), size, hash or mtime)] = path
+        if self.delete:
+            for path, (size, mtime, hash) in sorted(indexed.items()):
+                if not self.checksum:
+                    hash = mtime
+                moved = new.pop((posixpath.basename(path), size, hash), None)
+                if moved is not None:
+                    plan.moves.append((self.remote_path(path),
+                                       self.remote_path(moved)))
+                else:
+                    plan.deletes.append(self.remote_path(path))
+        for path in sorted(new.values()):
+            plan.uploads.append((os.path.join(self.local_dir, path),
+                                 self.remote_path(path)))
+        return plan
+
+    def _relative(self, remote):
+        return remote[len(self.remote_dir):].lstrip('/')
+
+    def _record(self, index, plan, remote):
+        "Records the version of a file that was planned, and so sent."
+        path = self._relative(remote)
+        index.put(path, *plan.versions[path])
+
+    def _run_action(self, index, plan, action):
+        kind, a, b = action
+        client = self.client
+        if kind == 'upload':
+            result = upload(client, a, b)
+            self._record(index, plan, b)
+        elif kind == 'move':
+            result = _resolve(client.post('/path/oper/move', src=a,
+                                          dst=posixpath.dirname(b)))
+            if isinstance(result, dict) and 'uuid' in result:
+                result = client.wait_for_task(result)
+            index.remove(self._relative(a))
+            self._record(index, plan, b)
+        else:
+            result = _resolve(client.post('/path/oper/remove', path=a))
+            index.remove(self._relative(a))
+        return result
+
+    def run(self, dry_run=False):
+        """Plans the sync and, unless dry_run, performs it. Returns the
+        SyncPlan, with a result for each action once run."""
+        index = SyncIndex(self.index_path, self.remote_dir, readonly=dry_run)
+        try:
+            plan = self.plan(index)
+            if dry_run:
+                return plan
+            for path, version in plan.refresh.items():
+                index.put(path, *version)
+            actions = [('move', a, b) for a, b in plan.moves]
+            actions.extend(('upload', a, b) for a, b in plan.uploads)
+            actions.extend(('delete', a, None) for a in plan.deletes)
+
+            def run(action):
+                try:
+                    return TransferResult(action[1], action[2],
+                                          result=self._run_action(index, plan,
+                                                                  action))
+                except Exception, e:
+                    return TransferResult(action[1], action[2], error=e)
+            with WorkerPool(self.workers) as pool:
+                plan.results = [f.result() for f in pool.map(run, actions)]
+            return plan
+        finally:
+            index.close()
@@ -0,0 +1,62 @@
+import time
+
+from smartfile.errors import TaskError
+from smartfile.pool import Future
+from smartfile.pool import WorkerPool
+from smartfile.transfer import _resolve
+
+FAILED = ('FAILURE', 'REVOKED')
+
+
+class TaskWaiter(object):
+    """Waits for long-running tasks by polling /task. Each task is polled
+    with exponential backoff, starting at initial seconds and growing by
+    factor up to max_delay. Tasks waiting for their next poll do not hold a
+    thread, so any number of them are multiplexed over a few pollers."""
+    def __init__(self, client, pollers=2, initial=0.1, factor=2.0,
+                 max_delay=5.0):
+        self.client = client
+        self.initial = initial
+        self.factor = factor
+        self.max_delay = max_delay
+        self.pool = WorkerPool(pollers)
+
+    def wait(self, task, timeout=None, callback=None):
+        """Returns a Future for the final status of task (a uuid, or the
+        value returned when the task was created). The future raises
+        TaskError if the task fails or timeout seconds pass."""
+        if isinstance(task, dict):
+            task = task['uuid']
+        future = Future()
+        if callback is not None:
+            future.add_done_callback(callback)
+        deadline = timeout is not None and time.time() + timeout or None
+        self.pool.submit(self._poll, future, task, self.initial, deadline)
+        return future
+
+    def _poll(self, future, uuid, delay, deadline):
+        try:
+            status = _resolve(self.client.get('/task', uuid))
+            state = status.get('status')
+        except Exception, e:
+            future.set_exception(e)
+            return
+        status.setdefault('uuid', uuid)
+        if state == 'SUCCESS':
+            future.set_result(status)
+        elif state in FAILED:
+            future.set_exception(TaskError(status, status.get('result') or state))
+        else:
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    future.set_exception(TaskError(status, 'Timed out, the '
+                                                   'task is %s.' % state))
+                    return
+                delay = min(delay, remaining)
+            self.pool.submit_after(delay, self._poll, future, uuid,
+                                   min(delay * self.factor, self.max_delay),
+                                   deadline)
+
+    def close(self):
+        self.pool.shutdown(wait=False)
@@ -0,0 +1,115 @@
+import os
+import time
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from smartfile.errors import APIError
+
+
+class MemoryBackend(object):
+    "Holds rate limiter state for the threads of this process."
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = (0.0, 0.0)
+
+    def update(self, fn):
+        """Replaces the (next_slot, rate) state with the first item returned
+        by fn(state), atomically. Returns the second item."""
+        with self._lock:
+            self._state, result = fn(self._state)
+            return result
+
+
+class FileBackend(object):
+    """Holds rate limiter state in a local file, so that every process
+    using the same path shares one limit. Requires fcntl (POSIX)."""
+    def __init__(self, path):
+        if fcntl is None:
+            raise APIError('FileBackend requires fcntl, which is not '
+                           'available on this platform.')
+        self.path = path
+        # flock() does not exclude threads sharing this process.
+        self._lock = threading.Lock()
+
+    def update(self, fn):
+        with self._lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                try:
+                    state = tuple(map(float, os.read(fd, 64).split()))
+                    next_slot, rate = state
+                except ValueError:
+                    state = (0.0, 0.0)
+                state, result = fn(state)
+                os.lseek(fd, 0, os.SEEK_SET)
+                os.ftruncate(fd, 0)
+                os.write(fd, '%r %r' % state)
+                return result
+            finally:
+                # Closing the descriptor releases the lock.
+                os.close(fd)
+
+
+class RateLimiter(object):
+    """Paces requests shared by many threads (or processes, with a
+    FileBackend) so that they stay below the API's rate limit, rather than
+    being throttled and retried.
+
+    The limit is learned from the x-throttle header. When a request is
+    throttled, every user of the limiter waits out the delay, and the rate
+    is cut to at most one request per delay. Each successful request then
+    raises the rate by the increase factor. If rate is given, it is the
+    starting rate and is never exceeded; otherwise requests are unpaced
+    until the first throttle."""
+    def __init__(self, rate=None, backend=None, increase=0.01):
+        self.rate = rate
+        self.backend = backend or MemoryBackend()
+        self.increase = increase
+
+    def reserve(self):
+        "Claims the next request slot, returns the seconds until it starts."
+        def claim(state):
+            next_slot, rate = state
+            rate = rate or self.rate
+            now = time.time()
+            slot = max(now, next_slot)
+            if rate:
+                next_slot = slot + 1.0 / rate
+            return (next_slot, rate or 0.0), slot - now
+        return self.backend.update(claim)
+
+    def acquire(self):
+        "Waits for the next request slot."
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def throttled(self, delay):
+        "Records that a request was throttled for delay seconds."
+        def slow(state):
+            next_slot, rate = state
+            limit = 1.0 / max(delay, 0.001)
+            rate = rate and min(rate / 2, limit) or limit
+            return (max(next_slot, time.time() + delay), rate), None
+        self.backend.update(slow)
+
+    def succeeded(self):
+        "Records that a request went through."
+        def speed_up(state):
+            next_slot, rate = state
+            if rate:
+                rate *= 1 + self.increase
+                if self.rate:
+                    rate = min(rate, self.rate)
+            return (next_slot, rate), None
+        self.backend.update(speed_up)
+
+    @property
+    def current_rate(self):
+        "The current rate in requests per second, or None when unpaced."
+        return self.backend.update(lambda state: (state, state[1] or None))
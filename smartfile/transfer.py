@@ -0,0 +1,429 @@
+import io
+import os
+import json
+import mmap
+import hashlib
+import posixpath
+import threading
+import uuid
+
+from smartfile.errors import APIError
+from smartfile.errors import ResponseError
+from smartfile.pool import Future
+from smartfile.pool import WorkerPool
+
+
+class TransferResult(object):
+    "The outcome of transferring one (local, remote) pair."
+    def __init__(self, local, remote, result=None, error=None):
+        self.local = local
+        self.remote = remote
+        self.result = result
+        self.error = error
+
+    def __repr__(self):
+        return '<TransferResult %s %s: %s>' % (self.local, self.remote,
+                                               self.error or 'ok')
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def _replace(src, dst):
+    """Renames src over dst. Windows will not rename onto an existing
+    file, so there dst is removed first; if the process dies in between,
+    dst is missing, and a transfer resuming from it starts over."""
+    try:
+        os.rename(src, dst)
+    except OSError:
+        if not os.path.exists(dst):
+            raise
+        os.unlink(dst)
+        os.rename(src, dst)
+
+
+def _resolve(result):
+    "Waits for the result when the client is an AsyncClient."
+    if isinstance(result, Future):
+        return result.result()
+    return result
+
+
+def upload(client, local, remote):
+    """Uploads the local file to the remote path. A remote path ending in /
+    is a directory, and the file keeps its local name."""
+    dirname, name = posixpath.split(remote)
+    if not name:
+        name = os.path.basename(local)
+    with open(local, 'rb') as f:
+        return _resolve(client.post('/path/data', dirname, file=(name, f)))
+
+
+class FileSink(object):
+    """Copies streams into a file descriptor through one preallocated
+    buffer of chunk_size bytes, written with os.write().
+
+    Sources with a native readinto() (files) are read straight into the
+    buffer. HTTP responses are read a chunk at a time instead, as their
+    readinto() is itself a read() and a copy; large chunks keep the per-call
+    overhead low. checksum, a hashlib object, is updated with the data as it
+    is written, and progress, if given, is called with the bytes written so
+    far and the total (or None) after each chunk."""
+    def __init__(self, fd, chunk_size=1048576, progress=None, checksum=None):
+        self.fd = fd
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.checksum = checksum
+        self.written = 0
+        self._view = None
+
+    def write(self, data):
+        if self.checksum is not None:
+            self.checksum.update(data)
+        self.written += len(data)
+        while len(data):
+            data = data[os.write(self.fd, data):]
+
+    def copy(self, src, total=None):
+        "Copies src to the end of the file, returns the bytes written."
+        start = self.written
+        if isinstance(src, (file, io.FileIO, io.BufferedReader)):
+            if self._view is None:
+                self._view = memoryview(bytearray(self.chunk_size))
+            view, readinto = self._view, src.readinto
+
+            def read():
+                return view[:readinto(view)]
+        else:
+            def read():
+                return src.read(self.chunk_size)
+        while True:
+            data = read()
+            if not len(data):
+                break
+            self.write(data)
+            if self.progress is not None:
+                self.progress(self.written - start, total)
+        return self.written - start
+
+
+def download(client, remote, local, chunk_size=1048576, progress=None,
+             checksum=None, expect=None):
+    """Downloads the remote file to the local path. A local directory
+    receives the file under its remote name. See FileSink for the options.
+    If expect, a hex digest, is given, the file is hashed (with checksum,
+    by default MD5) and removed, raising APIError, if it does not match."""
+    if os.path.isdir(local):
+        local = os.path.join(local, posixpath.basename(remote))
+    if expect is not None and checksum is None:
+        checksum = hashlib.md5()
+    f = _resolve(client.get('/path/data', remote))
+    total = None
+    headers = getattr(f, 'headers', {})
+    if 'content-length' in headers and 'content-encoding' not in headers:
+        total = int(headers['content-length'])
+    # O_BINARY keeps Windows from translating line endings.
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+    fd = os.open(local, flags, 0666)
+    try:
+        FileSink(fd, chunk_size, progress, checksum).copy(f, total)
+    finally:
+        os.close(fd)
+    if expect is not None and checksum.hexdigest() != expect.lower():
+        os.unlink(local)
+        raise APIError('Checksum of %s is %s, expected %s.' % (
+                       remote, checksum.hexdigest(), expect))
+    return local
+
+
+def transfer_many(transfer, client, pairs, workers):
+    """Runs transfer(client, a, b) for each (a, b) pair on a pool of workers.
+    Returns a TransferResult per pair, in order; a failed transfer records
+    its exception rather than stopping the others."""
+    def run(pair):
+        try:
+            return TransferResult(pair[0], pair[1],
+                                  result=transfer(client, *pair))
+        except Exception, e:
+            return TransferResult(pair[0], pair[1], error=e)
+    with WorkerPool(workers) as pool:
+        return [f.result() for f in pool.map(run, pairs)]
+
+
+class RangedDownload(object):
+    """Downloads a remote file in parts of part_size bytes, fetched
+    concurrently with HTTP range requests and written into the local file
+    through a memory map. The file is allocated at full size up front.
+
+    Completed parts are recorded in a ``<local>.parts`` file, so running the
+    same download again after a failure fetches only the missing parts. If
+    the server ignores the Range header, the body is written out as a single
+    stream instead."""
+    chunk_size = 1048576
+
+    def __init__(self, client, remote, local, workers=4, part_size=8388608):
+        self.client = client
+        self.remote = remote
+        self.local = local
+        self.workers = workers
+        self.part_size = part_size
+        self.progress = local + '.parts'
+        self._lock = threading.Lock()
+
+    def _load_progress(self, size):
+        try:
+            with open(self.progress) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return set()
+        if state.get('size') != size or \
+                state.get('part_size') != self.part_size or \
+                not os.path.exists(self.local):
+            return set()
+        return set(state.get('done', []))
+
+    def _save_progress(self, size, done):
+        tmp = self.progress + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'size': size, 'part_size': self.part_size,
+                       'done': sorted(done)}, f)
+        _replace(tmp, self.progress)
+
+    def _get_range(self, start, end):
+        # Ranges of a compressed body would not be ranges of the file.
+        headers = {'Range': 'bytes=%s-%s' % (start, end - 1),
+                   'Accept-Encoding': 'identity'}
+        return _resolve(self.client._request('get', '/path/data', id=self.remote,
+                                             headers=headers))
+
+    def _write(self, raw, mm, start, end):
+        pos = start
+        while pos < end:
+            chunk = raw.read(min(self.chunk_size, end - pos))
+            if not chunk:
+                raise APIError('Download of %s ended early at byte %s.' % (
+                               self.remote, pos))
+            mm[pos:pos + len(chunk)] = chunk
+            pos += len(chunk)
+
+    def run(self):
+        info = _resolve(self.client.get('/path/info', self.remote))
+        size = int(info['size'])
+        done = self._load_progress(size)
+        mode = done and 'r+b' or 'w+b'
+        with open(self.local, mode) as f:
+            f.truncate(size)
+            if not size:
+                return self.local
+            parts = range(0, (size + self.part_size - 1) // self.part_size)
+            missing = [i for i in parts if i not in done]
+            mm = mmap.mmap(f.fileno(), size)
+            try:
+                if missing and self._fetch_first(mm, size, missing, done):
+                    self._fetch_rest(mm, size, missing[1:], done)
+                mm.flush()
+            finally:
+                mm.close()
+        if os.path.exists(self.progress):
+            os.unlink(self.progress)
+        return self.local
+
+    def _bounds(self, part, size):
+        start = part * self.part_size
+        return start, min(start + self.part_size, size)
+
+    def _fetch_first(self, mm, size, missing, done):
+        """Fetches the first missing part, which tells us whether ranges are
+        supported. Returns False if the whole file was streamed instead."""
+        start, end = self._bounds(missing[0], size)
+        raw = self._get_range(start, end)
+        if raw.status != 206:
+            # The server sent the whole file, fall back to a single stream.
+            self._write(raw, mm, 0, size)
+            return False
+        self._write(raw, mm, start, end)
+        done.add(missing[0])
+        self._save_progress(size, done)
+        return True
+
+    def _fetch_rest(self, mm, size, missing, done):
+        def fetch(part):
+            start, end = self._bounds(part, size)
+            self._write(self._get_range(start, end), mm, start, end)
+            with self._lock:
+                done.add(part)
+                self._save_progress(size, done)
+        errors = []
+        with WorkerPool(self.workers) as pool:
+            for future in pool.map(fetch, missing):
+                if future.exception() is not None:
+                    errors.append(future.exception())
+        if errors:
+            raise errors[0]
+
+
+class FilePart(object):
+    """A read-only window of length bytes of the file at path, starting at
+    offset, so that one part of a file can be uploaded without reading it
+    into memory. It can seek, so the part can be sent again on a retry."""
+    def __init__(self, path, offset, length):
+        self.offset = offset
+        self.length = length
+        self._f = open(path, 'rb')
+        self._f.seek(offset)
+        self._pos = 0
+
+    def read(self, size=-1):
+        left = self.length - self._pos
+        if size is None or size < 0 or size > left:
+            size = left
+        data = self._f.read(size)
+        self._pos += len(data)
+        return data
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self._pos
+        elif whence == 2:
+            pos += self.length
+        self._pos = pos
+        self._f.seek(self.offset + pos)
+
+    def close(self):
+        self._f.close()
+
+
+def ranged_uploads(client, dirname):
+    """Returns True if the server assembles files uploaded in parts, each
+    sent with a ``Content-Range: bytes <first>-<last>/<size>`` header, as
+    ChunkedUpload and ProcessPipeline need. This is not part of the
+    documented API, and a server that ignores the header stores each part
+    as the whole file.
+
+    A two byte probe file is uploaded to dirname, its second byte first: a
+    server that ignores Content-Range then has a one byte file. The probe
+    is completed, if the server is waiting for its first byte, and
+    removed."""
+    name = '.range-probe-%s' % uuid.uuid4().hex
+    path = posixpath.join(dirname, name)
+
+    def send(data, start):
+        headers = {'Content-Range': 'bytes %s-%s/2' % (start, start)}
+        _resolve(client._request('post', '/path/data', id=dirname,
+                                 headers=headers,
+                                 data={'file': (name, io.BytesIO(data))}))
+    send('b', 1)
+    try:
+        size = int(_resolve(client.get('/path/info', path))['size'])
+    except ResponseError, e:
+        if e.status_code != 404:
+            raise
+        size = None
+    supported = size != 1
+    if supported:
+        send('a', 0)
+    _resolve(client.post('/path/oper/remove', path=path))
+    return supported
+
+
+class ChunkedUpload(object):
+    """Uploads a local file in parts of part_size bytes, sent concurrently
+    by up to workers threads. Each part is a multipart upload of its bytes
+    with a ``Content-Range: bytes <first>-<last>/<size>`` header, and the
+    server assembles the file once it has every part. Parts are streamed
+    from the file, so memory use is bounded by the number of parts in
+    flight.
+
+    Completed parts are recorded in a ``<local>.upload`` file, so running
+    the same upload again after a failure sends only the missing parts,
+    unless the file has changed since. Files no larger than a part are
+    uploaded in one request. The size of the remote file is checked once
+    every part has been sent.
+
+    Assembling parts by Content-Range is not part of the documented API,
+    so before the first part of a new upload, ranged_uploads() checks that
+    the server supports it. If it does not, the file is uploaded in one
+    request instead, rather than each part overwriting the last."""
+    def __init__(self, client, local, remote, workers=4, part_size=8388608):
+        self.client = client
+        self.local = local
+        self.workers = workers
+        self.part_size = part_size
+        self.progress = local + '.upload'
+        dirname, name = posixpath.split(remote)
+        self.dirname = dirname
+        self.name = name or os.path.basename(local)
+        self.remote = posixpath.join(dirname, self.name)
+        self._lock = threading.Lock()
+
+    def _state(self, size):
+        "Identifies the upload, a checkpoint for another is not resumed."
+        return {'remote': self.remote, 'size': size,
+                'mtime': os.path.getmtime(self.local),
+                'part_size': self.part_size}
+
+    def _load_progress(self, size):
+        try:
+            with open(self.progress) as f:
+                state = json.load(f)
+        except (IOError, ValueError):
+            return set()
+        done = set(state.pop('done', []))
+        if state != self._state(size):
+            return set()
+        return done
+
+    def _save_progress(self, size, done):
+        tmp = self.progress + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(dict(self._state(size), done=sorted(done)), f)
+        _replace(tmp, self.progress)
+
+    def _bounds(self, part, size):
+        start = part * self.part_size
+        return start, min(start + self.part_size, size)
+
+    def _send_part(self, start, end, size):
+        f = FilePart(self.local, start, end - start)
+        headers = {'Content-Range': 'bytes %s-%s/%s' % (start, end - 1, size)}
+        try:
+            return _resolve(self.client._request(
+                'post', '/path/data', id=self.dirname, headers=headers,
+                data={'file': (self.name, f)}))
+        finally:
+            f.close()
+
+    def run(self):
+        "Uploads the missing parts, returns the remote file's info."
+        size = os.path.getsize(self.local)
+        if size <= self.part_size:
+            return upload(self.client, self.local, self.remote)
+        done = self._load_progress(size)
+        if not done and not ranged_uploads(self.client, self.dirname):
+            return upload(self.client, self.local, self.remote)
+        parts = range(0, (size + self.part_size - 1) // self.part_size)
+        missing = [i for i in parts if i not in done]
+
+        def send(part):
+            self._send_part(*self._bounds(part, size) + (size,))
+            with self._lock:
+                done.add(part)
+                self._save_progress(size, done)
+        errors = []
+        with WorkerPool(self.workers) as pool:
+            for future in pool.map(send, missing, window=self.workers):
+                if future.exception() is not None:
+                    errors.append(future.exception())
+        if errors:
+            raise errors[0]
+        info = _resolve(self.client.get('/path/info', self.remote))
+        if int(info['size']) != size:
+            raise APIError('Uploaded %s bytes of %s, but %s has %s.' % (
+                           size, self.local, self.remote, info['size']))
+        if os.path.exists(self.progress):
+            os.unlink(self.progress)
+        return info
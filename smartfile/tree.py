@@ -0,0 +1,64 @@
+import Queue
+
+from smartfile.pool import WorkerPool
+from smartfile.transfer import _resolve
+
+
+def list_page(client, path, page):
+    """Fetches one page of a directory's children. Returns the children and
+    the number of the next page, or None if this was the last."""
+    params = {'children': True}
+    if page > 1:
+        params['page'] = page
+    info = _resolve(client.get('/path/info', path, **params))
+    next_page = None
+    if page < info.get('pages', 1):
+        next_page = page + 1
+    return info.get('children', []), next_page
+
+
+def walk(client, root='/', maxdepth=None, filter=None, onerror=None,
+         workers=4):
+    """Lazily yields the entries below root, as returned by /path/info.
+
+    Directories are listed a page at a time by up to workers concurrent
+    requests. Only the paths of directories waiting to be listed are held,
+    not their entries. They are listed depth first, so these paths are
+    roughly the subdirectories of the directories on the way down to the
+    one being listed. That is not a fixed bound: a wide tree holds many of
+    them. Entries are yielded as their pages arrive, so siblings may be
+    interleaved with other directories' entries.
+
+    maxdepth limits how far below root to descend, the children of root
+    being depth 1. Only entries for which filter(entry) is true are yielded,
+    though all directories are descended. A failed listing raises, unless
+    onerror is given, in which case it is called with the exception and the
+    walk continues."""
+    done = Queue.Queue()
+    pending = [(root, 1, 1)]
+    running = 0
+    with WorkerPool(workers) as pool:
+        while pending or running:
+            while pending and running < workers:
+                path, depth, page = task = pending.pop()
+                future = pool.submit(list_page, client, path, page)
+                future.task = task
+                future.add_done_callback(done.put)
+                running += 1
+            future = done.get()
+            running -= 1
+            path, depth, page = future.task
+            try:
+                children, next_page = future.result()
+            except Exception, e:
+                if onerror is None:
+                    raise
+                onerror(e)
+                continue
+            if next_page is not None:
+                pending.append((path, depth, next_page))
+            for entry in children:
+                if entry.get('isdir') and (maxdepth is None or depth < maxdepth):
+                    pending.append((entry['path'], depth + 1, 1))
+                if filter is None or filter(entry):
+                    yield entry
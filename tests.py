@@ -1,19 +1,59 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
+import re
+import cgi
+import gzip
 import json
+import hashlib
+import shutil
+import socket
 import urlparse
 import unittest
+import gc
+import time
 import tempfile
 import threading
+import subprocess
+import itertools
+import zlib
+import datetime
 
+from StringIO import StringIO
 from BaseHTTPServer import HTTPServer
 from BaseHTTPServer import BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
 
 from smartfile import BasicClient
 from smartfile import OAuthClient
+from smartfile import AsyncBasicClient
+from smartfile import AsyncOAuthClient
+from smartfile import OAuthToken
+from smartfile import cli
+from smartfile.auth import BasicAuthProvider
+from smartfile.cache import LRU
+from smartfile.cache import ResponseCache
 from smartfile.errors import APIError
 from smartfile.errors import RequestError
+from smartfile.errors import ResponseError
+from smartfile.errors import TaskError
+from smartfile.flight import SingleFlight
+from smartfile.metrics import Histogram
+from smartfile.metrics import MetricsCollector
+from smartfile.pipeline import ProcessPipeline
+from smartfile.records import PathInfo
+from smartfile.stream import ItemDecoder
+from smartfile.sync import SyncIndex
+from smartfile.tasks import TaskWaiter
+from smartfile.breaker import CircuitBreaker
+from smartfile.breaker import CircuitOpenError
+from smartfile.hedge import Hedge
+from smartfile.retry import RetryBudget
+from smartfile.retry import RetryPolicy
+from smartfile.throttle import FileBackend
+from smartfile.throttle import RateLimiter
+from smartfile.transfer import FileSink
 
 
 API_KEY = '8g1aq1UF2QfZTG47yEVhVLAFqyfDdp'
@@ -24,24 +64,37 @@ ACCESS_TOKEN = 'hIlkipZNmwIJ28HQtQRcbGuXBePQp5'
 ACCESS_SECRET = 'Scen1dwmVtWhjLpJfnilrfdc5OZWCJ'
 
 
+def windows_rename(src, dst, rename=os.rename):
+    "os.rename() as it behaves on Windows, refusing to replace a file."
+    if os.path.exists(dst):
+        raise OSError(17, 'File exists: %s' % dst)
+    rename(src, dst)
+
+
 class TestHTTPRequestHandler(BaseHTTPRequestHandler):
     """
     A simple handler that logs requests for examination.
     """
     class TestRequest(object):
-        def __init__(self, method, path, query=None, data=None):
+        def __init__(self, method, path, query=None, data=None, client=None,
+                     headers=None, body=None):
             self.method = method
             self.path = path
             self.query = query
             self.data = data
+            self.client = client
+            self.headers = headers
+            self.body = body
 
     def __init__(self, *args, **kwargs):
         self.verbose = kwargs.pop('verbose', False)
         BaseHTTPRequestHandler.__init__(self, *args, **kwargs)
 
-    def record(self, method, path, query=None, data=None):
+    def record(self, method, path, query=None, data=None, body=None):
         self.server.requests.append(TestHTTPRequestHandler.TestRequest(method,
-                                    path, query=query, data=data))
+                                    path, query=query, data=data,
+                                    client=self.client_address,
+                                    headers=self.headers, body=body))
 
     def respond(self):
         self.send_response(200)
@@ -49,13 +102,24 @@ class TestHTTPRequestHandler(BaseHTTPRequestHandler):
         self.end_headers()
         self.wfile.write("Hello World!")
 
+    def read_body(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            chunks = []
+            while True:
+                l = int(self.rfile.readline().split(';')[0], 16)
+                chunks.append(self.rfile.read(l))
+                self.rfile.readline()
+                if not l:
+                    return ''.join(chunks)
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
     def parse_and_record(self, method):
         urlp = urlparse.urlparse(self.path)
-        query, data = urlparse.parse_qs(urlp.query), None
-        if method == 'POST':
-            l = int(self.headers['Content-Length'])
-            data = urlparse.parse_qs(self.rfile.read(l))
-        self.record(method, urlp.path, query=query, data=data)
+        query, data, body = urlparse.parse_qs(urlp.query), None, None
+        if method in ('POST', 'PUT'):
+            body = self.read_body()
+            data = urlparse.parse_qs(body)
+        self.record(method, urlp.path, query=query, data=data, body=body)
         self.respond()
 
     def log_message(self, *args, **kwargs):
@@ -101,6 +165,10 @@ class TestServerTestCase(unittest.TestCase):
         self.server = TestHTTPServer()
 
     def tearDown(self):
+        # A client and its endpoint handles refer to each other, so a client
+        # a test did not close is freed, hanging up its keep-alive
+        # connections, only by the garbage collector.
+        gc.collect()
         self.server.shutdown()
 
     def assertRequestCount(self, num=1):
@@ -131,15 +199,19 @@ class TestServerTestCase(unittest.TestCase):
 
 
 class BasicTestCase(TestServerTestCase):
+    client_class = BasicClient
+
     def getClient(self, **kwargs):
         kwargs.setdefault('key', API_KEY)
         kwargs.setdefault('password', API_PASSWORD)
         kwargs.setdefault('url', 'http://127.0.0.1:%s/' %
                           self.server.server_port)
-        return BasicClient(**kwargs)
+        return self.client_class(**kwargs)
 
 
 class OAuthTestCase(TestServerTestCase):
+    client_class = OAuthClient
+
     def getClient(self, **kwargs):
         kwargs.setdefault('client_token', CLIENT_TOKEN)
         kwargs.setdefault('client_secret', CLIENT_SECRET)
@@ -147,7 +219,7 @@ class OAuthTestCase(TestServerTestCase):
         kwargs.setdefault('access_secret', ACCESS_SECRET)
         kwargs.setdefault('url', 'http://127.0.0.1:%s/' %
                           self.server.server_port)
-        return OAuthClient(**kwargs)
+        return self.client_class(**kwargs)
 
 
 class UrlGenerationTestCase(object):
@@ -172,6 +244,58 @@ class UrlGenerationTestCase(object):
         self.assertPath('/api/{0}/ping/'.format(client.version))
 
 
+class EndpointTestCase(object):
+    "Tests the prepared endpoint handles."
+    def test_handle_cached(self):
+        client = self.getClient()
+        self.assertTrue(client.endpoint('/path/info') is
+                        client.endpoint('/path/info'))
+
+    def test_handle_get(self):
+        client = self.getClient()
+        info = client.endpoint('/path//info/')
+        info.get('/the//file/path/', children=True)
+        self.assertMethod('GET')
+        self.assertPath('/api/{0}/path/info/the/file/path/'.format(
+            client.version))
+        self.assertEqual(self.server.requests[0].query, {'children': ['True']})
+
+    def test_handle_without_id(self):
+        client = self.getClient()
+        client.endpoint('/ping')()
+        self.assertPath('/api/{0}/ping/'.format(client.version))
+
+    def test_handle_post(self):
+        client = self.getClient()
+        client.endpoint('/user').post('bobafett', email='bobafett@example.com')
+        self.assertMethod('POST')
+        self.assertPath('/api/{0}/user/bobafett/'.format(client.version))
+
+    def test_handle_follows_client(self):
+        client = self.getClient()
+        info = client.endpoint('/path/info')
+        client.version = '3'
+        info.get('/a')
+        self.assertPath('/api/3/path/info/a/')
+
+    def test_handle_stream_items(self):
+        client = self.getClient()
+        client.endpoint('/path/info').get('/', stream_items=True).close()
+        self.assertEqual(self.server.requests[0].query, {})
+
+    def test_handle_outlives_call(self):
+        client = self.getClient()
+        url = self.getClient().endpoint('/ping').url_for('x')
+        self.assertEqual(url, '%sapi/%s/ping/x/' % (client.url,
+                                                   client.version))
+
+    def test_user_agent(self):
+        client = self.getClient()
+        client.get('/ping')
+        self.assertTrue(self.server.requests[0].headers['User-Agent']
+                        .startswith('SmartFile Python API client'))
+
+
 class MethodTestCase(object):
     "Tests the HTTP methods used by CRUD methods."
     def test_call_is_GET(self):
@@ -224,6 +348,205 @@ class UploadTestCase(object):
                 pass
 
 
+class BulkTransferTestCase(object):
+    def test_upload_many(self):
+        client = self.getClient()
+        tmp = tempfile.mkdtemp()
+        try:
+            pairs = []
+            for i in range(3):
+                local = os.path.join(tmp, 'file%s' % i)
+                with open(local, 'wb') as f:
+                    f.write('data')
+                pairs.append((local, '/dir/file%s' % i))
+            pairs.append((os.path.join(tmp, 'missing'), '/dir/missing'))
+            results = client.upload_many(iter(pairs), workers=2)
+        finally:
+            shutil.rmtree(tmp)
+        self.assertEqual([r.remote for r in results], [p[1] for p in pairs])
+        self.assertEqual([r.ok for r in results], [True, True, True, False])
+        self.assertRequestCount(3)
+        for request in self.server.requests:
+            self.assertEqual(request.path,
+                             '/api/{0}/path/data/dir/'.format(client.version))
+
+    def test_download_many(self):
+        client = self.getClient()
+        tmp = tempfile.mkdtemp()
+        try:
+            pairs = [('/dir/a', os.path.join(tmp, 'a')), ('/dir/b', tmp)]
+            results = client.download_many(pairs)
+            self.assertTrue(all(r.ok for r in results))
+            for name in ('a', 'b'):
+                with open(os.path.join(tmp, name)) as f:
+                    self.assertEqual(f.read(), 'Hello World!')
+        finally:
+            shutil.rmtree(tmp)
+        self.assertRequestCount(2)
+
+
+class StreamingUploadTestCase(object):
+    def test_file_streamed(self):
+        client = self.getClient(upload_chunk_size=16)
+        data = StringIO('x' * 100)
+        client.post('/path/data', '/dir', file=('foobar.txt', data), a='b')
+        request = self.server.requests[0]
+        self.assertEqual(request.headers['Content-Length'],
+                         str(len(request.body)))
+        self.assertTrue('filename="foobar.txt"' in request.body)
+        self.assertTrue('x' * 100 in request.body)
+        self.assertTrue('name="a"\r\n\r\nb\r\n' in request.body)
+
+    def test_iterator_upload(self):
+        client = self.getClient()
+        chunks = ('chunk%s' % i for i in range(5))
+        client.post('/path/data', '/dir', file=('foobar.txt', chunks))
+        request = self.server.requests[0]
+        self.assertEqual(request.headers['Transfer-Encoding'], 'chunked')
+        self.assertTrue('chunk0chunk1chunk2chunk3chunk4' in request.body)
+
+
+class HTTPRangeRequestHandler(TestHTTPRequestHandler):
+    content = ''.join(chr(i) for i in range(95))
+    ranges = True
+
+    def respond(self):
+        if '/path/info/' in self.path:
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps({'size': len(self.content)}))
+            return
+        m = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range', ''))
+        if m and self.ranges:
+            start, end = int(m.group(1)), int(m.group(2)) + 1
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %s-%s/%s" % (
+                             start, end - 1, len(self.content)))
+        else:
+            start, end = 0, len(self.content)
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.end_headers()
+        self.wfile.write(self.content[start:end])
+
+
+class HTTPNoRangeRequestHandler(HTTPRangeRequestHandler):
+    ranges = False
+
+
+class RangedDownloadTestCase(BasicTestCase):
+    def setUp(self):
+        self.server = TestHTTPServer(handler=HTTPRangeRequestHandler)
+        self.tmp = tempfile.mkdtemp()
+        self.local = os.path.join(self.tmp, 'foobar')
+
+    def tearDown(self):
+        super(RangedDownloadTestCase, self).tearDown()
+        shutil.rmtree(self.tmp)
+
+    def dataRequests(self):
+        return [r for r in self.server.requests if '/path/data/' in r.path]
+
+    def assertDownloaded(self):
+        with open(self.local, 'rb') as f:
+            self.assertEqual(f.read(), HTTPRangeRequestHandler.content)
+        self.assertFalse(os.path.exists(self.local + '.parts'))
+
+    def test_download_to(self):
+        client = self.getClient()
+        client.download_to('/foobar', self.local, part_size=10)
+        self.assertDownloaded()
+        self.assertEqual(len(self.dataRequests()), 10)
+
+    def test_resume(self):
+        with open(self.local, 'wb') as f:
+            f.write(HTTPRangeRequestHandler.content[:50])
+        with open(self.local + '.parts', 'w') as f:
+            json.dump({'size': 95, 'part_size': 10, 'done': range(5)}, f)
+        client = self.getClient()
+        client.download_to('/foobar', self.local, part_size=10)
+        self.assertDownloaded()
+        self.assertEqual(len(self.dataRequests()), 5)
+
+    def test_checkpoint_replaced(self):
+        rename, os.rename = os.rename, windows_rename
+        try:
+            client = self.getClient()
+            client.download_to('/foobar', self.local, part_size=10)
+        finally:
+            os.rename = rename
+        self.assertDownloaded()
+
+    def test_no_ranges(self):
+        self.server.shutdown()
+        self.server = TestHTTPServer(handler=HTTPNoRangeRequestHandler)
+        client = self.getClient()
+        client.download_to('/foobar', self.local, part_size=10)
+        self.assertDownloaded()
+        self.assertEqual(len(self.dataRequests()), 1)
+
+
+class HTTPTaskRequestHandler(TestHTTPRequestHandler):
+    "Tasks finish after two polls, unless their uuid says otherwise."
+    def respond(self):
+        uuid = self.path.rstrip('/').split('/')[-1]
+        polls = len([r for r in self.server.requests
+                     if r.path.endswith('/%s/' % uuid)])
+        if uuid.startswith('fail'):
+            status = 'FAILURE'
+        elif uuid.startswith('slow') or polls < 3:
+            status = 'PENDING'
+        else:
+            status = 'SUCCESS'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps({'uuid': uuid, 'status': status}))
+
+
+class TaskTestCase(BasicTestCase):
+    def setUp(self):
+        self.server = TestHTTPServer(handler=HTTPTaskRequestHandler)
+
+    def getClient(self, **kwargs):
+        client = super(TaskTestCase, self).getClient(**kwargs)
+        client.task_waiter = TaskWaiter(client, initial=0.01)
+        return client
+
+    def test_wait_for_task(self):
+        client = self.getClient()
+        status = client.wait_for_task({'uuid': 'abc'})
+        self.assertEqual(status['status'], 'SUCCESS')
+        self.assertRequestCount(3)
+        self.assertPath('/api/{0}/task/abc/'.format(client.version))
+
+    def test_not_cached(self):
+        client = self.getClient(cache=ResponseCache(ttl=30))
+        status = client.wait_for_task({'uuid': 'abc'}, timeout=5)
+        self.assertEqual(status['status'], 'SUCCESS')
+        self.assertRequestCount(3)
+
+    def test_failure(self):
+        client = self.getClient()
+        self.assertRaises(TaskError, client.wait_for_task, 'fail')
+
+    def test_timeout(self):
+        client = self.getClient()
+        self.assertRaises(TaskError, client.wait_for_task, 'slow', timeout=0.1)
+
+    def test_wait_for_tasks(self):
+        client = self.getClient()
+        done = []
+        uuids = ['task%s' % i for i in range(20)] + ['fail']
+        futures = client.wait_for_tasks(uuids, callback=done.append)
+        results = [f.exception(5) for f in futures]
+        self.assertEqual(len(done), 21)
+        self.assertEqual(results[:-1], [None] * 20)
+        self.assertTrue(isinstance(results[-1], TaskError))
+        self.assertRequestCount(61)
+
+
 class BasicEnvironTestCase(BasicTestCase):
     "Tests that the API client reads settings from ENV."
     def setUp(self):
@@ -271,10 +594,19 @@ class OAuthEnvironTestCase(OAuthTestCase):
 
 
 class BasicClientTestCase(DownloadTestCase, UploadTestCase, MethodTestCase,
-                          UrlGenerationTestCase, BasicTestCase):
+                          EndpointTestCase,
+                          UrlGenerationTestCase, BulkTransferTestCase,
+                          StreamingUploadTestCase, BasicTestCase):
     def test_blank_credentials(self):
         self.assertRaises(APIError, self.getClient, key='', password='')
 
+    def test_auth_provider(self):
+        client = self.getClient()
+        self.assertTrue(isinstance(client.auth, BasicAuthProvider))
+        client.get('/ping')
+        self.assertTrue(self.server.requests[0].headers['Authorization']
+                        .startswith('Basic '))
+
     def test_netrc(self):
         fd, t = tempfile.mkstemp()
         try:
@@ -301,7 +633,9 @@ class BasicClientTestCase(DownloadTestCase, UploadTestCase, MethodTestCase,
 
 
 class OAuthClientTestCase(DownloadTestCase, UploadTestCase, MethodTestCase,
-                          UrlGenerationTestCase, OAuthTestCase):
+                          EndpointTestCase,
+                          UrlGenerationTestCase, BulkTransferTestCase,
+                          StreamingUploadTestCase, OAuthTestCase):
     def test_blank_client_token(self):
         self.assertRaises(APIError, self.getClient, client_token='', client_secret='')
 
@@ -309,6 +643,92 @@ class OAuthClientTestCase(DownloadTestCase, UploadTestCase, MethodTestCase,
         client = self.getClient(access_token='', access_secret='')
         self.assertRaises(APIError, client.get, '/ping')
 
+    def test_no_access_token(self):
+        client = self.getClient(access_token=None, access_secret=None)
+        self.assertFalse(client._access.is_valid())
+        self.assertRaises(APIError, client.get, '/ping')
+
+    def test_access_token_swapped(self):
+        client = self.getClient(access_token='', access_secret='')
+        client._access = OAuthToken(ACCESS_TOKEN, ACCESS_SECRET)
+        client.get('/ping')
+        self.assertTrue('oauth_token="%s"' % ACCESS_TOKEN in
+                        self.server.requests[0].headers['Authorization'])
+
+    def test_signer_reused(self):
+        client = self.getClient()
+        signer = client.auth.signer
+        client.get('/ping')
+        client.get('/ping')
+        self.assertTrue(client.auth.signer is signer)
+
+
+class HTTPKeepAliveRequestHandler(TestHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def respond(self):
+        self.send_response(200)
+        self.send_header("Content-type", "text/plain")
+        self.send_header("Content-Length", "12")
+        self.end_headers()
+        self.wfile.write("Hello World!")
+
+
+class SessionTestCase(object):
+    def setUp(self):
+        self.server = TestHTTPServer(handler=HTTPKeepAliveRequestHandler)
+
+    def test_connection_reused(self):
+        client = self.getClient()
+        client.get('/ping').read()
+        client.get('/ping').read()
+        self.assertRequestCount(2)
+        self.assertEqual(self.server.requests[0].client,
+                         self.server.requests[1].client)
+
+    def test_idle_connections_dropped(self):
+        with self.getClient(idle_timeout=60) as client:
+            client.get('/ping').read()
+            client._session_used -= 61
+            client.get('/ping').read()
+        self.assertRequestCount(2)
+        self.assertNotEqual(self.server.requests[0].client,
+                            self.server.requests[1].client)
+
+    def test_keep_alive_off(self):
+        with self.getClient(keep_alive=False) as client:
+            client.get('/ping').read()
+            client.get('/ping').read()
+        self.assertRequestCount(2)
+        self.assertEqual(self.server.requests[0].headers['Connection'],
+                         'close')
+        self.assertNotEqual(self.server.requests[0].client,
+                            self.server.requests[1].client)
+
+    def test_close(self):
+        client = self.getClient()
+        session = client.session
+        client.close()
+        self.assertTrue(client.session is not session)
+
+    def test_context_manager(self):
+        with self.getClient() as client:
+            client.get('/ping').read()
+        self.assertTrue(client._session is None)
+
+    def test_pool_size(self):
+        client = self.getClient(pool_size=3)
+        adapter = client.session.get_adapter(client.url)
+        self.assertEqual(adapter._pool_maxsize, 3)
+
+
+class BasicSessionTestCase(SessionTestCase, BasicTestCase):
+    pass
+
+
+class OAuthSessionTestCase(SessionTestCase, OAuthTestCase):
+    pass
+
 
 class HTTPThrottleRequestHandler(TestHTTPRequestHandler):
     def respond(self):
@@ -328,6 +748,63 @@ class ThrottleTestCase(object):
         self.assertRequestCount(3)
 
 
+    def test_rate_limiter_learns(self):
+        limiter = RateLimiter()
+        client = self.getClient(rate_limiter=limiter)
+        self.assertRaises(RequestError, client.get, '/ping')
+        self.assertRequestCount(3)
+        self.assertTrue(limiter.current_rate <= 100)
+
+    def test_metrics(self):
+        metrics = MetricsCollector()
+        client = metrics.install(self.getClient())
+        self.assertRaises(RequestError, client.get, '/ping')
+        stats = metrics.snapshot()['ping']
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['errors'], 3)
+        self.assertEqual(stats['retries'], 2)
+        self.assertEqual(stats['throttles'], 3)
+        self.assertAlmostEqual(stats['throttle_wait'], 0.03)
+
+
+class RateLimiterTestCase(unittest.TestCase):
+    def test_paced(self):
+        limiter = RateLimiter(rate=10)
+        delays = [limiter.reserve() for i in range(3)]
+        self.assertTrue(delays[0] < 0.01)
+        self.assertAlmostEqual(delays[1], 0.1, 1)
+        self.assertAlmostEqual(delays[2], 0.2, 1)
+
+    def test_unpaced_until_throttled(self):
+        limiter = RateLimiter()
+        self.assertEqual(limiter.current_rate, None)
+        self.assertTrue(limiter.reserve() < 0.01)
+        limiter.throttled(0.5)
+        self.assertEqual(limiter.current_rate, 2)
+        self.assertAlmostEqual(limiter.reserve(), 0.5, 1)
+
+    def test_succeeded_never_exceeds_rate(self):
+        limiter = RateLimiter(rate=10)
+        limiter.throttled(1)
+        limiter.succeeded()
+        self.assertTrue(1 < limiter.current_rate < 10)
+        for i in range(500):
+            limiter.succeeded()
+        self.assertEqual(limiter.current_rate, 10)
+
+    def test_file_backend_shared(self):
+        fd, t = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            a = RateLimiter(backend=FileBackend(t))
+            b = RateLimiter(backend=FileBackend(t))
+            a.throttled(0.5)
+            self.assertEqual(b.current_rate, 2)
+            self.assertAlmostEqual(b.reserve(), 0.5, 1)
+        finally:
+            os.unlink(t)
+
+
 class BasicThrottleTestCase(ThrottleTestCase, BasicTestCase):
     pass
 
@@ -336,6 +813,52 @@ class OAuthThrottleTestCase(ThrottleTestCase, OAuthTestCase):
     pass
 
 
+class HistogramTestCase(unittest.TestCase):
+    def test_percentiles(self):
+        h = Histogram()
+        for i in range(1, 101):
+            h.record(i / 100.0)
+        self.assertEqual(h.count, 100)
+        self.assertAlmostEqual(h.mean, 0.505)
+        self.assertAlmostEqual(h.percentile(50), 0.5, delta=0.1)
+        self.assertAlmostEqual(h.percentile(99), 0.99, delta=0.1)
+        self.assertEqual(h.percentile(100), 1.0)
+
+    def test_empty(self):
+        self.assertEqual(Histogram().snapshot()['p95'], 0.0)
+
+
+class MetricsTestCase(BasicTestCase):
+    def test_hooks(self):
+        client = self.getClient()
+        events = []
+        client.on('request', events.append)
+        client.on('response', events.append)
+        client.get('/path/info', '/a')
+        self.assertEqual([e['event'] for e in events], ['request', 'response'])
+        self.assertEqual(events[1]['method'], 'GET')
+        self.assertEqual(events[1]['response'].status_code, 200)
+        self.assertTrue(events[1]['elapsed'] >= 0)
+
+    def test_per_endpoint(self):
+        metrics = MetricsCollector()
+        client = metrics.install(self.getClient())
+        client.get('/path/info', '/a')
+        client.get('/path/info', '/b')
+        client.post('/path/oper/move', src='/a', dst='/b')
+        client.get('/user', 'bobafett')
+        snapshot = metrics.snapshot()
+        self.assertEqual(sorted(snapshot),
+                         ['path/info', 'path/oper/move', 'user'])
+        stats = snapshot['path/info']
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['errors'], 0)
+        self.assertEqual(stats['latency']['count'], 2)
+        self.assertTrue(snapshot['path/oper/move']['bytes_sent'] > 0)
+        metrics.reset()
+        self.assertEqual(metrics.snapshot(), {})
+
+
 class HTTPJSONRequestHandler(TestHTTPRequestHandler):
     def respond(self):
         self.send_response(200)
@@ -363,6 +886,1432 @@ class OAuthJSONTestCase(JSONTestCase, OAuthTestCase):
     pass
 
 
+class AsyncTestCase(object):
+    "Tests the Future-returning clients."
+    def test_get_returns_future(self):
+        client = self.getClient()
+        r = client.get('/user', 'bobafett').result(5)
+        self.assertMethod('GET')
+        self.assertPath('/api/{0}/user/bobafett/'.format(client.version))
+        self.assertEqual(r.read(), 'Hello World!')
+
+    def test_endpoint_returns_future(self):
+        client = self.getClient()
+        r = client.endpoint('/user').get('bobafett').result(5)
+        self.assertPath('/api/{0}/user/bobafett/'.format(client.version))
+        self.assertEqual(r.read(), 'Hello World!')
+
+    def test_many_in_flight(self):
+        client = self.getClient(workers=4)
+        futures = [client.post('/user', username=str(i)) for i in range(20)]
+        for future in futures:
+            future.result(5)
+        self.assertRequestCount(20)
+
+    def test_callback(self):
+        client = self.getClient()
+        done = threading.Event()
+        client.delete('/user', 'bobafett').add_done_callback(
+            lambda f: done.set())
+        done.wait(5)
+        self.assertTrue(done.is_set())
+        self.assertMethod('DELETE')
+
+
+class AsyncBasicTestCase(AsyncTestCase, BulkTransferTestCase, BasicTestCase):
+    client_class = AsyncBasicClient
+
+
+class AsyncOAuthTestCase(AsyncTestCase, OAuthTestCase):
+    client_class = AsyncOAuthClient
+
+
+class AsyncThrottleTestCase(BasicTestCase):
+    client_class = AsyncBasicClient
+
+    def setUp(self):
+        self.server = TestHTTPServer(handler=HTTPThrottleRequestHandler)
+
+    def test_throttle_GET(self):
+        client = self.getClient()
+        future = client.get('/ping')
+        self.assertRaises(RequestError, future.result, 5)
+        self.assertRequestCount(3)
+
+
+class AsyncJSONTestCase(BasicTestCase):
+    client_class = AsyncBasicClient
+
+    def setUp(self):
+        self.server = TestHTTPServer(handler=HTTPJSONRequestHandler)
+
+    def test_json_GET(self):
+        client = self.getClient()
+        r = client.get('/user').result(5)
+        self.assertMethod('GET')
+        self.assertEqual(r, { 'foo': 'bar' })
+
+
+class HTTPETagRequestHandler(TestHTTPRequestHandler):
+    def respond(self):
+        if self.headers.get('If-None-Match') == '"v1"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("ETag", '"v1"')
+        self.end_headers()
+        self.wfile.write(json.dumps({'path': self.path}))
+
+
+class HTTPTreeRequestHandler(TestHTTPRequestHandler):
+    "Serves listings of a small tree, /b is split into two pages."
+    tree = {
+        '/': (['a', 'b', 'c.txt'], ),
+        '/a': (['d.txt'], ),
+        '/b': (['e', 'f.txt'], ['g.txt']),
+        '/a/d.txt': None,
+        '/b/e': ([], ),
+    }
+
+    def respond(self):
+        urlp = urlparse.urlparse(self.path)
+        path = '/' + urlp.path.split('/path/info/', 1)[1].strip('/')
+        page = int(urlparse.parse_qs(urlp.query).get('page', ['1'])[0])
+        pages = self.tree[path]
+        children = []
+        for name in pages[page - 1]:
+            child = path.rstrip('/') + '/' + name
+            children.append({'path': child, 'isdir': '.' not in name})
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps({'path': path, 'children': children,
+                                     'page': page, 'pages': len(pages)}))
+
+
+class WalkTestCase(BasicTestCase):
+    def setUp(self):
+        self.server = TestHTTPServer(handler=HTTPTreeRequestHandler)
+
+    def test_walk(self):
+        client = self.getClient()
+        paths = sorted(e['path'] for e in client.walk('/'))
+        self.assertEqual(paths, ['/a', '/a/d.txt', '/b', '/b/e', '/b/f.txt',
+                                 '/b/g.txt', '/c.txt'])
+        self.assertRequestCount(5)
+
+    def test_maxdepth_and_filter(self):
+        client = self.getClient()
+        files = client.walk('/', maxdepth=1, filter=lambda e: not e['isdir'])
+        self.assertEqual([e['path'] for e in files], ['/c.txt'])
+        self.assertRequestCount(1)
+
+    def test_onerror(self):
+        # Listing /b/e fails, as the server has no such directory.
+        tree = HTTPTreeRequestHandler.tree
+        HTTPTreeRequestHandler.tree = dict(tree)
+        del HTTPTreeRequestHandler.tree['/b/e']
+        errors = []
+        try:
+            client = self.getClient()
+            paths = [e['path'] for e in client.walk('/', onerror=errors.append)]
+        finally:
+            HTTPTreeRequestHandler.tree = tree
+        self.assertEqual(len(errors), 1)
+        self.assertTrue('/b/g.txt' in paths)
+
+
+class ItemDecoderTestCase(unittest.TestCase):
+    def chunked(self, doc, size=1):
+        doc = json.dumps(doc)
+        return [doc[i:i + size] for i in range(0, len(doc), size)]
+
+    def test_children(self):
+        doc = {'attributes': {'children': [1]}, 'path': u'/\u00e9',
+               'children': [{'name': u'\u00e9\u4e2d'}, 12345, [1, 2], None,
+                            'x'],
+               'size': 10}
+        for size in (1, 2, 3, 7, 1000):
+            items = list(ItemDecoder(self.chunked(doc, size)))
+            self.assertEqual(items, doc['children'])
+
+    def test_top_level_array(self):
+        items = list(ItemDecoder(self.chunked([1, 22, {'a': 'b'}], 2)))
+        self.assertEqual(items, [1, 22, {'a': 'b'}])
+
+    def test_empty_and_missing(self):
+        self.assertEqual(list(ItemDecoder(['{"children": [ ]}'])), [])
+        self.assertEqual(list(ItemDecoder(['{}'])), [])
+        self.assertEqual(list(ItemDecoder(['{"a": 1}'])), [])
+
+    def test_truncated(self):
+        decoder = ItemDecoder(['{"children": [1, 2'])
+        self.assertRaises(ValueError, list, decoder)
+
+
+class HTTPListingRequestHandler(TestHTTPRequestHandler):
+    def respond(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        children = [{'path': '/%s' % i} for i in range(1000)]
+        self.wfile.write(json.dumps({'path': '/', 'children': children}))
+
+
+class StreamItemsTestCase(BasicTestCase):
+    def setUp(self):
+        self.server = TestHTTPServer(handler=HTTPListingRequestHandler)
+
+    def test_stream_items(self):
+        client = self.getClient()
+        items = client.get('/path/info', '/', children=True, stream_items=True)
+        self.assertRequestCount(1)
+        self.assertEqual(self.server.requests[0].query, {'children': ['True']})
+        self.assertEqual([i['path'] for i in items],
+                         ['/%s' % i for i in range(1000)])
+
+    def test_stream_items_async(self):
+        self.client_class = AsyncBasicClient
+        client = self.getClient()
+        items = client.get('/path/info', '/', stream_items=True).result(5)
+        self.assertEqual(len(list(items)), 1000)
+
+
+class HTTPRemoteTreeRequestHandler(TestHTTPRequestHandler):
+    "Emulates the path endpoints over the server's files, {path: data}."
+    def json(self, value):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(json.dumps(value))
+
+    def respond(self):
+        files = self.server.files
+        request = self.server.requests[-1]
+        path = '/' + request.path.split('/', 5)[-1].strip('/')
+        if request.path.startswith('/api/2.1/path/info/'):
+            prefix = path.rstrip('/') + '/'
+            children = {}
+            for name in files:
+                if name.startswith(prefix):
+                    child = name[len(prefix):].split('/')[0]
+                    isdir = '/' in name[len(prefix):]
+                    children[child] = {'path': prefix + child, 'isdir': isdir,
+                                       'size': len(files[name]),
+                                       'time': '2100-01-01T00:00:00'}
+            self.json({'path': path, 'children': children.values()})
+        elif request.path.startswith('/api/2.1/path/data/'):
+            form = cgi.FieldStorage(fp=StringIO(request.body),
+                                    headers=self.headers,
+                                    environ={'REQUEST_METHOD': 'POST'})
+            files[path.rstrip('/') + '/' + form['file'].filename] = \
+                form['file'].value
+            self.json({})
+        elif request.path.endswith('/oper/move/'):
+            src = request.data['src'][0]
+            files[request.data['dst'][0] + '/' + src.split('/')[-1]] = \
+                files.pop(src)
+            self.json({})
+        elif request.path.endswith('/oper/remove/'):
+            del files[request.data['path'][0]]
+            self.json({})
+
+
+class SyncTestCase(BasicTestCase):
+    def setUp(self):
+        self.server = TestHTTPServer(handler=HTTPRemoteTreeRequestHandler)
+        self.server.files = {}
+        self.tmp = tempfile.mkdtemp()
+        self.write('a.txt', 'aaa')
+        self.write('d/b.txt', 'bbbb')
+
+    def tearDown(self):
+        super(SyncTestCase, self).tearDown()
+        shutil.rmtree(self.tmp)
+
+    def write(self, path, data):
+        path = os.path.join(self.tmp, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(data)
+
+    def sync(self, **kwargs):
+        del self.server.requests[:]
+        return self.getClient().sync(self.tmp, '/backup', **kwargs)
+
+    def test_sync(self):
+        plan = self.sync()
+        self.assertEqual(len(plan.uploads), 2)
+        self.assertTrue(all(r.ok for r in plan.results))
+        self.assertEqual(self.server.files, {'/backup/a.txt': 'aaa',
+                                             '/backup/d/b.txt': 'bbbb'})
+        # Nothing changed, so the index answers without any requests.
+        plan = self.sync()
+        self.assertEqual((len(plan), plan.unchanged), (0, 2))
+        self.assertRequestCount(0)
+        self.write('a.txt', 'changed')
+        plan = self.sync()
+        self.assertEqual(plan.uploads, [(os.path.join(self.tmp, 'a.txt'),
+                                         '/backup/a.txt')])
+        self.assertEqual(self.server.files['/backup/a.txt'], 'changed')
+
+    def test_moves_and_deletes(self):
+        self.sync()
+        os.renames(os.path.join(self.tmp, 'd/b.txt'),
+                   os.path.join(self.tmp, 'e/b.txt'))
+        os.unlink(os.path.join(self.tmp, 'a.txt'))
+        plan = self.sync(dry_run=True, delete=True)
+        self.assertEqual(plan.moves, [('/backup/d/b.txt', '/backup/e/b.txt')])
+        self.assertEqual(plan.deletes, ['/backup/a.txt'])
+        self.assertEqual([r.method for r in self.server.requests
+                          if r.method != 'GET'], [])
+        self.sync(delete=True)
+        self.assertEqual(self.server.files, {'/backup/e/b.txt': 'bbbb'})
+        self.assertEqual(len(self.sync(delete=True)), 0)
+
+    def test_checksum(self):
+        self.sync(checksum=True)
+        os.utime(os.path.join(self.tmp, 'a.txt'), (0, 0))
+        plan = self.sync(checksum=True)
+        self.assertEqual((len(plan), plan.unchanged), (0, 2))
+
+    def test_dry_run_writes_nothing(self):
+        index = os.path.join(self.tmp, '.smartfile-sync')
+        self.sync(dry_run=True)
+        self.assertFalse(os.path.exists(index))
+        self.sync(checksum=True)
+        os.utime(os.path.join(self.tmp, 'a.txt'), (0, 0))
+        before = SyncIndex(index, '/backup').files()
+        self.assertEqual(self.sync(checksum=True, dry_run=True).unchanged, 2)
+        self.getClient().sync(self.tmp, '/other', dry_run=True)
+        self.assertEqual(SyncIndex(index, '/backup').files(), before)
+
+    def test_changed_during_upload(self):
+        local = os.path.join(self.tmp, 'a.txt')
+        changed = []
+
+        def change(info):
+            # Changes a.txt as the first upload is sent.
+            if info['method'] == 'POST' and not changed:
+                changed.append(info['url'])
+                self.write('a.txt', 'changed')
+                os.utime(local, (0, 0))
+        client = self.getClient()
+        client.on('request', change)
+        client.sync(self.tmp, '/backup', index=os.path.join(self.tmp, 'idx'))
+        plan = client.sync(self.tmp, '/backup',
+                           index=os.path.join(self.tmp, 'idx'), dry_run=True)
+        self.assertTrue((local, '/backup/a.txt') in plan.uploads)
+
+    def test_existing_remote_files(self):
+        self.server.files['/backup/a.txt'] = 'aaa'
+        plan = self.sync()
+        self.assertEqual(plan.uploads, [(os.path.join(self.tmp, 'd/b.txt'),
+                                         '/backup/d/b.txt')])
+
+
+class CacheTestCase(BasicTestCase):
+    def setUp(self):
+        self.server = TestHTTPServer(handler=HTTPETagRequestHandler)
+
+    def test_fresh_entry_served(self):
+        client = self.getClient(cache=ResponseCache(ttl=60))
+        a = client.get('/path/info', '/a', children=True)
+        b = client.get('/path/info', '/a', children=True)
+        self.assertEqual(a, b)
+        self.assertRequestCount(1)
+        client.get('/path/info', '/a')
+        self.assertRequestCount(2)
+
+    def test_revalidate(self):
+        client = self.getClient(cache=ResponseCache(ttl=0))
+        a = client.get('/path/info', '/a')
+        b = client.get('/path/info', '/a')
+        self.assertEqual(a, b)
+        self.assertRequestCount(2)
+        self.assertEqual(self.server.requests[1].headers['If-None-Match'],
+                         '"v1"')
+
+    def test_write_invalidates(self):
+        client = self.getClient(cache=ResponseCache(ttl=60))
+        client.get('/path/info', '/a/b')
+        client.get('/path/info', '/a')
+        client.get('/path/info', '/c')
+        client.post('/path/oper/remove', path='/a/b')
+        self.assertEqual(len(client.cache), 1)
+        client.get('/path/info', '/a/b')
+        client.get('/path/info', '/c')
+        self.assertRequestCount(5)
+
+    def test_upload_invalidates(self):
+        self.server.shutdown()
+        self.server = StandInServer(files={'/dir/x.bin': 'aaa'})
+        with self.getClient(cache=ResponseCache(ttl=60)) as client:
+            self.assertEqual(client.get('/path/info', '/dir/x.bin')['size'], 3)
+            client.post('/path/data', '/dir',
+                        file=('x.bin', StringIO('fourteen bytes')))
+            self.assertEqual(client.get('/path/info', '/dir/x.bin')['size'],
+                             14)
+        self.assertRequestCount(3)
+
+    def test_unicode_params(self):
+        client = self.getClient(cache=ResponseCache(ttl=60))
+        client.get('/path/info', '/a', q=u'\xe9')
+        client.get('/path/info', '/a', q=u'\xe8')
+        self.assertRequestCount(2)
+
+    def test_lru(self):
+        lru = LRU(2)
+        lru['a'], lru['b'] = 1, 2
+        lru.get('a')
+        lru['c'] = 3
+        self.assertTrue('a' in lru)
+        self.assertFalse('b' in lru)
+        self.assertEqual(len(lru), 2)
+
+
+class StandInRequestHandler(TestHTTPRequestHandler):
+    """Emulates the parts of the API the client builds on: /path/info,
+    /path/data (downloads, with ranges, and uploads, whole or in parts with
+    Content-Range), /task and throttling,
+    over the server's files, {path: data}. Connections are kept alive, and
+    the server's latency and bandwidth options are applied to every
+    request."""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    write_size = 65536
+    truncate = False
+
+    def parse_and_record(self, method):
+        self.url = urlparse.urlparse(self.path)
+        self.body = None
+        if method in ('POST', 'PUT'):
+            self.body = self.read_body()
+            self.limit(len(self.body))
+        if self.server.record:
+            self.record(method, self.url.path,
+                        query=urlparse.parse_qs(self.url.query), body=self.body)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            if not self.server.accept_gzip:
+                return self.send(415, 'Unsupported Media Type', 'text/plain')
+            self.body = zlib.decompress(self.body, 16 + zlib.MAX_WBITS)
+        self.respond()
+
+    def limit(self, size):
+        "Waits as long as size bytes take at the server's bandwidth."
+        if self.server.bandwidth:
+            time.sleep(size / float(self.server.bandwidth))
+
+    def send(self, status, body='', content_type='application/json',
+             headers=()):
+        if self.truncate:
+            # Send half of the body, chunked, then hang up.
+            self.truncate = False
+            self.close_connection = 1
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            half = body[:len(body) // 2]
+            self.wfile.write('%x\r\n%s\r\n' % (len(half), half))
+            return
+        if self.server.compress and status == 200 and len(body) > 100 and \
+                'gzip' in self.headers.get('Accept-Encoding', ''):
+            gz = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = gz.compress(body) + gz.flush()
+            headers = list(headers) + [('Content-Encoding', 'gzip')]
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        for i in range(0, len(body), self.write_size):
+            chunk = body[i:i + self.write_size]
+            self.wfile.write(chunk)
+            self.limit(len(chunk))
+
+    def json(self, value, status=200):
+        self.send(status, json.dumps(value))
+
+    def respond(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        failure = None
+        if server.failures:
+            with server.lock:
+                failure = server.failures and server.failures.pop(0)
+        if isinstance(failure, float):
+            # Stall, then answer.
+            time.sleep(failure)
+            failure = None
+        if failure == 'truncate':
+            self.truncate = True
+            failure = None
+        if failure == 0:
+            # Hang up without a response.
+            self.close_connection = 1
+            return
+        if failure == 'throttle' or server.throttle_every and \
+                next(server.counter) % server.throttle_every == 0:
+            return self.send(503, 'Request Throttled!', 'text/plain', [(
+                'X-Throttle', 'throttled; next=%s sec' % server.throttle_delay)])
+        if failure:
+            return self.send(failure, 'Failed!', 'text/plain')
+        # /api/<version>/<endpoint>/<rest>
+        parts = self.url.path.split('/', 4)[3:] + ['', '']
+        endpoint, rest = parts[:2]
+        if endpoint == 'path':
+            operation, _, path = rest.partition('/')
+            path = '/' + path.strip('/')
+            if operation == 'info':
+                return self.info(path)
+            elif operation == 'data' and self.command == 'GET':
+                return self.download(path)
+            elif operation == 'data' and self.command == 'POST':
+                return self.upload(path)
+            elif operation == 'oper':
+                return self.oper(path.strip('/'))
+        elif endpoint == 'task':
+            return self.task(rest.strip('/'))
+        self.json({})
+
+    def entry(self, path, isdir=False):
+        return {'path': path, 'name': path.split('/')[-1], 'isdir': isdir,
+                'size': len(self.server.files.get(path, '')),
+                'time': '2100-01-01T00:00:00'}
+
+    def info(self, path):
+        files = self.server.files
+        if path in files:
+            return self.json(self.entry(path))
+        prefix = path.rstrip('/') + '/'
+        children = {}
+        for name in files.keys():
+            if name.startswith(prefix):
+                child = name[len(prefix):].split('/')[0]
+                children[child] = self.entry(prefix + child,
+                                             prefix + child not in files)
+        if not children and path != '/':
+            return self.json({'detail': 'Not found.'}, 404)
+        self.json(dict(self.entry(path, True), children=children.values()))
+
+    def download(self, path):
+        data = self.server.files.get(path)
+        if data is None:
+            return self.json({'detail': 'Not found.'}, 404)
+        m = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range', ''))
+        if m is None:
+            return self.send(200, data, 'application/octet-stream')
+        start, end = int(m.group(1)), min(int(m.group(2)), len(data) - 1)
+        self.send(206, data[start:end + 1], 'application/octet-stream', [(
+            'Content-Range', 'bytes %s-%s/%s' % (start, end, len(data)))])
+
+    def upload(self, path):
+        form = cgi.FieldStorage(fp=StringIO(self.body), headers=self.headers,
+                                environ={'REQUEST_METHOD': 'POST'})
+        path = path.rstrip('/') + '/' + form['file'].filename
+        m = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)',
+                     self.headers.get('Content-Range', ''))
+        if m is None or not self.server.ranged_uploads:
+            self.server.files[path] = form['file'].value
+            return self.json(self.entry(path))
+        # One part of a chunked upload, the file exists once all have come.
+        # The total may be *, unknown, until the last part.
+        start = int(m.group(1))
+        with self.server.lock:
+            upload = self.server.partial.setdefault(path, [None, {}])
+            if m.group(3) != '*':
+                upload[0] = int(m.group(3))
+            total, parts = upload
+            parts[start] = form['file'].value
+            if total is not None and \
+                    sum(len(p) for p in parts.values()) >= total:
+                del self.server.partial[path]
+                self.server.files[path] = ''.join(parts[k] for k in
+                                                  sorted(parts))
+        self.json(self.entry(path))
+
+    def oper(self, name):
+        "Performs a move, copy or remove, returns a task for it."
+        data = urlparse.parse_qs(self.body or '')
+        files = self.server.files
+        with self.server.lock:
+            uuid = '%s-%s' % (name, len(self.server.tasks))
+            self.server.tasks[uuid] = 0
+            try:
+                for path in data.get('path', ()):
+                    del files[path]
+                for src in data.get('src', ()):
+                    dst = data['dst'][0].rstrip('/') + '/' + src.split('/')[-1]
+                    files[dst] = name == 'move' and files.pop(src) or files[src]
+            except KeyError:
+                self.server.failed.add(uuid)
+        self.json({'uuid': uuid, 'status': 'PENDING'})
+
+    def task(self, uuid):
+        with self.server.lock:
+            polls = self.server.tasks[uuid] = self.server.tasks.get(uuid, 0) + 1
+        status = polls > self.server.task_polls and 'SUCCESS' or 'PENDING'
+        if uuid in self.server.failed:
+            status = 'FAILURE'
+        self.json({'uuid': uuid, 'status': status})
+
+
+class StandInServer(ThreadingMixIn, TestHTTPServer):
+    """A threaded stand-in for the API, for tests and benchmarks, serving
+    files, {path: data}. The options are:
+
+    latency: seconds to wait before each response.
+    bandwidth: bytes per second, for each request and response body.
+    throttle_every: throttle one request in this many, with x-throttle.
+    throttle_delay: the seconds throttled requests are told to wait.
+    task_polls: how many polls of a task answer PENDING before SUCCESS.
+    compress: gzip responses to clients that accept it.
+    accept_gzip: accept gzipped request bodies, rather than answering 415.
+    ranged_uploads: assemble files uploaded in parts with Content-Range,
+        rather than storing each part as the whole file.
+    failures: how the next requests fail, in order: a status code,
+        'throttle', 0 to close the connection without a response,
+        'truncate' to close it halfway through the response body, or a
+        float, the seconds to stall before answering as usual.
+    record: whether requests are recorded, turn off for long runs."""
+    daemon_threads = True
+    latency = 0
+    bandwidth = None
+    throttle_every = None
+    throttle_delay = 0.01
+    task_polls = 2
+    compress = False
+    accept_gzip = True
+    ranged_uploads = True
+    record = True
+
+    def __init__(self, address='127.0.0.1', port=0, files=None, failures=(),
+                 **options):
+        for name, value in options.items():
+            if not hasattr(StandInServer, name):
+                raise TypeError('Unknown option: %s' % name)
+            setattr(self, name, value)
+        self.files = files or {}
+        self.tasks = {}
+        self.failed = set()
+        self.partial = {}
+        self.failures = list(failures)
+        self.lock = threading.Lock()
+        self.counter = itertools.count(1)
+        TestHTTPServer.__init__(self, address, port,
+                                handler=StandInRequestHandler)
+
+    def handle_error(self, request, client_address):
+        # Clients that timed out have hung up, that is expected.
+        if not isinstance(sys.exc_info()[1], socket.error):
+            TestHTTPServer.handle_error(self, request, client_address)
+
+
+class StandInTestCase(BasicTestCase):
+    def setUp(self):
+        self.data = os.urandom(100000)
+        self.server = StandInServer(files={'/dir/a.bin': self.data})
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        super(StandInTestCase, self).tearDown()
+        shutil.rmtree(self.tmp)
+
+    def test_info(self):
+        with self.getClient() as client:
+            self.assertEqual(client.get('/path/info', '/dir/a.bin')['size'],
+                             100000)
+            listing = client.get('/path/info', '/dir')
+            self.assertEqual([c['path'] for c in listing['children']],
+                             ['/dir/a.bin'])
+            self.assertRaises(ResponseError, client.get, '/path/info', '/b')
+
+    def test_transfers(self):
+        local = os.path.join(self.tmp, 'a.bin')
+        with self.getClient() as client:
+            client.download_to('/dir/a.bin', local, part_size=30000)
+            with open(local, 'rb') as f:
+                self.assertEqual(f.read(), self.data)
+            results = client.upload_many([(local, '/up/')])
+        self.assertTrue(results[0].ok)
+        self.assertEqual(self.server.files['/up/a.bin'], self.data)
+        self.assertEqual(self.server.requests[1].headers['Range'],
+                         'bytes=0-29999')
+
+    def test_chunked_upload(self):
+        local = os.path.join(self.tmp, 'a.bin')
+        with open(local, 'wb') as f:
+            f.write(self.data)
+        with self.getClient() as client:
+            info = client.upload_chunked(local, '/up/', workers=2,
+                                         part_size=30000)
+        self.assertEqual(info['size'], 100000)
+        self.assertEqual(self.server.files['/up/a.bin'], self.data)
+        # The two bytes of the probe file, which was removed, and the parts.
+        self.assertEqual(sorted(self.server.files),
+                         ['/dir/a.bin', '/up/a.bin'])
+        ranges = sorted(r.headers['Content-Range'] for r in
+                        self.server.requests if 'Content-Range' in r.headers)
+        self.assertEqual(ranges, ['bytes 0-0/2',
+                                  'bytes 0-29999/100000',
+                                  'bytes 1-1/2',
+                                  'bytes 30000-59999/100000',
+                                  'bytes 60000-89999/100000',
+                                  'bytes 90000-99999/100000'])
+        self.assertFalse(os.path.exists(local + '.upload'))
+
+    def test_chunked_upload_checkpoint_replaced(self):
+        local = os.path.join(self.tmp, 'a.bin')
+        with open(local, 'wb') as f:
+            f.write(self.data)
+        rename, os.rename = os.rename, windows_rename
+        try:
+            with self.getClient() as client:
+                client.upload_chunked(local, '/up/', part_size=30000)
+        finally:
+            os.rename = rename
+        self.assertEqual(self.server.files['/up/a.bin'], self.data)
+
+    def test_chunked_upload_unsupported(self):
+        self.server.ranged_uploads = False
+        local = os.path.join(self.tmp, 'a.bin')
+        with open(local, 'wb') as f:
+            f.write(self.data)
+        with self.getClient() as client:
+            client.upload_chunked(local, '/up/', part_size=30000)
+        # The server ignores Content-Range, the file is sent whole.
+        self.assertEqual(self.server.files, {'/dir/a.bin': self.data,
+                                             '/up/a.bin': self.data})
+        self.assertFalse('Content-Range' in self.server.requests[-1].headers)
+        self.assertRequestCount(4)
+
+    def test_chunked_upload_resumed(self):
+        local = os.path.join(self.tmp, 'a.bin')
+        with open(local, 'wb') as f:
+            f.write(self.data)
+        # The probe takes four requests, the second part fails.
+        self.server.failures = [None] * 5 + [0]
+        with self.getClient() as client:
+            self.assertRaises(RequestError, client.upload_chunked, local,
+                              '/up/b.bin', workers=1, part_size=30000)
+            self.assertFalse('/up/b.bin' in self.server.files)
+            with open(local + '.upload') as f:
+                self.assertEqual(json.load(f)['done'], [0, 2, 3])
+            del self.server.requests[:]
+            client.upload_chunked(local, '/up/b.bin', workers=1,
+                                  part_size=30000)
+        self.assertEqual(self.server.files['/up/b.bin'], self.data)
+        self.assertEqual(self.server.requests[0].headers['Content-Range'],
+                         'bytes 30000-59999/100000')
+        # The missing part, and the size check.
+        self.assertRequestCount(2)
+
+    def test_chunked_upload_small_file(self):
+        local = os.path.join(self.tmp, 'a.bin')
+        with open(local, 'wb') as f:
+            f.write('small')
+        with self.getClient() as client:
+            client.upload_chunked(local, '/up/')
+        self.assertEqual(self.server.files['/up/a.bin'], 'small')
+        self.assertFalse('Content-Range' in self.server.requests[0].headers)
+
+    def test_process_pipeline(self):
+        pairs = []
+        for i, size in enumerate((100000, 30000, 0)):
+            local = os.path.join(self.tmp, '%s.bin' % i)
+            with open(local, 'wb') as f:
+                f.write(self.data[:size])
+            pairs.append((local, '/up/'))
+        pairs.append((os.path.join(self.tmp, 'missing'), '/up/'))
+        with self.getClient() as client:
+            with ProcessPipeline(client, processes=2, threads=2,
+                                 part_size=30000) as pipeline:
+                results = pipeline.upload_many(pairs)
+        for i, size in enumerate((100000, 30000, 0)):
+            self.assertEqual(self.server.files['/up/%s.bin' % i],
+                             self.data[:size])
+            self.assertEqual(results[i].result['sent'], size)
+        self.assertEqual(results[0].result['digests'], [
+            hashlib.md5(self.data[i:i + 30000]).hexdigest()
+            for i in range(0, 100000, 30000)])
+        self.assertTrue(isinstance(results[3].error, OSError))
+        # The probe, four parts, one whole file and an empty one.
+        self.assertRequestCount(10)
+
+    def test_process_pipeline_unsupported(self):
+        self.server.ranged_uploads = False
+        pairs = []
+        for i, size in enumerate((100000, 30000)):
+            local = os.path.join(self.tmp, '%s.bin' % i)
+            with open(local, 'wb') as f:
+                f.write(self.data[:size])
+            pairs.append((local, '/up/'))
+        with self.getClient() as client:
+            with ProcessPipeline(client, processes=2, threads=2,
+                                 part_size=30000) as pipeline:
+                results = pipeline.upload_many(pairs)
+        # The large file is not sent in parts the server would not assemble.
+        self.assertTrue(isinstance(results[0].error, APIError))
+        self.assertTrue(results[1].ok)
+        self.assertEqual(self.server.files, {'/dir/a.bin': self.data,
+                                             '/up/1.bin': self.data[:30000]})
+        # The probe, and the small file.
+        self.assertRequestCount(4)
+
+    def test_process_pipeline_compressed(self):
+        local = os.path.join(self.tmp, 'a.txt')
+        data = 'compressible text\n' * 10000
+        with open(local, 'wb') as f:
+            f.write(data)
+        with self.getClient() as client:
+            with ProcessPipeline(client, processes=2, part_size=50000,
+                                 compress=True, checksum='sha1') as pipeline:
+                result, = pipeline.upload_many([(local, '/up/b.txt')])
+        uploaded = self.server.files['/up/b.txt.gz']
+        self.assertEqual(result.result['sent'], len(uploaded))
+        self.assertTrue(len(uploaded) < len(data) // 10)
+        # Each part is a gzip member, together they decompress to the file.
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(uploaded)).read(),
+                         data)
+        totals = sorted(r.headers['Content-Range'].split('/')[1]
+                        for r in self.server.requests
+                        if 'Content-Range' in r.headers)
+        # The two bytes of the probe, then the parts.
+        self.assertEqual(totals, ['*'] * 3 + sorted(['2', '2',
+                                                     str(len(uploaded))]))
+
+    def test_download(self):
+        local = os.path.join(self.tmp, 'a.bin')
+        calls = []
+        checksum = hashlib.sha1()
+        with self.getClient() as client:
+            self.assertEqual(client.download('/dir/a.bin', self.tmp,
+                             chunk_size=30000, checksum=checksum,
+                             progress=lambda *a: calls.append(a)), local)
+            with open(local, 'rb') as f:
+                self.assertEqual(f.read(), self.data)
+            self.assertEqual(checksum.hexdigest(),
+                             hashlib.sha1(self.data).hexdigest())
+            self.assertEqual(calls[0], (30000, 100000))
+            self.assertEqual(calls[-1], (100000, 100000))
+            client.download('/dir/a.bin', local,
+                            expect=hashlib.md5(self.data).hexdigest())
+            self.assertRaises(APIError, client.download, '/dir/a.bin', local,
+                              expect='0' * 32)
+            self.assertFalse(os.path.exists(local))
+
+    def test_file_sink_readinto(self):
+        src = os.path.join(self.tmp, 'src')
+        with open(src, 'wb') as f:
+            f.write(self.data)
+        fd, dst = tempfile.mkstemp(dir=self.tmp)
+        try:
+            sink = FileSink(fd, chunk_size=4096)
+            with open(src, 'rb') as f:
+                self.assertEqual(sink.copy(f), 100000)
+            sink.write('tail')
+        finally:
+            os.close(fd)
+        with open(dst, 'rb') as f:
+            self.assertEqual(f.read(), self.data + 'tail')
+
+    def test_tasks_and_throttling(self):
+        self.server.throttle_every = 3
+        with self.getClient() as client:
+            client.task_waiter = TaskWaiter(client, initial=0.01)
+            status = client.wait_for_task({'uuid': 'abc'})
+        self.assertEqual(status['status'], 'SUCCESS')
+        self.assertEqual(self.server.tasks['abc'], 3)
+        # Every third request was throttled and retried.
+        self.assertRequestCount(4)
+
+    def test_latency(self):
+        self.server.latency = 0.05
+        with self.getClient() as client:
+            start = time.time()
+            client.get('/path/info', '/dir')
+        self.assertTrue(time.time() - start >= 0.05)
+
+
+class BatchTestCase(BasicTestCase):
+    def setUp(self):
+        files = dict(('/src/%s' % i, str(i)) for i in range(250))
+        self.server = StandInServer(files=files, task_polls=0)
+
+    def getClient(self, **kwargs):
+        client = super(BatchTestCase, self).getClient(**kwargs)
+        client.task_waiter = TaskWaiter(client, initial=0.01)
+        return client
+
+    def posts(self):
+        return [r for r in self.server.requests if r.method == 'POST']
+
+    def test_move_many(self):
+        pairs = [('/src/%s' % i, i % 5 and '/a' or '/b/') for i in range(250)]
+        with self.getClient() as client:
+            result = client.move_many(pairs)
+        self.assertTrue(result.ok)
+        # 50 files to /b in one call, 200 to /a in two.
+        self.assertEqual([len(c.sources) for c in result.calls],
+                         [50, 100, 100])
+        self.assertEqual([c.dst for c in result.calls], ['/b', '/a', '/a'])
+        self.assertEqual(len(self.posts()), 3)
+        self.assertEqual(len(result.tasks), 3)
+        self.assertEqual(self.server.tasks.values(), [1, 1, 1])
+        self.assertEqual(self.server.files['/b/5'], '5')
+        self.assertFalse([p for p in self.server.files if p.startswith('/src')])
+
+    def test_copy_many_without_waiting(self):
+        with self.getClient() as client:
+            result = client.copy_many([('/src/1', '/c'), ('/src/2', '/c')],
+                                      wait=False)
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result.calls[0].status, None)
+        self.assertEqual(self.server.files['/c/1'], self.server.files['/src/1'])
+        self.assertEqual(self.server.tasks.values(), [0])
+
+    def test_remove_many_failure(self):
+        paths = ['/src/%s' % i for i in range(10)] + ['/missing']
+        with self.getClient() as client:
+            result = client.remove_many(paths, chunk_size=5)
+        self.assertEqual(len(result), 3)
+        self.assertFalse(result.ok)
+        self.assertEqual(result.failed, ['/missing'])
+        self.assertTrue(isinstance(result.errors[0], TaskError))
+        self.assertEqual(len(self.server.files), 240)
+
+
+class CompressionTestCase(BasicTestCase):
+    def setUp(self):
+        self.data = 'compressible ' * 10000
+        files = dict(('/dir/%s' % i, self.data) for i in range(100))
+        self.server = StandInServer(files=files, compress=True)
+
+    def test_responses(self):
+        with self.getClient() as client:
+            listing = client.get('/path/info', '/dir')
+            self.assertEqual(len(listing['children']), 100)
+            self.assertTrue(client.bytes_saved['received'] > 0)
+            self.assertEqual(client.get('/path/data', '/dir/1').read(),
+                             self.data)
+        self.assertEqual(self.server.requests[0].headers['Accept-Encoding'],
+                         'gzip, deflate')
+
+    def test_download(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            totals = []
+            with self.getClient() as client:
+                local = client.download('/dir/1', tmp,
+                                        progress=lambda d, t: totals.append(t))
+            with open(local, 'rb') as f:
+                self.assertEqual(f.read(), self.data)
+            # The compressed length says nothing about the file's.
+            self.assertEqual(set(totals), set([None]))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_ranged_download_not_compressed(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            local = os.path.join(tmp, 'a')
+            with self.getClient() as client:
+                client.download_to('/dir/1', local, part_size=50000)
+            with open(local, 'rb') as f:
+                self.assertEqual(f.read(), self.data)
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_disabled(self):
+        with self.getClient(compress=False) as client:
+            client.get('/path/info', '/dir')
+            self.assertEqual(client.bytes_saved['received'], 0)
+        self.assertEqual(self.server.requests[0].headers['Accept-Encoding'],
+                         'identity')
+
+    def test_requests(self):
+        paths = ['/dir/%s' % i for i in range(100)]
+        with self.getClient(compress_requests=True) as client:
+            client.post('/path/oper/remove', path=paths)
+            self.assertTrue(client.bytes_saved['sent'] > 0)
+            # Too small to compress.
+            client.post('/path/oper/remove', path='/missing')
+        self.assertEqual(self.server.files, {})
+        headers = [r.headers for r in self.server.requests]
+        self.assertEqual(headers[0]['Content-Encoding'], 'gzip')
+        self.assertFalse('Content-Encoding' in headers[1])
+
+    def test_requests_encoded(self):
+        self.server.files['/dir/caf\xc3\xa9'] = 'cafe'
+        paths = ['/dir/%s' % i for i in range(100)] + [u'/dir/caf\xe9']
+        with self.getClient(compress_requests=True) as client:
+            client.post('/path/oper/move', src=paths, dst=u'/d\xe9st',
+                        overwrite=None)
+            self.assertTrue(client.bytes_saved['sent'] > 0)
+        self.assertEqual(self.server.files['/d\xc3\xa9st/caf\xc3\xa9'], 'cafe')
+        self.assertEqual(len(self.server.files), 101)
+        body = zlib.decompress(self.server.requests[0].body,
+                               16 + zlib.MAX_WBITS)
+        self.assertFalse('overwrite' in urlparse.parse_qs(body))
+
+    def test_requests_refused(self):
+        self.server.accept_gzip = False
+        paths = ['/dir/%s' % i for i in range(100)]
+        with self.getClient(compress_requests=True) as client:
+            client.post('/path/oper/remove', path=paths)
+            self.assertFalse(client.compress_requests)
+            self.assertEqual(client.bytes_saved['sent'], 0)
+        self.assertEqual(self.server.files, {})
+        self.assertRequestCount(2)
+
+
+class RetryTestCase(BasicTestCase):
+    def setUp(self):
+        self.server = StandInServer(files={'/a': 'aaa'})
+
+    def getClient(self, **kwargs):
+        kwargs.setdefault('retry', RetryPolicy(backoff=0.01))
+        return super(RetryTestCase, self).getClient(**kwargs)
+
+    def test_transient_failures(self):
+        self.server.failures = [502, 0]
+        with self.getClient() as client:
+            self.assertEqual(client.get('/path/info', '/a')['size'], 3)
+        self.assertRequestCount(3)
+
+    def test_truncated_response(self):
+        self.server.failures = ['truncate']
+        with self.getClient() as client:
+            self.assertEqual(client.get('/path/info', '/a')['size'], 3)
+        self.assertRequestCount(2)
+
+    def test_truncated_post_not_retried(self):
+        self.server.failures = ['truncate']
+        with self.getClient() as client:
+            self.assertRaises(RequestError, client.post, '/path/oper/remove',
+                              path='/a')
+        self.assertRequestCount(1)
+
+    def test_post_not_retried(self):
+        self.server.failures = [502]
+        with self.getClient() as client:
+            self.assertRaises(ResponseError, client.post, '/path/oper/remove',
+                              path='/a')
+        self.assertRequestCount(1)
+        self.assertEqual(self.server.files, {'/a': 'aaa'})
+
+    def test_gives_up(self):
+        self.server.failures = [504, 504, 504, 504]
+        with self.getClient() as client:
+            self.assertRaises(ResponseError, client.get, '/path/info', '/a')
+        self.assertRequestCount(3)
+
+    def test_upload_rewound(self):
+        self.server.failures = ['throttle', 'throttle']
+        data = os.urandom(200000)
+        with self.getClient(upload_chunk_size=4096) as client:
+            client.post('/path/data', '/up', file=('b', StringIO(data)))
+        self.assertRequestCount(3)
+        self.assertEqual(self.server.files['/up/b'], data)
+
+    def test_iterator_not_rewound(self):
+        self.server.failures = ['throttle']
+        with self.getClient() as client:
+            self.assertRaises(ResponseError, client.post, '/path/data', '/up',
+                              file=('b', iter(['a', 'b'])))
+        self.assertRequestCount(1)
+
+    def test_budget(self):
+        self.server.failures = [502]
+        policy = RetryPolicy(backoff=0.01, budget=RetryBudget(0, capacity=1))
+        with self.getClient(retry=policy) as client:
+            self.assertEqual(client.get('/path/info', '/a')['size'], 3)
+            # The one retry was spent.
+            self.server.failures = [502]
+            self.assertRaises(ResponseError, client.get, '/path/info', '/a')
+        self.assertRequestCount(3)
+
+    def test_max_elapsed(self):
+        self.server.failures = [502]
+        policy = RetryPolicy(backoff=1, jitter=False, max_elapsed=0.5)
+        with self.getClient(retry=policy) as client:
+            self.assertRaises(ResponseError, client.get, '/path/info', '/a')
+        self.assertRequestCount(1)
+
+    def test_async(self):
+        self.server.failures = [503, 'truncate']
+        client = AsyncBasicClient(key=API_KEY, password=API_PASSWORD,
+                                  url='http://127.0.0.1:%s/' %
+                                  self.server.server_port,
+                                  retry=RetryPolicy(backoff=0.01))
+        with client:
+            self.assertEqual(client.get('/path/info', '/a').result(5)['size'],
+                             3)
+        self.assertRequestCount(3)
+
+    def test_backoff(self):
+        policy = RetryPolicy(backoff=1, factor=2, max_backoff=3, jitter=False)
+        self.assertEqual([policy.backoff_delay(a) for a in (1, 2, 3)],
+                         [1, 2, 3])
+        policy.jitter = True
+        self.assertTrue(0 <= policy.backoff_delay(2) <= 2)
+
+
+class TimeoutTestCase(BasicTestCase):
+    def setUp(self):
+        self.server = StandInServer(files={'/a': 'aaa'})
+
+    def getClient(self, **kwargs):
+        kwargs.setdefault('retry', RetryPolicy(backoff=0.01))
+        return super(TimeoutTestCase, self).getClient(**kwargs)
+
+    def test_read_timeout(self):
+        self.server.failures = [0.5]
+        with self.getClient(timeout=(1, 0.1)) as client:
+            self.assertEqual(client.get('/path/info', '/a')['size'], 3)
+        self.assertRequestCount(2)
+
+    def test_hedge(self):
+        self.server.failures = [0.5]
+        hedges = []
+        hedge = Hedge(initial=0.05)
+        with self.getClient(hedge=hedge) as client:
+            client.on('hedge', hedges.append)
+            start = time.time()
+            self.assertEqual(client.get('/path/info', '/a')['size'], 3)
+            self.assertTrue(time.time() - start < 0.4)
+        hedge.close()
+        self.assertEqual([h['delay'] for h in hedges], [0.05])
+
+    def test_hedge_not_needed(self):
+        hedge = Hedge(initial=0.5)
+        with self.getClient(hedge=hedge) as client:
+            self.assertEqual(client.get('/path/info', '/a')['size'], 3)
+            self.assertRaises(ResponseError, client.get, '/path/info', '/b')
+            client.post('/path/oper/remove', path='/a')
+        hedge.close()
+        self.assertRequestCount(3)
+
+    def test_hedge_concurrent(self):
+        self.server.latency = 0.2
+        hedge = Hedge(initial=5, workers=1)
+        with self.getClient(hedge=hedge, pool_size=4) as client:
+            threads = [threading.Thread(target=client.get,
+                                        args=('/path/info', '/a'))
+                       for i in range(4)]
+            start = time.time()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            # The requests did not wait for the hedge's one worker.
+            self.assertTrue(time.time() - start < 0.6)
+        hedge.close()
+        self.assertRequestCount(4)
+
+    def test_hedge_not_streamed(self):
+        self.server.latency = 0.1
+        hedges = []
+        hedge = Hedge(initial=0.01)
+        with self.getClient(hedge=hedge) as client:
+            client.on('hedge', hedges.append)
+            items = list(client.get('/path/info', '/', children=True,
+                                    stream_items=True))
+        hedge.close()
+        self.assertEqual([i['path'] for i in items], ['/a'])
+        self.assertEqual(hedges, [])
+        self.assertRequestCount(1)
+
+    def test_hedge_budget(self):
+        self.server.failures = [0.3]
+        hedge = Hedge(initial=0.05, budget=RetryBudget(0, capacity=0))
+        with self.getClient(hedge=hedge) as client:
+            start = time.time()
+            client.get('/path/info', '/a')
+            self.assertTrue(time.time() - start >= 0.3)
+        hedge.close()
+        self.assertRequestCount(1)
+
+    def test_hedge_delay(self):
+        hedge = Hedge(initial=1, min_samples=10, window=20)
+        self.assertEqual(hedge.delay('path/info'), 1)
+        for i in range(15):
+            hedge.record('path/info', 0.01)
+        self.assertTrue(0.01 <= hedge.delay('path/info') < 0.012)
+        for i in range(5):
+            hedge.record('path/info', 0.5)
+        self.assertEqual(hedge.delay('path/info'), 0.5)
+        self.assertEqual(hedge.delay('path/data'), 1)
+        # A full window is forgotten.
+        hedge.record('path/info', 0.01)
+        self.assertEqual(hedge.delay('path/info'), 1)
+        hedge.close()
+
+    def test_breaker(self):
+        self.server.failures = [502, 502]
+        breaker = CircuitBreaker(threshold=2, reset_timeout=0.2)
+        with self.getClient(breaker=breaker) as client:
+            self.assertRaises(CircuitOpenError, client.get, '/path/info', '/a')
+            self.assertRaises(CircuitOpenError, client.get, '/path/info', '/a')
+            self.assertEqual(breaker.state('path/info'), 'open')
+            # Other endpoints are unaffected.
+            client.get('/task', 'x')
+            time.sleep(0.2)
+            self.assertEqual(client.get('/path/info', '/a')['size'], 3)
+            self.assertEqual(breaker.state('path/info'), 'closed')
+        self.assertRequestCount(4)
+
+    def test_breaker_ignores_client_errors(self):
+        self.server.failures = ['throttle']
+        breaker = CircuitBreaker(threshold=1)
+        with self.getClient(breaker=breaker) as client:
+            client.get('/path/info', '/a')
+            self.assertRaises(ResponseError, client.get, '/path/info', '/b')
+        self.assertEqual(breaker.state('path/info'), 'closed')
+
+    def test_breaker_half_open(self):
+        breaker = CircuitBreaker(threshold=1, reset_timeout=0)
+        client = self.getClient()
+        url = client.url + 'api/2/path/info/a'
+        key = breaker.before(client, url)
+        self.assertTrue(breaker.failure(key))
+        # One trial is let through, the next waits for its outcome.
+        breaker.before(client, url)
+        self.assertRaises(CircuitOpenError, breaker.before, client, url)
+        self.assertTrue(breaker.failure(key))
+        breaker.before(client, url)
+        breaker.success(key)
+        breaker.before(client, url)
+        breaker.before(client, url)
+
+
+    def test_breaker_trial_released(self):
+        breaker = CircuitBreaker(threshold=1, reset_timeout=0)
+
+        def fail(info):
+            raise ValueError('Hook failed.')
+        with self.getClient(breaker=breaker) as client:
+            url = client.url + 'api/2/path/info/a'
+            breaker.failure(breaker.before(client, url))
+            client.on('request', fail)
+            # The trial raised before it was sent, another is let through.
+            self.assertRaises(ValueError, client.get, '/path/info', '/a')
+            self.assertEqual(breaker.state('path/info'), 'half-open')
+            breaker.before(client, url)
+
+
+class SingleFlightTestCase(BasicTestCase):
+    def setUp(self):
+        self.server = StandInServer(files={'/a': 'aaa'}, latency=0.2)
+
+    def get_all(self, client, *calls):
+        """Makes GET calls, (args, kwargs) pairs, at once from threads,
+        returns their results or errors."""
+        results = [None] * len(calls)
+
+        def get(i, args, kwargs):
+            try:
+                results[i] = client.get(*args, **kwargs)
+            except Exception, e:
+                results[i] = e
+        threads = [threading.Thread(target=get, args=(i,) + call)
+                   for i, call in enumerate(calls)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_shared(self):
+        flight = SingleFlight()
+        with self.getClient(single_flight=flight) as client:
+            results = self.get_all(client, *[(('/path/info', '/a'), {})] * 5)
+        self.assertEqual(results[0]['size'], 3)
+        for result in results:
+            self.assertTrue(result is results[0])
+        self.assertEqual(flight.shared, 4)
+        self.assertEqual(len(flight), 0)
+        self.assertRequestCount(1)
+
+    def test_different_calls(self):
+        with self.getClient(single_flight=SingleFlight()) as client:
+            self.get_all(client, (('/path/info', '/a'), {}),
+                         (('/path/info', '/a'), {'children': True}),
+                         (('/task', 'x'), {}),
+                         (('/path/info', '/a'), {'q': u'\xe9'}),
+                         (('/path/info', '/a'), {'q': u'\xe8'}))
+        self.assertRequestCount(5)
+
+    def test_errors_shared(self):
+        with self.getClient(single_flight=SingleFlight(),
+                            retry=RetryPolicy(tries=1)) as client:
+            results = self.get_all(client, *[(('/path/info', '/b'), {})] * 3)
+        for result in results:
+            self.assertTrue(isinstance(result, ResponseError))
+            self.assertEqual(result.status_code, 404)
+        self.assertRequestCount(1)
+
+    def test_async(self):
+        flight = SingleFlight()
+        client = AsyncBasicClient(key=API_KEY, password=API_PASSWORD,
+                                  url='http://127.0.0.1:%s/' %
+                                  self.server.server_port,
+                                  single_flight=flight)
+        with client:
+            futures = [client.get('/path/info', '/a') for i in range(5)]
+            futures.append(client.endpoint('/path/info').get('/a'))
+            futures.append(client.get('/path/info', '/b'))
+            for future in futures[:-1]:
+                self.assertEqual(future.result(5)['size'], 3)
+            self.assertRaises(ResponseError, futures[-1].result, 5)
+        self.assertEqual(flight.shared, 5)
+        self.assertRequestCount(2)
+
+    def test_files_not_shared(self):
+        self.server.files['/a.bin'] = 'x' * 1000
+        with self.getClient(single_flight=SingleFlight()) as client:
+            results = self.get_all(client, *[(('/path/data', '/a.bin'), {})] * 3)
+            self.assertEqual([r.read() for r in results], ['x' * 1000] * 3)
+
+
+class RecordsTestCase(BasicTestCase):
+    ENTRY = {u'acl': {u'list': True, u'read': True, u'remove': True,
+                      u'write': True},
+             u'attributes': {}, u'extension': u'.png', u'id': 7,
+             u'isdir': False, u'mime': u'image/png', u'name': u'a.png',
+             u'path': u'/a.png', u'size': 1024, u'tags': [],
+             u'time': u'2013-02-23T22:49:30', u'owner': None,
+             u'url': u'http://localhost:8000/api/2/path/info/a.png'}
+
+    def setUp(self):
+        self.server = StandInServer(files={'/dir/a': 'aaa', '/dir/b/c': 'c'})
+
+    def test_record(self):
+        record = PathInfo(self.ENTRY)
+        self.assertEqual(record.size, 1024)
+        self.assertEqual(record.time, datetime.datetime(2013, 2, 23, 22, 49,
+                                                        30))
+        self.assertEqual(record['time'], u'2013-02-23T22:49:30')
+        self.assertEqual(record['owner'], None)
+        self.assertEqual(record.get('children', []), [])
+        self.assertRaises(KeyError, lambda: record['children'])
+        self.assertTrue('mime' in record and 'owner' in record)
+        self.assertFalse('pages' in record)
+        self.assertEqual(record.to_dict(), self.ENTRY)
+        self.assertRaises(AttributeError, setattr, record, 'other', 1)
+
+    def test_missing_fields(self):
+        record = PathInfo({'path': '/a', 'isdir': False, 'mime': None})
+        self.assertEqual(record.size, None)
+        self.assertEqual(record.time, None)
+        self.assertFalse('size' in record or 'time' in record)
+        self.assertTrue('mime' in record)
+        self.assertRaises(KeyError, lambda: record['size'])
+        self.assertEqual(record.get('size', 0), 0)
+        self.assertEqual(record.to_dict(), {'path': '/a', 'isdir': False,
+                                            'mime': None})
+        self.assertRaises(AttributeError, getattr, record, 'other')
+
+    def test_unhashable_acl(self):
+        entry = dict(self.ENTRY, acl={'list': True, 'groups': ['staff']})
+        a, b = PathInfo(entry), PathInfo(json.loads(json.dumps(entry)))
+        self.assertEqual(a.acl, b.acl)
+        self.assertFalse(a.acl is b.acl)
+
+    def test_shared_values(self):
+        a = PathInfo(self.ENTRY)
+        b = PathInfo(json.loads(json.dumps(self.ENTRY)))
+        self.assertTrue(a.mime is b.mime)
+        self.assertTrue(a.extension is b.extension)
+        self.assertTrue(a.acl is b.acl)
+
+    def test_smaller_than_dict(self):
+        record = PathInfo(self.ENTRY)
+        self.assertTrue(sys.getsizeof(record) * 3 < sys.getsizeof(self.ENTRY))
+
+    def test_client(self):
+        with self.getClient(records=True) as client:
+            info = client.get('/path/info', '/dir', children=True)
+            self.assertTrue(isinstance(info, PathInfo))
+            self.assertEqual(sorted(c.name for c in info['children']),
+                             ['a', 'b'])
+            self.assertEqual(info.get('children')[0].time.year, 2100)
+            streamed = list(client.get('/path/info', '/dir', children=True,
+                                       stream_items=True))
+            self.assertTrue(isinstance(streamed[0], PathInfo))
+            walked = sorted(e.path for e in client.walk('/dir'))
+            self.assertEqual(walked, ['/dir/a', '/dir/b', '/dir/b/c'])
+
+    def test_off_by_default(self):
+        with self.getClient() as client:
+            self.assertTrue(isinstance(client.get('/path/info', '/dir/a'),
+                                       dict))
+
+
+class LazyImportTestCase(unittest.TestCase):
+    def test_optional_modules_not_imported(self):
+        code = ('import sys, smartfile; '
+                'print sorted(m for m in ("oauthlib", "requests_oauthlib", '
+                '"netrc", "sqlite3", "mmap", "smartfile.sync") '
+                'if m in sys.modules)')
+        output = subprocess.Popen([sys.executable, '-c', code],
+                                  stdout=subprocess.PIPE).communicate()[0]
+        self.assertEqual(output.strip(), '[]')
+
+
+class CLITestCase(BasicTestCase):
+    def setUp(self):
+        self.server = StandInServer(files={'/dir/a': 'aaa', '/dir/b': 'bb',
+                                           '/x/c': 'c'}, task_polls=0)
+
+    def main(self, *args):
+        argv = ['--url', 'http://127.0.0.1:%s/' % self.server.server_port,
+                '--key', API_KEY, '--password', API_PASSWORD] + list(args)
+        stdout = sys.stdout
+        sys.stdout = StringIO()
+        try:
+            status = cli.main(argv)
+            return status, sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_command(self):
+        status, output = self.main('ls', '/dir')
+        self.assertEqual(status, 0)
+        self.assertEqual(json.loads(output), ['/dir/a', '/dir/b'])
+        status, output = self.main('get', '/path/data', '/dir/a')
+        self.assertEqual(output, 'aaa')
+        status, output = self.main('get', '/path/info', '/dir/a',
+                                   'children=true')
+        self.assertEqual(json.loads(output)['size'], 3)
+        self.assertEqual(self.server.requests[-1].query,
+                         {'children': ['true']})
+
+    def test_batch(self):
+        lines = ['# A comment', 'ls /dir', '', 'mv /x/c /other',
+                 'get /path/info /nothing', 'bogus',
+                 'get /path/info "/dir/b"']
+        out = StringIO()
+        with self.getClient() as client:
+            failed = cli.run_batch(client, iter(lines), out, jobs=4)
+        results = [json.loads(l) for l in out.getvalue().splitlines()]
+        self.assertEqual(failed, 2)
+        self.assertEqual([r['line'] for r in results], [2, 4, 5, 6, 7])
+        self.assertEqual(results[0]['result'], ['/dir/a', '/dir/b'])
+        self.assertEqual(results[1]['result'][0]['status'], 'SUCCESS')
+        self.assertTrue('error' in results[2])
+        self.assertEqual(results[3]['error'], 'Unknown command: bogus')
+        self.assertEqual(results[4]['result']['size'], 2)
+        self.assertEqual(sorted(self.server.files),
+                         ['/dir/a', '/dir/b', '/other/c'])
+
+
 # TODO: Test with missing oauthlib...
 # Must invoke an ImportError when smartfile tries to import it. Then the test
 # case should verify that the correct exception (NotImplementedError) is raised